@@ -1,11 +1,14 @@
 import numpy as np
 import torch
 import utils.pc_utils as pc_utils
+from utils.amp_utils import fp32
+from utils.profiler import profiled
 
 DefRec_SCALER = 20.0
 
 
-def deform_input(X, lookup, DefRec_dist='volume_based_voxels', device='cuda:0'):
+@profiled('defrec_deform')
+def deform_input(X, lookup, DefRec_dist='volume_based_voxels', device='cuda:0', valid=None):
     """
     Deform a region in the point cloud. For more details see https://arxiv.org/pdf/2003.12641.pdf
     Input:
@@ -13,6 +16,9 @@ def deform_input(X, lookup, DefRec_dist='volume_based_voxels', device='cuda:0'):
         X - Point cloud [B, C, N]
         lookup - regions center point
         device - cuda/cpu
+        valid - valid points of the padded shapes [B, N], None if all the points are valid. The padding
+                (copies of points of the shape) is deformed with its points, but it is not counted in the
+                region sizes and it is left out of the mask (of the reconstruction loss)
     Return:
         X - Point cloud with a deformed region
         mask - 0/1 label per point indicating if the point was centered
@@ -34,7 +40,7 @@ def deform_input(X, lookup, DefRec_dist='volume_based_voxels', device='cuda:0'):
             for i in region_ids:
                 ind = regions[b, :] == i
                 # if there are enough points in the region
-                if torch.sum(ind) >= min_pts:
+                if torch.sum(ind if valid is None else ind & valid[b]) >= min_pts:
                     region = lookup[i].cpu().numpy()  # current region average point
                     mask[b, :3, ind] = 1
                     num_points = int(torch.sum(ind).cpu().numpy())
@@ -42,9 +48,53 @@ def deform_input(X, lookup, DefRec_dist='volume_based_voxels', device='cuda:0'):
                         rnd_pts = pc_utils.draw_from_gaussian(region, num_points)
                         X[b, :3, ind] = torch.tensor(rnd_pts, dtype=torch.float).to(device)
                     break  # move to the next shape in the batch
+    if valid is not None:
+        mask *= valid.unsqueeze(1)
     return X, mask
 
 
+def deform_input_np(X, lookup, DefRec_dist='volume_based_voxels', mask=None, valid=None):
+    """
+    numpy deform_input, run by the loader workers on the collated batch
+    Input:
+        X - Point cloud [B, C, N], deformed in place
+        lookup - regions center point (numpy)
+        mask - array [B, C, N] to write the mask to (zeroed), default a new one
+        valid - valid points of the padded shapes [B, N] (see deform_input)
+    Return:
+        X - Point cloud with a deformed region
+        mask - 0/1 label per point indicating if the point was centered
+    """
+    regions = pc_utils.assign_region_to_point_np(X)
+
+    n = pc_utils.NREGIONS
+    min_pts = 40
+    region_ids = np.random.permutation(n ** 3)
+    if mask is None:
+        mask = np.zeros_like(X)
+    else:
+        mask[...] = 0
+
+    for b in range(X.shape[0]):
+        if DefRec_dist == 'volume_based_radius':
+            X[b], indices = pc_utils.collapse_to_point_np(X[b])
+            mask[b, :3, indices] = 1
+        else:
+            # the first region of the permutation with enough points
+            counts = np.bincount(regions[b] if valid is None else regions[b][valid[b]], minlength=n ** 3)[region_ids]
+            if not np.any(counts >= min_pts):
+                continue
+            i = region_ids[np.argmax(counts >= min_pts)]
+            ind = regions[b] == i
+            mask[b, :3, ind] = 1
+            if DefRec_dist == 'volume_based_voxels':
+                X[b, :3, ind] = pc_utils.draw_from_gaussian(lookup[i], int(np.sum(ind))).T
+    if valid is not None:
+        mask *= valid[:, None, :]
+    return X, mask
+
+
+@profiled('chamfer')
 def chamfer_distance(p1, p2, mask):
     """
     Calculate Chamfer Distance between two point sets
@@ -95,7 +145,10 @@ def reconstruction_loss(pred, gold, mask):
     Return: 
         mean batch loss
     """
-    gold = gold.clone()
+    # the chamfer distance is computed in fp32 also under autocast
+    gold = gold.float().clone()
+    pred = pred.float()
+    mask = mask.float()
 
     batch_size = pred.size(0)
 
@@ -104,8 +157,9 @@ def reconstruction_loss(pred, gold, mask):
     mask = mask.permute(0, 2, 1)
 
     # calc average chamfer distance for each direction
-    dist_gold = chamfer_distance(gold, pred, mask)
-    dist_pred = chamfer_distance(pred, gold, mask)
+    with fp32(pred.device.type):
+        dist_gold = chamfer_distance(gold, pred, mask)
+        dist_pred = chamfer_distance(pred, gold, mask)
     chamfer_loss = dist_gold + dist_pred
 
     # average loss
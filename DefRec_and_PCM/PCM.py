@@ -1,8 +1,10 @@
 import torch
 import numpy as np
 import utils.pc_utils as pc_utils
+from utils.profiler import profiled
 
 
+@profiled('pcm_mix')
 def mix_shapes(args, X, Y):
     """
     combine 2 shapes arbitrarily in each batch.
@@ -12,11 +14,8 @@ def mix_shapes(args, X, Y):
     Return:
         mixed shape, labels and proportion
     """
-    mixed_X = X.clone()
-    batch_size, _, num_points = mixed_X.size()
-
-    # uniform sampling of points from each shape
-    device = torch.device("cuda:" + str(X.get_device()) if args.cuda else "cpu")
+    # uniform sampling of points from each shape (X is not modified)
+    device = X.device
     batch_size, _, num_points = X.size()
     index = torch.randperm(batch_size).to(device)  # random permutation of examples in batch
 
@@ -37,6 +36,7 @@ def mix_shapes(args, X, Y):
 
     return mixed_X, (Y_a, Y_b, lam)
 
+@profiled('pcm_mix')
 def mix_shapes_segmentation(args, X, Y):
     """
     combine 2 shapes arbitrarily in each batch for segmentation task.
@@ -49,7 +49,7 @@ def mix_shapes_segmentation(args, X, Y):
     batch_size, _, num_points = X.size()
 
     # uniform sampling of points from each shape
-    device = torch.device("cuda:" + str(X.get_device()) if args.gpus[0] != -1 else "cpu")
+    device = X.device
     batch_size, _, num_points = X.size()
     index = torch.randperm(batch_size).to(device)  # random permutation of examples in batch
 
@@ -73,6 +73,60 @@ def mix_shapes_segmentation(args, X, Y):
     return mixed_X, mixed_Y
 
 
+def mix_points_np(X, orderings, mixup_params):
+    """
+    Draw the mixing of mix_shapes on a numpy batch with farthest point orderings of its shapes
+    (the first k points of an ordering are a farthest point sample of k points)
+    Input:
+        X - shapes [B, C, N]
+        orderings - farthest point ordering of the points of each shape [B, N]
+    Return:
+        mixed shapes, indices of the mixed shapes, indices of the points taken from the shapes of
+        the batch and from the mixed shapes, random permutation of the points of the mixed shapes
+    """
+    batch_size, _, num_points = X.shape
+    index = np.random.permutation(batch_size)  # random permutation of examples in batch
+
+    # draw lambda from beta distribution
+    lam = np.random.beta(mixup_params, mixup_params) if mixup_params > 0 else 1.0
+
+    num_pts_a = round(lam * num_points)
+    pts_indices_a = orderings[:, :num_pts_a]
+    pts_indices_b = orderings[index, :num_points - num_pts_a]
+    mixed_X = np.concatenate((np.take_along_axis(X, pts_indices_a[:, None, :], 2),
+                              np.take_along_axis(X[index], pts_indices_b[:, None, :], 2)), 2)
+    points_perm = np.random.permutation(num_points)  # draw random permutation of points in the shape
+    return mixed_X[:, :, points_perm], index, lam, (pts_indices_a, pts_indices_b), points_perm
+
+
+def mix_shapes_np(mixup_params, X, Y, orderings):
+    """
+    numpy mix_shapes, run by the loader workers on the collated batch
+    Input:
+        X, Y - shapes [B, C, N] and corresponding labels [B]
+        orderings - farthest point ordering of the points of each shape [B, N]
+    Return:
+        mixed shape, labels and proportion
+    """
+    mixed_X, index, lam, _, _ = mix_points_np(X, orderings, mixup_params)
+    return mixed_X, (Y, Y[index], lam)
+
+
+def mix_shapes_segmentation_np(mixup_params, X, Y, orderings):
+    """
+    numpy mix_shapes_segmentation, run by the loader workers on the collated batch
+    Input:
+        X, Y - shapes [B, C, N] and corresponding labels for each point [B, N]
+        orderings - farthest point ordering of the points of each shape [B, N]
+    Return:
+        mixed shape, labels for each point
+    """
+    mixed_X, index, _, (pts_indices_a, pts_indices_b), points_perm = mix_points_np(X, orderings, mixup_params)
+    mixed_Y = np.concatenate((np.take_along_axis(Y, pts_indices_a, 1),
+                              np.take_along_axis(Y[index], pts_indices_b, 1)), 1)
+    return mixed_X, mixed_Y[:, points_perm]
+
+
 def calc_loss(args, logits, mixup_vals, criterion):
     """
     Calculate loss between 2 shapes
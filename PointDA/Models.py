@@ -1,27 +1,43 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from utils.activation_checkpoint import checkpoint_block
+from utils.amp_utils import fp32
+from utils.profiler import profiled
+from utils.pc_utils import masked_max, masked_mean
 
 K = 7
 
-def knn(x, k):
-    inner = -2*torch.matmul(x.transpose(2, 1), x)
-    xx = torch.sum(x**2, dim=1, keepdim=True)
-    pairwise_distance = -xx - inner - xx.transpose(2, 1)
+@profiled('knn')
+def knn(x, k, valid=None):
+    # distances are computed in fp32 also under autocast, the neighbours are sensitive to rounding
+    with fp32(x.device.type):
+        x = x.float()
+        inner = -2*torch.matmul(x.transpose(2, 1), x)
+        xx = torch.sum(x**2, dim=1, keepdim=True)
+        pairwise_distance = -xx - inner - xx.transpose(2, 1)
+        if valid is not None:
+            # the padding of the shapes is nobody's neighbour
+            pairwise_distance = pairwise_distance.masked_fill(~valid.unsqueeze(1), float('-inf'))
 
     # (batch_size, num_points, k)
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]
+    distance, idx = pairwise_distance.topk(k=k, dim=-1)
+    if valid is not None:
+        # shapes with fewer valid points than k: the missing neighbours repeat the nearest one, which
+        # leaves the max over the neighbours unchanged
+        idx = torch.where(torch.isinf(distance), idx[:, :, :1], idx)
     return idx
 
 
-def get_graph_feature(x, args, k=20, idx=None):
+@profiled('graph_feature')
+def get_graph_feature(x, k=20, idx=None, valid=None):
     batch_size = x.size(0)
     num_points = x.size(2)
     x = x.view(batch_size, -1, num_points)
     if idx is None:
-        idx = knn(x, k=k)   # (batch_size, num_points, k)
-    # Run on cpu or gpu
-    device = torch.device("cuda:" + str(x.get_device()) if args.cuda else "cpu")
+        idx = knn(x, k=k, valid=valid)   # (batch_size, num_points, k)
+    # Run on the device of the input
+    device = x.device
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
 
@@ -41,6 +57,35 @@ def get_graph_feature(x, args, k=20, idx=None):
     return feature
 
 
+def edge_conv(x, layers, k=20, recompute=False, valid=None):
+    """
+    EdgeConv block: graph features of the k nearest neighbours, layers and max over the neighbours.
+    With recompute the [B, C, N, k] activations are recomputed in backward instead of kept.
+    The neighbours are valid points of the padded shapes (valid [B, N], None - all the points).
+    """
+    def block(x):
+        x = get_graph_feature(x, k=k, valid=valid)
+        for layer in layers:
+            x = layer(x)
+        return x.max(dim=-1, keepdim=False)[0]
+
+    if recompute and torch.is_grad_enabled():
+        return checkpoint_block(block, x, layers)
+    return block(x)
+
+
+def input_transform(x, transform_net, k=20, recompute=False, valid=None):
+    """
+    Transformation matrix predicted from the graph features of x (recomputed in backward as edge_conv)
+    """
+    def block(x):
+        return transform_net(get_graph_feature(x, k=k, valid=valid), valid)
+
+    if recompute and torch.is_grad_enabled():
+        return checkpoint_block(block, x, [transform_net])
+    return block(x)
+
+
 class conv_2d(nn.Module):
     def __init__(self, in_ch, out_ch, kernel, activation='relu', bias=True):
         super(conv_2d, self).__init__()
@@ -95,6 +140,8 @@ class transform_net(nn.Module):
         super(transform_net, self).__init__()
         self.K = out
         self.args = args
+        # options are resolved here, the forward pass does not read args
+        self.max_over_neighbours = args.model == 'dgcnn'
 
         activation = 'leakyrelu' if args.model == 'dgcnn' else 'relu'
         bias = False if args.model == 'dgcnn' else True
@@ -106,23 +153,22 @@ class transform_net(nn.Module):
         self.fc2 = fc_layer(512, 256, activation=activation, bn=True)
         self.fc3 = nn.Linear(256, out * out)
 
-    def forward(self, x):
-        device = torch.device("cuda:" + str(x.get_device()) if self.args.cuda else "cpu")
+    def forward(self, x, valid=None):
+        device = x.device
 
         x = self.conv2d1(x)
         x = self.conv2d2(x)
-        if self.args.model == "dgcnn":
+        if self.max_over_neighbours:
             x = x.max(dim=-1, keepdim=False)[0]
             x = torch.unsqueeze(x, dim=3)
         x = self.conv2d3(x)
-        x, _ = torch.max(x, dim=2, keepdim=False)
+        x = masked_max(x, valid)
         x = x.view(x.size(0), -1)
         x = self.fc1(x)
         x = self.fc2(x)
         x = self.fc3(x)
 
-        iden = torch.eye(self.K).view(1, self.K * self.K).repeat(x.size(0), 1)
-        iden = iden.to(device)
+        iden = torch.eye(self.K, device=device).view(1, self.K * self.K).repeat(x.size(0), 1)
         x = x + iden
         x = x.view(x.size(0), self.K, self.K)
         return x
@@ -132,6 +178,7 @@ class PointNet(nn.Module):
     def __init__(self, args, num_class=10):
         super(PointNet, self).__init__()
         self.args = args
+        self.DeepJDOT_head = args.DeepJDOT_head
 
         self.trans_net1 = transform_net(args, 3, 3)
         self.trans_net2 = transform_net(args, 64, 64)
@@ -144,15 +191,22 @@ class PointNet(nn.Module):
         num_f_prev = 64 + 64 + 64 + 128
 
         self.C = classifier(args, num_class)
+        if self.DeepJDOT_head:
+            self.DeepJDOT = classifier(args, num_class)
         self.DefRec = RegionReconstruction(args, num_f_prev + 1024)
 
-    def forward(self, x, activate_DefRec=False, return_intermediate=False):
+    def forward(self, x, activate_DefRec=False, return_intermediate=False, valid=None):
+        """
+        Input:
+            x - point clouds [B, 3, N]
+            valid - valid points of the padded shapes [B, N], None if all the points are valid
+        """
         num_points = x.size(2)
         x = torch.unsqueeze(x, dim=3)
 
         logits = {}
 
-        transform = self.trans_net1(x)
+        transform = self.trans_net1(x, valid)
         x = x.transpose(2, 1)
         x = x.squeeze(dim=3)
         x = torch.bmm(x, transform)
@@ -160,7 +214,7 @@ class PointNet(nn.Module):
         x = x.transpose(2, 1)
         x1 = self.conv1(x)
         x2 = self.conv2(x1)
-        transform = self.trans_net2(x2)
+        transform = self.trans_net2(x2, valid)
         x = x2.transpose(2, 1)
         x = x.squeeze(dim=3)
         x = torch.bmm(x, transform)
@@ -171,20 +225,20 @@ class PointNet(nn.Module):
         x_cat = torch.cat((x1, x2, x3, x4), dim=1)
 
         x = self.conv5(x4)
-        x5, _ = torch.max(x, dim=2, keepdim=False)
+        x5 = masked_max(x, valid)
         x = x5.squeeze(dim=2)  # batchsize*1024
 
 
-        logits["cls"], embeddings = self.C(x)
+        logits["cls"] = self.C(x)
         if activate_DefRec:
             DefRec_input = torch.cat((x_cat.squeeze(dim=3), x5.repeat(1, 1, num_points)), dim=1)
             logits["DefRec"] = self.DefRec(DefRec_input)
 
-        if self.args.DeepJDOT_head:
-            logits["DeepJDOT"], embeddings = self.DeepJDOT(x)
+        if self.DeepJDOT_head:
+            logits["DeepJDOT"] = self.DeepJDOT(x)
 
         if return_intermediate:
-            return logits, torch.nn.functional.softmax(embeddings,-1)
+            return logits, x
         return logits
 
 
@@ -193,7 +247,10 @@ class DGCNN(nn.Module):
         super(DGCNN, self).__init__()
         self.args = args
         self.k = K
-        self.deepJDOT_head=False
+        # options are resolved here, the forward pass does not read args
+        self.use_sigmoid = args.use_sigmoid
+        self.DeepJDOT_head = args.DeepJDOT_head
+        self.checkpoint_edgeconv = getattr(args, 'checkpoint_edgeconv', False)
 
         self.input_transform_net = transform_net(args, 6, 3)
 
@@ -210,34 +267,27 @@ class DGCNN(nn.Module):
         self.DeepJDOT = classifier(args, num_class)
         self.DefRec = RegionReconstruction(args, num_f_prev + 1024)
 
-    def forward(self, x, activate_DefRec=False, return_intermediate=False):
-        batch_size = x.size(0)
+    def forward(self, x, activate_DefRec=False, return_intermediate=False, valid=None):
+        """
+        Input:
+            x - point clouds [B, 3, N]
+            valid - valid points of the padded shapes [B, N], None if all the points are valid
+        """
         num_points = x.size(2)
         logits = {}
 
-        x0 = get_graph_feature(x, self.args, k=self.k)
-        transformd_x0 = self.input_transform_net(x0)
+        transformd_x0 = input_transform(x, self.input_transform_net, k=self.k, recompute=self.checkpoint_edgeconv,
+                                        valid=valid)
         x = torch.matmul(transformd_x0, x)
 
-        x = get_graph_feature(x, self.args, k=self.k)
-        x = self.conv1(x)
-        x1 = x.max(dim=-1, keepdim=False)[0]
-
-        x = get_graph_feature(x1, self.args, k=self.k)
-        x = self.conv2(x)
-        x2 = x.max(dim=-1, keepdim=False)[0]
-
-        x = get_graph_feature(x2, self.args, k=self.k)
-        x = self.conv3(x)
-        x3 = x.max(dim=-1, keepdim=False)[0]
-
-        x = get_graph_feature(x3, self.args, k=self.k)
-        x = self.conv4(x)
-        x4 = x.max(dim=-1, keepdim=False)[0]
+        x1 = edge_conv(x, [self.conv1], k=self.k, recompute=self.checkpoint_edgeconv, valid=valid)
+        x2 = edge_conv(x1, [self.conv2], k=self.k, recompute=self.checkpoint_edgeconv, valid=valid)
+        x3 = edge_conv(x2, [self.conv3], k=self.k, recompute=self.checkpoint_edgeconv, valid=valid)
+        x4 = edge_conv(x3, [self.conv4], k=self.k, recompute=self.checkpoint_edgeconv, valid=valid)
 
         x_cat = torch.cat((x1, x2, x3, x4), dim=1)
         
-        if self.args.use_sigmoid:
+        if self.use_sigmoid:
             x5 = torch.sigmoid(self.bn5(self.conv5(x_cat))) # Change for DeepJDOT 
         else:
             x5 = F.leaky_relu(self.bn5(self.conv5(x_cat)), negative_slope=0.2)
@@ -245,12 +295,12 @@ class DGCNN(nn.Module):
 
         # Per feature take the point that have the highest (absolute) value.
         # Generate a feature vector for the whole shape
-        x5 = F.adaptive_avg_pool1d(x5, 1).view(batch_size, -1)
+        x5 = masked_mean(x5, valid)
         x = x5
 
         logits["cls"] = self.C(x)
-        if self.args.DeepJDOT_head:
-            logits["DeepJDOT"], embeddings = self.DeepJDOT(x)
+        if self.DeepJDOT_head:
+            logits["DeepJDOT"] = self.DeepJDOT(x)
 
         if activate_DefRec:
             DefRec_input = torch.cat((x_cat, x5.unsqueeze(2).repeat(1, 1, num_points)), dim=1)
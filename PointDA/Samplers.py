@@ -9,9 +9,49 @@ from torch.utils.data.sampler import BatchSampler
 
 import tqdm.auto as tqdm
 
+
+class ResumableSubsetRandomSampler(SubsetRandomSampler):
+    """
+    SubsetRandomSampler with a permutation that depends only on (seed, epoch), so that an
+    interrupted epoch can be continued from any position without replaying the earlier samples.
+    With num_replicas > 1 each rank gets an equally sized shard of the permutation.
+    """
+    def __init__(self, indices, seed=0, num_replicas=1, rank=0):
+        super(ResumableSubsetRandomSampler, self).__init__(indices)
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = (len(self.indices) + num_replicas - 1) // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        """
+        Skip the first start samples of the next iteration
+        """
+        self.start = start
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        perm = torch.randperm(len(self.indices), generator=g).tolist()
+        # pad so that all ranks get the same number of samples
+        perm += perm[:self.num_samples * self.num_replicas - len(perm)]
+        perm = perm[self.rank::self.num_replicas]
+        start, self.start = self.start, 0
+        for i in perm[start:]:
+            yield self.indices[i]
+
+    def __len__(self):
+        return self.num_samples
+
+
 class BalancedSubsetBatchSampler(BatchSampler):
 
-    def __init__(self, dataset, n_classes, n_samples, indices):
+    def __init__(self, dataset, n_classes, n_samples, indices, seed=0, num_replicas=1, rank=0):
         self.indices = np.asarray(indices)
         loader = DataLoader(Subset(dataset, indices)) # Getting the subset deterministically.
         
@@ -24,34 +64,127 @@ class BalancedSubsetBatchSampler(BatchSampler):
         self.label_to_indices = {label: self.indices[np.where(self.labels.numpy() == label)[0]]
                                  for label in self.labels_set}
         
-        for l in self.labels_set:
-            np.random.shuffle(self.label_to_indices[l])
-        
-        self.used_label_indices_count = {label: 0 for label in self.labels_set}
         self.count = 0
         self.n_classes = n_classes
         self.n_samples = n_samples
         self.dataset = dataset
         self.batch_size = self.n_samples * self.n_classes
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        """
+        Skip the first start batches of the next iteration (only the indices are drawn)
+        """
+        self.start = start
 
     def __iter__(self):
+        # the batches of an epoch depend only on (seed, epoch)
+        rng = np.random.RandomState(self.seed + self.epoch)
+        label_to_indices = {l: self.label_to_indices[l].copy() for l in self.labels_set}
+        for l in self.labels_set:
+            rng.shuffle(label_to_indices[l])
+        used_label_indices_count = {label: 0 for label in self.labels_set}
+
+        start, self.start = self.start, 0
+        batch_idx = 0
         self.count = 0
+        # every rank takes every num_replicas-th batch, the remainder is dropped so all ranks are even
+        num_batches = max(len(self.dataset) - 1, 0) // self.batch_size
+        num_batches -= num_batches % self.num_replicas
         while self.count + self.batch_size < len(self.dataset):
-            classes = np.random.choice(self.labels_set, self.n_classes, replace=False)
+            classes = rng.choice(self.labels_set, self.n_classes, replace=False)
             indices = []
             for class_ in classes:
-                indices.extend(self.label_to_indices[class_][
-                               self.used_label_indices_count[class_]:self.used_label_indices_count[
-                                                                         class_] + self.n_samples])
-                self.used_label_indices_count[class_] += self.n_samples
-                if self.used_label_indices_count[class_] + self.n_samples > len(self.label_to_indices[class_]):
-                    np.random.shuffle(self.label_to_indices[class_])
-                    self.used_label_indices_count[class_] = 0
+                indices.extend(label_to_indices[class_][
+                               used_label_indices_count[class_]:used_label_indices_count[
+                                                                    class_] + self.n_samples])
+                used_label_indices_count[class_] += self.n_samples
+                if used_label_indices_count[class_] + self.n_samples > len(label_to_indices[class_]):
+                    rng.shuffle(label_to_indices[class_])
+                    used_label_indices_count[class_] = 0
             
-            yield indices
+            if batch_idx < num_batches and batch_idx % self.num_replicas == self.rank \
+                    and batch_idx // self.num_replicas >= start:
+                yield indices
+            batch_idx += 1
             
             self.count += self.n_classes * self.n_samples
 
     def __len__(self):
         # return len(self.dataset) // self.batch_size
         return len(self.indices)
+
+
+class BucketBatchSampler(BatchSampler):
+    """
+    Random batches of samples of similar point counts, so that little of a batch of shapes of varying
+    density is padding (PointCollate pads to the largest shape of the batch). Every epoch the shuffled
+    indices are split into buckets of bucket_batches batches, each bucket is sorted by point count and
+    cut into batches, and the batches of all the buckets are shuffled: the batches stay random while
+    the shapes of a batch are neighbours in point count. The batches of an epoch depend only on
+    (seed, epoch), every rank takes every num_replicas-th batch.
+    """
+    def __init__(self, indices, point_counts, batch_size, bucket_batches=50, drop_last=True, seed=0,
+                 num_replicas=1, rank=0):
+        """
+        Input:
+            indices - dataset indices of the sampled subset
+            point_counts - number of points of every sample of the dataset (dataset.point_counts())
+            bucket_batches - batches per bucket (1 - batches of random samples, no bucketing)
+        """
+        self.indices = np.asarray(indices)
+        self.point_counts = np.asarray(point_counts)[self.indices]
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        """
+        Skip the first start batches of the next iteration
+        """
+        self.start = start
+
+    def num_batches(self):
+        # batches of all the ranks, the remainder is dropped so all ranks are even
+        if self.drop_last:
+            num_batches = sum(min(self.bucket_size, len(self.indices) - i) // self.batch_size
+                              for i in range(0, len(self.indices), self.bucket_size))
+        else:
+            num_batches = sum(-(-min(self.bucket_size, len(self.indices) - i) // self.batch_size)
+                              for i in range(0, len(self.indices), self.bucket_size))
+        return num_batches - num_batches % self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        perm = rng.permutation(len(self.indices))
+        batches = []
+        for i in range(0, len(perm), self.bucket_size):
+            bucket = perm[i:i + self.bucket_size]
+            bucket = bucket[np.argsort(self.point_counts[bucket], kind='stable')]
+            for j in range(0, len(bucket), self.batch_size):
+                batch = bucket[j:j + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(self.indices[batch].tolist())
+        rng.shuffle(batches)
+        batches = batches[:self.num_batches()][self.rank::self.num_replicas]
+        start, self.start = self.start, 0
+        for batch in batches[start:]:
+            yield batch
+
+    def __len__(self):
+        return self.num_batches() // self.num_replicas
@@ -42,8 +42,12 @@ class ScanNet(Dataset):
     """
     scannet dataset for pytorch dataloader
     """
-    def __init__(self, io, dataroot, partition='train'):
+    def __init__(self, io, dataroot, partition='train', num_points=NUM_POINTS):
         self.partition = partition
+        # shapes with more points are subsampled by farthest point sampling (in farthest point order),
+        # 0 - the shapes are kept at their native density
+        self.num_points = num_points
+        self.fps_ordered = num_points > 0
 
         # read data
         self.data, self.label = load_data_h5py_scannet10(self.partition, dataroot)
@@ -67,9 +71,9 @@ class ScanNet(Dataset):
         # Rotate ScanNet by -90 degrees
         pointcloud = self.rotate_pc(pointcloud)
         # sample according to farthest point sampling
-        if pointcloud.shape[0] > NUM_POINTS:
+        if self.num_points and pointcloud.shape[0] > self.num_points:
             pointcloud = np.swapaxes(np.expand_dims(pointcloud, 0), 1, 2)
-            _, pointcloud = farthest_point_sample_np(pointcloud, NUM_POINTS)
+            _, pointcloud = farthest_point_sample_np(pointcloud, self.num_points)
             pointcloud = np.swapaxes(pointcloud.squeeze(), 1, 0).astype('float32')
 
         # apply data rotation and augmentation on train samples
@@ -81,6 +85,13 @@ class ScanNet(Dataset):
     def __len__(self):
         return self.data.shape[0]
 
+    def point_counts(self):
+        """
+        Return: number of points of every shape as loaded
+        """
+        counts = np.full(self.num_examples, self.data.shape[1])
+        return np.minimum(counts, self.num_points) if self.num_points else counts
+
     # scannet is rotated such that the up direction is the y axis
     def rotate_pc(self, pointcloud):
         pointcloud = rotate_shape(pointcloud, 'x', -np.pi / 2)
@@ -91,8 +102,12 @@ class ModelNet(Dataset):
     """
     modelnet dataset for pytorch dataloader
     """
-    def __init__(self, io, dataroot, partition='train'):
+    def __init__(self, io, dataroot, partition='train', num_points=NUM_POINTS):
         self.partition = partition
+        # shapes with more points are subsampled by farthest point sampling (in farthest point order),
+        # 0 - the shapes are kept at their native density
+        self.num_points = num_points
+        self.fps_ordered = num_points > 0
         self.pc_list = []
         self.lbl_list = []
         DATA_DIR = os.path.join(dataroot, "PointDA_data", "modelnet")
@@ -122,9 +137,9 @@ class ModelNet(Dataset):
         label = np.copy(self.label[item])
         pointcloud = scale_to_unit_cube(pointcloud)
         # sample according to farthest point sampling
-        if pointcloud.shape[0] > NUM_POINTS:
+        if self.num_points and pointcloud.shape[0] > self.num_points:
             pointcloud = np.swapaxes(np.expand_dims(pointcloud, 0), 1, 2)
-            _, pointcloud = farthest_point_sample_np(pointcloud, NUM_POINTS)
+            _, pointcloud = farthest_point_sample_np(pointcloud, self.num_points)
             pointcloud = np.swapaxes(pointcloud.squeeze(), 1, 0).astype('float32')
 
         # apply data rotation and augmentation on train samples
@@ -135,13 +150,24 @@ class ModelNet(Dataset):
     def __len__(self):
         return len(self.pc_list)
 
+    def point_counts(self):
+        """
+        Return: number of points of every shape as loaded
+        """
+        counts = np.array([np.load(f, mmap_mode='r').shape[0] for f in self.pc_list])
+        return np.minimum(counts, self.num_points) if self.num_points else counts
+
 
 class ShapeNet(Dataset):
     """
     Sahpenet dataset for pytorch dataloader
     """
-    def __init__(self, io, dataroot, partition='train'):
+    def __init__(self, io, dataroot, partition='train', num_points=NUM_POINTS):
         self.partition = partition
+        # shapes with more points are subsampled by farthest point sampling (in farthest point order),
+        # 0 - the shapes are kept at their native density
+        self.num_points = num_points
+        self.fps_ordered = num_points > 0
         self.pc_list = []
         self.lbl_list = []
         DATA_DIR = os.path.join(dataroot, "PointDA_data", "shapenet")
@@ -173,9 +199,9 @@ class ShapeNet(Dataset):
         # Rotate ShapeNet by -90 degrees
         pointcloud = self.rotate_pc(pointcloud, label)
         # sample according to farthest point sampling
-        if pointcloud.shape[0] > NUM_POINTS:
+        if self.num_points and pointcloud.shape[0] > self.num_points:
             pointcloud = np.swapaxes(np.expand_dims(pointcloud, 0), 1, 2)
-            _, pointcloud = farthest_point_sample_np(pointcloud, NUM_POINTS)
+            _, pointcloud = farthest_point_sample_np(pointcloud, self.num_points)
             pointcloud = np.swapaxes(pointcloud.squeeze(), 1, 0).astype('float32')
 
         # apply data rotation and augmentation on train samples
@@ -186,6 +212,13 @@ class ShapeNet(Dataset):
     def __len__(self):
         return len(self.pc_list)
 
+    def point_counts(self):
+        """
+        Return: number of points of every shape as loaded
+        """
+        counts = np.array([np.load(f, mmap_mode='r').shape[0] for f in self.pc_list])
+        return np.minimum(counts, self.num_points) if self.num_points else counts
+
     # shpenet is rotated such that the up direction is the y axis in all shapes except plant
     def rotate_pc(self, pointcloud, label):
         if label.item(0) != label_to_idx["plant"]:
@@ -4,23 +4,33 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import CosineAnnealingLR
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
 from torch.utils.data import DataLoader
-import sklearn.metrics as metrics
 import argparse
+import time
 import ot
-import copy
 import utils.log
-import wandb
-from PointDA.data.dataloader import ScanNet, ModelNet, ShapeNet, label_to_idx
+from PointDA.data.dataloader import ScanNet, ModelNet, ShapeNet, label_to_idx, NUM_POINTS
 from PointDA.Models import PointNet, DGCNN
 from utils import pc_utils
+from utils.metrics import ClassificationEvaluator, LossTracker
+from utils.checkpoint import CheckpointManager, unwrap_model
+from utils.dist_utils import init_distributed, is_main_process, cleanup
+from utils.amp_utils import autocast, grad_scaler
+from utils.train_utils import micro_batch_slices, no_sync, preserve_bn_stats
+from utils.batch_probe import auto_batch_size
+from utils.compile_utils import compile_model, check_compiled
+from utils.profiler import StageProfiler, set_profiler
+from utils.memory_tracker import MemoryTracker
+from utils.loader_tuning import DEFAULT_TUNING_FILE, dataset_key, trainer_loader_config, loader_kwargs
+from utils.worker_pool import WorkerPool, PooledLoader, EVAL
+from utils.point_batch import AugmentCollate, FPSOrderings
+from utils.distillation import Teacher, IndexedDataset, distillation_loss, embedding_loss
 from DefRec_and_PCM import DefRec, PCM
 
-from PointDA.Samplers import BalancedSubsetBatchSampler
+from PointDA.Samplers import BalancedSubsetBatchSampler, BucketBatchSampler, ResumableSubsetRandomSampler
 
 import tqdm.auto as tqdm
-import wandb
 
 
 NWORKERS=20
@@ -83,13 +93,58 @@ parser.add_argument('--jdot_tloss', type=float, default=0.0001, help='JDOT Weigh
 parser.add_argument('--jdot_train_cl', type=float, default=1.0, help='JDOT Train CL')
 parser.add_argument('--jdot_train_algn', type=float, default=1.0, help='JDOT Train CL')
 parser.add_argument('--use_sigmoid', type=str2bool, default=True, help='Use SIGMOID for the embedding layer of DeepJDOT')
+parser.add_argument('--num_points', type=int, default=NUM_POINTS,
+                    help='points per shape, larger shapes are subsampled (0 - the native point counts, padded and masked in the batches)')
 parser.add_argument('--balance_dataset', type=str2bool, default=False, help='Balance Dataset to have equal number from each class')
+parser.add_argument('--amp', type=str2bool, default=False, help='mixed precision (autocast) training and evaluation')
+parser.add_argument('--amp_dtype', type=str, default='fp16', choices=['fp16', 'bf16'],
+                    help='autocast dtype on accelerators (bf16 is always used on cpu)')
+parser.add_argument('--auto_batch_size', type=str2bool, default=False,
+                    help='set the train (micro-)batch size and the test batch size to the largest that fit in memory')
+parser.add_argument('--memory_fraction', type=float, default=0.9, help='memory budget of --auto_batch_size')
+parser.add_argument('--accum_steps', type=int, default=1,
+                    help='micro-batches per source/target batch, gradients are accumulated over them '
+                         '(batch norm normalizes each micro-batch with its own statistics)')
+parser.add_argument('--compile', type=str2bool, default=False, help='torch.compile the model')
+parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'])
+parser.add_argument('--checkpoint_edgeconv', type=str2bool, default=False,
+                    help='recompute the EdgeConv blocks in backward instead of keeping their activations')
+parser.add_argument('--teacher', type=str, default='',
+                    help='checkpoint of a trained classifier (e.g. DGCNN DefRec/PCM) to distill into the model')
+parser.add_argument('--teacher_config', type=str, default=None, help='args.json of the teacher (default: of its run)')
+parser.add_argument('--kd_weight', type=float, default=1.0, help='weight of the soft logits distillation loss')
+parser.add_argument('--kd_temperature', type=float, default=4.0, help='softmax temperature of the distillation')
+parser.add_argument('--kd_embed_weight', type=float, default=0.1, help='weight of the embedding matching loss')
+parser.add_argument('--kd_cache', type=str2bool, default=False,
+                    help='cache the teacher outputs per train sample on disk, the teacher runs once per sample')
+parser.add_argument('--profile', type=str2bool, default=False,
+                    help='time the stages of the training step (run log summary per epoch and a Chrome trace)')
+parser.add_argument('--profile_memory', type=str2bool, default=False,
+                    help='track the peak memory of the stages and model submodules (implies --profile)')
+parser.add_argument('--resume', type=str2bool, default=False, help='resume from the latest checkpoint of the experiment')
+parser.add_argument('--ckpt_interval', type=int, default=0, help='steps between mid-epoch checkpoints (0 - only at epoch end)')
+parser.add_argument('--keep_checkpoints', type=int, default=3, help='number of recent checkpoints to keep')
+parser.add_argument('--log_interval', type=int, default=5, help='steps between logging of the train losses')
+parser.add_argument('--max_steps', type=int, default=0,
+                    help='train steps per epoch (0 - the full epoch), for short benchmark runs')
+parser.add_argument('--tune_loader', type=str2bool, default=False,
+                    help='benchmark the data loader configurations of the datasets on this host and keep the best')
+parser.add_argument('--tuned_loader', type=str2bool, default=True,
+                    help='use the loader configurations tuned for this host and the datasets (if any)')
+parser.add_argument('--loader_tuning_file', type=str, default=DEFAULT_TUNING_FILE,
+                    help='tuned loader configurations per host and dataset')
+parser.add_argument('--worker_pool', type=str2bool, default=False,
+                    help='load the batches of all the loaders with one persistent worker pool (training batches first)')
+parser.add_argument('--worker_augment', type=str2bool, default=False,
+                    help='draw the DefRec deformations and the PCM mixes of the train batches in the loader workers')
+parser.add_argument('--metrics_backends', type=str, default='wandb',
+                    help='comma delimited metrics backends out of wandb, jsonl, stdout')
+parser.add_argument('--metrics_queue_size', type=int, default=1024, help='max pending metric records')
+parser.add_argument('--metrics_policy', type=str, default='block', choices=['block', 'drop'],
+                    help='what to do with a metric record when the queue is full')
 args = parser.parse_args()
 
 
-# 1. Start a new run
-wandb.init(project='pcc-ablations', entity='pcc-team')   
-
 # config = {
 #     'lr': args.lr,
 #     'optimizer': args.optimizer,
@@ -104,7 +159,7 @@ wandb.init(project='pcc-ablations', entity='pcc-team')
 # config = wandb.config
 
 
-def classifier_cat_loss(source_ypred, ypred_t, ys, gamma):
+def classifier_cat_loss(source_ypred, ypred_t, ys, gamma, ys_s=None, s_weight=1.0):
     '''
     classifier loss based on categorical cross entropy in the target domain
     y_true:  
@@ -113,9 +168,11 @@ def classifier_cat_loss(source_ypred, ypred_t, ys, gamma):
     0:batch_size - is source samples
     batch_size:end - is target samples
     gamma - is the optimal transport plan
+    ys_s - labels of source_ypred when it holds a micro-batch of the source samples (default ys)
+    s_weight - weight of the source loss (share of the micro-batch in the source batch)
     '''   
     # pytorch has the mean-inbuilt, 
-    source_loss = torch.nn.functional.cross_entropy(source_ypred,ys)
+    source_loss = torch.nn.functional.cross_entropy(source_ypred, ys if ys_s is None else ys_s) * s_weight
 
     ys_cat = torch.nn.functional.one_hot(ys, num_classes=10).type(ypred_t.dtype) 
     
@@ -182,14 +239,23 @@ def align_loss(g_source, g_target, gamma):
 # ==================
 # init
 # ==================
+args.cuda = (args.gpus[0] >= 0) and torch.cuda.is_available()
+# distributed when launched with torchrun
+device = init_distributed(args)
 io = utils.log.IOStream(args)
 io.cprint(str(args))
+io.save_args()
+memory_tracker = MemoryTracker(device, path=io.path + '/memory_rank%d.jsonl' % args.rank) if args.profile_memory else None
+profiler = set_profiler(StageProfiler(enabled=args.profile or args.profile_memory, device=device, pid=args.rank,
+                                      trace_path=io.path + '/trace_rank%d.json' % args.rank, memory=memory_tracker))
+# 1. Start a new run
+sink = utils.log.build_metrics_sink(args, io.path, wandb_kwargs={'project': 'pcc-ablations', 'entity': 'pcc-team'})
 
 random.seed(1)
 np.random.seed(1)  # to get the same point choice in ModelNet and ScanNet leave it fixed
 torch.manual_seed(args.seed)
-args.cuda = (args.gpus[0] >= 0) and torch.cuda.is_available()
-device = torch.device("cuda:" + str(args.gpus[0]) if args.cuda else "cpu")
+if args.distributed:
+    io.cprint('Distributed run with %d processes' % args.world_size)
 if args.cuda:
     io.cprint('Using GPUs ' + str(args.gpus) + ',' + ' from ' +
               str(torch.cuda.device_count()) + ' devices available')
@@ -200,6 +266,10 @@ if args.cuda:
 else:
     io.cprint('Using CPU')
 
+if args.auto_batch_size:
+    auto_batch_size(PointNet(args) if args.model == 'pointnet' else DGCNN(args), args, 'cls', device,
+                    args.num_points or NUM_POINTS, io)
+
 
 # ==================
 # Read Data
@@ -223,41 +293,102 @@ def split_set(dataset, domain, set_type="source"):
               " validation part: " + str(dict(zip(unique, counts))))
     # Creating PT data samplers and loaders:
     # train_sampler = SubsetRandomSampler(train_indices)
+    # the source and target batches are drawn with different seeds, so their pairing changes every epoch
+    seed = args.seed if set_type == 'source' else args.seed + 1
     if args.balance_dataset and set_type == 'source':
         print("Using balanced batches")
-        train_sampler = BalancedSubsetBatchSampler(dataset=dataset, n_classes=10, n_samples=args.batch_size // 10, indices=train_indices)
+        train_sampler = BalancedSubsetBatchSampler(dataset=dataset, n_classes=10, n_samples=args.batch_size // 10,
+                                                   indices=train_indices, seed=seed,
+                                                   num_replicas=args.world_size, rank=args.rank)
+    elif len(np.unique(dataset.point_counts()[train_indices])) > 1:
+        # shapes of varying point counts: batches of similar counts, little padding
+        train_sampler = BucketBatchSampler(train_indices, dataset.point_counts(), args.batch_size, seed=seed,
+                                           num_replicas=args.world_size, rank=args.rank)
     else:
-        train_sampler = SubsetRandomSampler(train_indices)
-    valid_sampler = SubsetRandomSampler(val_indices)
+        train_sampler = ResumableSubsetRandomSampler(train_indices, seed=seed,
+                                                     num_replicas=args.world_size, rank=args.rank)
+    valid_sampler = eval_sampler(val_indices)
     return train_sampler, valid_sampler
 
+
+def sampler_kwargs(sampler):
+    # keyword arguments of the train loaders (DataLoader or PooledLoader) of a train sampler
+    if isinstance(sampler, BatchSampler):
+        return {'batch_sampler': sampler}
+    return {'sampler': sampler, 'batch_size': args.batch_size, 'drop_last': True}
+
+
+def eval_sampler(indices):
+    # each process evaluates its own part, the evaluator sums the statistics over all processes
+    return SubsetRandomSampler(list(indices)[args.rank::args.world_size])
+
+
 src_dataset = args.src_dataset
 trgt_dataset = args.trgt_dataset
 data_func = {'modelnet': ModelNet, 'scannet': ScanNet, 'shapenet': ShapeNet}
 
-src_trainset = data_func[src_dataset](io, args.dataroot, 'train')
-trgt_trainset = data_func[trgt_dataset](io, args.dataroot, 'train')
-trgt_testset = data_func[trgt_dataset](io, args.dataroot, 'test')
+src_trainset = data_func[src_dataset](io, args.dataroot, 'train', num_points=args.num_points)
+trgt_trainset = data_func[trgt_dataset](io, args.dataroot, 'train', num_points=args.num_points)
+trgt_testset = data_func[trgt_dataset](io, args.dataroot, 'test', num_points=args.num_points)
 
 # Creating data indices for training and validation splits:
 src_train_sampler, src_valid_sampler = split_set(src_trainset, src_dataset, "source")
 trgt_train_sampler, trgt_valid_sampler = split_set(trgt_trainset, trgt_dataset, "target")
 
+# distillation: the train items also hold their index, to look up the cached teacher outputs
+# (and the PCM orderings the loader workers cache for the shapes not in farthest point order)
+src_train_data = IndexedDataset(src_trainset) if args.teacher or (
+    args.worker_augment and not src_trainset.fps_ordered) else src_trainset
+trgt_train_data = IndexedDataset(trgt_trainset) if args.teacher else trgt_trainset
+
+# loader configurations (workers, prefetching, pinning) tuned per host and dataset
+src_loader_config = trainer_loader_config(args, dataset_key('PointDA', args.dataroot, src_dataset), src_train_data,
+                                          args.batch_size, NWORKERS, device, io)
+trgt_loader_config = trainer_loader_config(args, dataset_key('PointDA', args.dataroot, trgt_dataset),
+                                           trgt_train_data, args.batch_size, NWORKERS, device, io)
+
+# the DefRec deformations and the PCM mixes of the train batches are drawn by the loader workers
+src_collate = trgt_collate = None
+if args.worker_augment:
+    region_means = pc_utils.region_mean(args.num_regions)
+    src_collate = AugmentCollate(src_loader_config['pin_memory'],
+                                 defrec=(region_means, args.DefRec_dist) if args.DefRec_on_src else None,
+                                 pcm=args.mixup_params if args.supervised and args.apply_PCM else None,
+                                 orderings=FPSOrderings(src_trainset.fps_ordered))
+    trgt_collate = AugmentCollate(trgt_loader_config['pin_memory'],
+                                  defrec=(region_means, args.DefRec_dist) if args.DefRec_on_trgt else None)
+
 # dataloaders for source and target
-if args.balance_dataset:
-    src_train_loader = DataLoader(src_trainset, num_workers=NWORKERS,
-                                batch_sampler=src_train_sampler)
+pool = None
+if args.worker_pool:
+    # one persistent worker pool loads the batches of all the loaders, the training ones first
+    pool = WorkerPool.from_configs({'src_train': (src_train_data, src_loader_config),
+                                    'src_val': (src_trainset, src_loader_config),
+                                    'trgt_train': (trgt_train_data, trgt_loader_config),
+                                    'trgt_val': (trgt_trainset, trgt_loader_config),
+                                    'trgt_test': (trgt_testset, trgt_loader_config)}, seed=args.seed,
+                                   collate_fns={'src_train': src_collate, 'trgt_train': trgt_collate})
+    io.cprint("Worker pool of %d processes for all the loaders" % pool.num_workers)
+    src_train_loader = PooledLoader(pool, 'src_train', **sampler_kwargs(src_train_sampler))
+    src_val_loader = PooledLoader(pool, 'src_val', sampler=src_valid_sampler, batch_size=args.test_batch_size,
+                                  priority=EVAL)
+    trgt_train_loader = PooledLoader(pool, 'trgt_train', **sampler_kwargs(trgt_train_sampler))
+    trgt_val_loader = PooledLoader(pool, 'trgt_val', sampler=trgt_valid_sampler, batch_size=args.test_batch_size,
+                                   priority=EVAL)
+    trgt_test_loader = PooledLoader(pool, 'trgt_test', sampler=eval_sampler(range(len(trgt_testset))),
+                                    batch_size=args.test_batch_size, priority=EVAL)
 else:
-    src_train_loader = DataLoader(src_trainset, num_workers=NWORKERS, batch_size=args.batch_size,
-                                sampler=src_train_sampler, drop_last=True)
-    
-src_val_loader = DataLoader(src_trainset, num_workers=NWORKERS, batch_size=args.test_batch_size,
-                             sampler=src_valid_sampler)
-trgt_train_loader = DataLoader(trgt_trainset, num_workers=NWORKERS, batch_size=args.batch_size,
-                                sampler=trgt_train_sampler, drop_last=True)
-trgt_val_loader = DataLoader(trgt_trainset, num_workers=NWORKERS, batch_size=args.test_batch_size,
-                                  sampler=trgt_valid_sampler)
-trgt_test_loader = DataLoader(trgt_testset, num_workers=NWORKERS, batch_size=args.test_batch_size)
+    src_train_loader = DataLoader(src_train_data, **sampler_kwargs(src_train_sampler),
+                                  **loader_kwargs(src_loader_config, collate_fn=src_collate))
+    src_val_loader = DataLoader(src_trainset, batch_size=args.test_batch_size,
+                                sampler=src_valid_sampler, **loader_kwargs(src_loader_config, persistent=False))
+    trgt_train_loader = DataLoader(trgt_train_data, **sampler_kwargs(trgt_train_sampler),
+                                   **loader_kwargs(trgt_loader_config, collate_fn=trgt_collate))
+    trgt_val_loader = DataLoader(trgt_trainset, batch_size=args.test_batch_size,
+                                 sampler=trgt_valid_sampler, **loader_kwargs(trgt_loader_config, persistent=False))
+    trgt_test_loader = DataLoader(trgt_testset, batch_size=args.test_batch_size,
+                                  sampler=eval_sampler(range(len(trgt_testset))),
+                                  **loader_kwargs(trgt_loader_config, persistent=False))
 
 # ==================
 # Init Model
@@ -270,11 +401,30 @@ else:
     raise Exception("Not implemented")
 
 model = model.to(device)
+if memory_tracker is not None and not args.compile:  # the hooks would break the compiled graph
+    memory_tracker.attach(model)
+if args.compile:
+    eager_model, model = model, compile_model(model, args)
+    example = torch.rand(2, 3, NUM_POINTS, generator=torch.Generator().manual_seed(0)).to(device) * 2 - 1
+    max_diff, match = check_compiled(eager_model, model, example, activate_DefRec=True)
+    io.cprint("Compiled model outputs %s the eager outputs (max abs diff %.2e)"
+              % ("match" if match else "DO NOT MATCH", max_diff))
+
+teacher = None
+if args.teacher:
+    teacher = Teacher(args.teacher, device, args.teacher_config)
+    io.cprint("Distilling the %s teacher %s (head %s) into the %s model"
+              % (teacher.config.model, args.teacher, teacher.head, args.model))
+    if args.kd_cache:
+        teacher.add_cache('src', io.path + '/teacher_cache/' + src_dataset, len(src_trainset))
+        teacher.add_cache('trgt', io.path + '/teacher_cache/' + trgt_dataset, len(trgt_trainset))
 
 # Handle multi-gpu
-if (device.type == 'cuda') and len(args.gpus) > 1:
+if args.distributed:
+    model = nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank] if args.cuda else None,
+                                                find_unused_parameters=True)
+elif (device.type == 'cuda') and len(args.gpus) > 1:
     model = nn.DataParallel(model, args.gpus)
-best_model = copy.deepcopy(model)
 
 # ==================
 # Optimizer
@@ -283,6 +433,7 @@ opt = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_d
     else optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
 scheduler = CosineAnnealingLR(opt, args.epochs)
 criterion = nn.CrossEntropyLoss()  # return the mean of CE over the batch
+scaler = grad_scaler(args, device)  # loss scaling for fp16 autocast (disabled otherwise)
 # lookup table of regions means
 lookup = torch.Tensor(pc_utils.region_mean(args.num_regions)).to(device)
 
@@ -293,43 +444,29 @@ lookup = torch.Tensor(pc_utils.region_mean(args.num_regions)).to(device)
 def test(test_loader, model=None, set_type="Target", partition="Val", epoch=0):
 
     # Run on cpu or gpu
-    count = 0.0
-    print_losses = {'cls': 0.0}
-    batch_idx = 0
+    evaluator = ClassificationEvaluator(num_classes=len(label_to_idx), device=device)
+    head = "DeepJDOT" if args.use_DeepJDOT and args.DeepJDOT_head and args.DeepJDOT_classifier else "cls"
 
+    # evaluate the local model, the shards of the processes have different sizes
+    if args.distributed:
+        model = unwrap_model(model)
     with torch.no_grad():
         model.eval()
-        test_pred = []
-        test_true = []
-        for data, labels in test_loader:
-            data, labels = data.to(device), labels.to(device).squeeze()
-            data = data.permute(0, 2, 1)
-            batch_size = data.size()[0]
-
-            logits = model(data, activate_DefRec=False)
-            if args.use_DeepJDOT and args.DeepJDOT_head and args.DeepJDOT_classifier:
-                loss = criterion(logits["DeepJDOT"], labels)
-            else:
-                loss = criterion(logits["cls"], labels)
-            print_losses['cls'] += loss.item() * batch_size
-
-            # evaluation metrics
-            if args.use_DeepJDOT and args.DeepJDOT_head and args.DeepJDOT_classifier:
-                preds = logits["DeepJDOT"].max(dim=1)[1]
-            else:
-                preds = logits["cls"].max(dim=1)[1]
-            test_true.append(labels.cpu().numpy())
-            test_pred.append(preds.detach().cpu().numpy())
-            count += batch_size
-            batch_idx += 1
-
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
-    print_losses = {k: v * 1.0 / count for (k, v) in print_losses.items()}
-    test_acc = io.print_progress(set_type, partition, epoch, print_losses, test_true, test_pred)
-    conf_mat = metrics.confusion_matrix(test_true, test_pred, labels=list(label_to_idx.values())).astype(int)
-
-    return test_acc, print_losses['cls'], conf_mat
+        for batch in test_loader:
+            batch = batch.to(device)
+            data, labels = batch.points, batch.labels
+
+            with autocast(args, device):
+                logits = model(data, activate_DefRec=False, valid=batch.valid)
+                loss = criterion(logits[head], labels)
+            evaluator.update(logits[head], labels, loss)
+
+    evaluator.all_reduce()
+    results = evaluator.compute()
+    print_losses = {'cls': results['loss']}
+    test_acc = io.print_progress(set_type, partition, epoch, print_losses, conf_mat=results['conf_mat'])
+
+    return test_acc, print_losses['cls'], results['conf_mat']
 
 
 # ==================
@@ -337,119 +474,195 @@ def test(test_loader, model=None, set_type="Target", partition="Val", epoch=0):
 # ==================
 src_best_val_acc = trgt_best_val_acc = best_val_epoch = 0
 src_best_val_loss = trgt_best_val_loss = MAX_LOSS
-best_model = io.save_model(model)
+best_epoch_conf_mat = None
+
+
+def best_state():
+    return {'src_best_val_acc': src_best_val_acc, 'src_best_val_loss': src_best_val_loss,
+            'trgt_best_val_acc': trgt_best_val_acc, 'trgt_best_val_loss': trgt_best_val_loss,
+            'best_val_epoch': best_val_epoch, 'best_epoch_conf_mat': best_epoch_conf_mat}
+
+
+ckpt = CheckpointManager(io.path, keep_last=args.keep_checkpoints, write=is_main_process())
+loss_tracker = LossTracker(log_interval=args.log_interval, device=device)
+start_epoch = start_step = 0
+resumed = ckpt.resume(model, opt, scheduler, scaler=scaler) if args.resume else None
+if resumed is not None:
+    start_epoch, start_step = resumed['epoch'], resumed['step']
+    extra = resumed['extra']
+    src_best_val_acc, src_best_val_loss = extra['src_best_val_acc'], extra['src_best_val_loss']
+    trgt_best_val_acc, trgt_best_val_loss = extra['trgt_best_val_acc'], extra['trgt_best_val_loss']
+    best_val_epoch, best_epoch_conf_mat = extra['best_val_epoch'], extra['best_epoch_conf_mat']
+    io.cprint("Resuming from epoch %d, step %d" % (start_epoch, start_step))
+else:
+    ckpt.save(0, 0, model, opt, scheduler, extra=best_state(), is_best=True, scaler=scaler)
 
-for epoch in range(args.epochs):
+for epoch in range(start_epoch, args.epochs):
     model.train()
+    epoch_start = time.perf_counter()
+
+    # continue an interrupted epoch without replaying its first batches
+    skip = start_step if epoch == start_epoch else 0
+    for sampler in (src_train_sampler, trgt_train_sampler):
+        sampler.set_epoch(epoch)
+        sampler.set_start(skip if isinstance(sampler, BatchSampler) else skip * args.batch_size)
 
     # init data structures for saving epoch stats
     cls_type = 'mixup' if args.apply_PCM else 'cls'
-    src_print_losses = {"total": 0.0, cls_type: 0.0}
-    if args.DefRec_on_src:
-        src_print_losses['DefRec'] = 0.0
-    trgt_print_losses = {'DefRec': 0.0}
-    deepjdot_print_losses = {"total": 0.0, "cat": 0.0, "align": 0.0}
-    src_count = trgt_count = deepjdot_count =  0.0
+    if skip > 0 and 'loss_tracker' in resumed['extra']:
+        loss_tracker.load_state_dict(resumed['extra']['loss_tracker'])
+    else:
+        loss_tracker.reset('src', ["total", cls_type] + (['DefRec'] if args.DefRec_on_src else []))
+        loss_tracker.reset('trgt', ['DefRec'])
+        loss_tracker.reset('deepjdot', ["total", "cat", "align"])
+        loss_tracker.reset('kd_src', ["total", "soft", "embed"])
+        loss_tracker.reset('kd_trgt', ["total", "soft", "embed"])
 
     batch_idx = 1
-    cnt = 0
-    for data1, data2 in tqdm.tqdm(zip(src_train_loader, trgt_train_loader)): #total=len(src_trainset.train_ind) // args.batch_size
+    cnt = skip
+    for data1, data2 in tqdm.tqdm(profiler.iterate(zip(src_train_loader, trgt_train_loader), 'data'), disable=not is_main_process()): #total=len(src_trainset.train_ind) // args.batch_size
         opt.zero_grad()
         cnt = cnt + 1
+        # the batches are copied to the device once, all the branches below use views of them
+        src = data1.to(device) if data1 is not None else None
+        trgt = data2.to(device) if data2 is not None else None
 
         #### source data ####
-        if data1 is not None:
-            src_data, src_label = data1[0].to(device), data1[1].to(device).squeeze()
-            # change to [batch_size, num_coordinates, num_points]
-            src_data = src_data.permute(0, 2, 1)
-            batch_size = src_data.size()[0]
-            src_data_orig = src_data.clone()
-            device = torch.device("cuda:" + str(src_data.get_device()) if args.cuda else "cpu")
-
-            # self-supervised
-            if args.DefRec_on_src:
-                src_data, src_mask = DefRec.deform_input(src_data, lookup, args.DefRec_dist, device)
-                src_logits = model(src_data, activate_DefRec=True)
-                loss = DefRec.calc_loss(args, src_logits, src_data_orig, src_mask)
-                src_print_losses['DefRec'] += loss.item() * batch_size
-                src_print_losses['total'] += loss.item() * batch_size
-                if cnt % 5 == 0: 
-                    wandb.log({"defrec_ssl_src_loss": loss.item()})
-                loss.backward()
-
-            # supervised
-            if args.supervised:
-                if args.apply_PCM:
-                    src_data = src_data_orig.clone()
-                    src_data, mixup_vals = PCM.mix_shapes(args, src_data, src_label)
-                    src_cls_logits = model(src_data, activate_DefRec=False)
-                    #print(src_cls_logits)
-                    #print(src_cls_logits['cls'].shape, 'cls')
-                    loss = PCM.calc_loss(args, src_cls_logits, mixup_vals, criterion)
-                    src_print_losses['mixup'] += loss.item() * batch_size
-                    src_print_losses['total'] += loss.item() * batch_size
-                    if cnt % 5 == 0:
-                        wandb.log({"pcm_src_loss": loss.item()})
-                    loss.backward()
+        if src is not None:
+            src_data_orig, src_label = src.points, src.labels
+            batch_size = len(src)
 
+            # the deformation and the mixing are drawn for the full batch,
+            # forward/backward run per micro-batch with the losses weighted by the micro-batch share
+            if args.DefRec_on_src:
+                if args.worker_augment:
+                    src_data, src_mask = src.deformed, src.mask
                 else:
-                    src_data = src_data_orig.clone()
-                    # predict with undistorted shape
-                    src_cls_logits = model(src_data, activate_DefRec=False)
-                    loss = (1 - args.DefRec_weight) * criterion(src_cls_logits["cls"], src_label)
-                    src_print_losses['cls'] += loss.item() * batch_size
-                    src_print_losses['total'] += loss.item() * batch_size
-                    if cnt % 5 == 0:                    
-                        wandb.log({"defrec_src_loss": loss.item()})
-                    loss.backward()
-
-            src_count += batch_size
+                    # deformed in place, the original shapes are the reconstruction targets
+                    src_data, src_mask = DefRec.deform_input(src_data_orig.clone(), lookup, args.DefRec_dist, device,
+                                                             valid=src.valid)
+            if args.supervised and args.apply_PCM:
+                if args.worker_augment:
+                    src_mix_data, (src_label_a, src_label_b, lam) = src.mixed, (src.labels_a, src.labels_b, src.lam)
+                else:
+                    src_mix_data, (src_label_a, src_label_b, lam) = PCM.mix_shapes(args, src_data_orig, src_label)
+
+            for mb in micro_batch_slices(batch_size, args.accum_steps):
+                with no_sync(model, mb.stop == batch_size):
+                    mb_size = mb.stop - mb.start
+                    weight = mb_size / batch_size
+
+                    # self-supervised
+                    if args.DefRec_on_src:
+                        with profiler.stage('forward'), autocast(args, device):
+                            src_logits = model(src_data[mb], activate_DefRec=True, valid=src.valid_mask(mb))
+                            loss = DefRec.calc_loss(args, src_logits, src_data_orig[mb], src_mask[mb])
+                        loss_tracker.update('src', 'DefRec', loss, mb_size, log_name="defrec_ssl_src_loss")
+                        loss_tracker.update('src', 'total', loss, mb_size)
+                        with profiler.stage('backward'):
+                            scaler.scale(loss * weight).backward()
+
+                    # supervised
+                    if args.supervised:
+                        if args.apply_PCM:
+                            mixup_vals = (src_label_a[mb], src_label_b[mb], lam)
+                            with profiler.stage('forward'), autocast(args, device):
+                                src_cls_logits = model(src_mix_data[mb], activate_DefRec=False)
+                                loss = PCM.calc_loss(args, src_cls_logits, mixup_vals, criterion)
+                            loss_tracker.update('src', 'mixup', loss, mb_size, log_name="pcm_src_loss")
+                            loss_tracker.update('src', 'total', loss, mb_size)
+                            with profiler.stage('backward'):
+                                scaler.scale(loss * weight).backward()
+
+                        else:
+                            # predict with undistorted shape
+                            with profiler.stage('forward'), autocast(args, device):
+                                src_cls_logits = model(src_data_orig[mb], activate_DefRec=False,
+                                                       valid=src.valid_mask(mb))
+                                loss = (1 - args.DefRec_weight) * criterion(src_cls_logits["cls"], src_label[mb])
+                            loss_tracker.update('src', 'cls', loss, mb_size, log_name="defrec_src_loss")
+                            loss_tracker.update('src', 'total', loss, mb_size)
+                            with profiler.stage('backward'):
+                                scaler.scale(loss * weight).backward()
+
+            loss_tracker.count('src', batch_size)
 
         #### target data ####
-        if data2 is not None:
+        if trgt is not None:
             if args.DefRec_on_trgt:
-                trgt_data, trgt_label = data2[0].to(device), data2[1].to(device).squeeze()
-                trgt_data = trgt_data.permute(0, 2, 1)
-                batch_size = trgt_data.size()[0]
-                trgt_data_orig = trgt_data.clone()
-                device = torch.device("cuda:" + str(trgt_data.get_device()) if args.cuda else "cpu")
-
-                trgt_data, trgt_mask = DefRec.deform_input(trgt_data, lookup, args.DefRec_dist, device)
-                trgt_logits = model(trgt_data, activate_DefRec=True)
-                loss = DefRec.calc_loss(args, trgt_logits, trgt_data_orig, trgt_mask)
-                trgt_print_losses['DefRec'] += loss.item() * batch_size
-                if cnt % 5 == 0:                
-                    wandb.log({"defrec_trgt_loss": loss.item()})
-                loss.backward()
-            trgt_count += batch_size
-            
+                trgt_data_orig = trgt.points
+                batch_size = len(trgt)
+
+                if args.worker_augment:
+                    trgt_data, trgt_mask = trgt.deformed, trgt.mask
+                else:
+                    trgt_data, trgt_mask = DefRec.deform_input(trgt_data_orig.clone(), lookup, args.DefRec_dist,
+                                                               device, valid=trgt.valid)
+                for mb in micro_batch_slices(batch_size, args.accum_steps):
+                    with no_sync(model, mb.stop == batch_size):
+                        with profiler.stage('forward'), autocast(args, device):
+                            trgt_logits = model(trgt_data[mb], activate_DefRec=True, valid=trgt.valid_mask(mb))
+                            loss = DefRec.calc_loss(args, trgt_logits, trgt_data_orig[mb], trgt_mask[mb])
+                        loss_tracker.update('trgt', 'DefRec', loss, mb.stop - mb.start, log_name="defrec_trgt_loss")
+                        with profiler.stage('backward'):
+                            scaler.scale(loss * (mb.stop - mb.start) / batch_size).backward()
+            loss_tracker.count('trgt', batch_size)
+
+        #### distillation on the source and the unlabeled target data ####
+        if teacher is not None:
+            kd_head = "DeepJDOT" if args.use_DeepJDOT and args.DeepJDOT_head and args.DeepJDOT_classifier else "cls"
+            for domain, batch in (('src', src), ('trgt', trgt)):
+                if batch is None:
+                    continue
+                kd_data = batch.points
+                batch_size = len(batch)
+                with profiler.stage('kd_teacher'):
+                    teacher_logits, teacher_x = teacher.outputs(kd_data, args, domain, batch.index.numpy(),
+                                                                valid=batch.valid)
+                for mb in micro_batch_slices(batch_size, args.accum_steps):
+                    with no_sync(model, mb.stop == batch_size):
+                        mb_size = mb.stop - mb.start
+                        with profiler.stage('forward'), autocast(args, device):
+                            kd_logits, kd_x = model(kd_data[mb], activate_DefRec=False, return_intermediate=True,
+                                                    valid=batch.valid_mask(mb))
+                        soft_loss = args.kd_weight * distillation_loss(kd_logits[kd_head], teacher_logits[mb],
+                                                                       args.kd_temperature)
+                        embed_loss = args.kd_embed_weight * embedding_loss(kd_x, teacher_x[mb])
+                        loss = soft_loss + embed_loss
+                        loss_tracker.update('kd_' + domain, 'soft', soft_loss, mb_size, log_name="kd_%s_loss" % domain)
+                        loss_tracker.update('kd_' + domain, 'embed', embed_loss, mb_size)
+                        loss_tracker.update('kd_' + domain, 'total', loss, mb_size)
+                        with profiler.stage('backward'):
+                            scaler.scale(loss * mb_size / batch_size).backward()
+                loss_tracker.count('kd_' + domain, batch_size)
+
         string_to_be_taken = 'cls'
         if args.DeepJDOT_head:
             # separate head for DeepJDOT
             string_to_be_taken = 'DeepJDOT'
-        if data1 is not None and data2 is not None and args.use_DeepJDOT:
+        if src is not None and trgt is not None and args.use_DeepJDOT:
+            # predict with undistorted shapes
+            src_data, src_label = src.points, src.labels
+            src_batch_size = len(src)
+            trgt_data = trgt.points
+            batch_size = len(trgt)
+
             model.eval()
             gamma = None
             with torch.no_grad():
-                # predict with undistorted shape
-                src_data, src_label = data1[0].to(device), data1[1].to(device).squeeze()
-                # change to [batch_size, num_coordinates, num_points]
-                src_data = src_data.permute(0, 2, 1)
-                batch_size = src_data.size()[0]
-                src_data_orig = src_data.clone()
-                device = torch.device("cuda:" + str(src_data.get_device()) if args.cuda else "cpu")
-
-                src_data = src_data_orig.clone()
-                src_cls_logits, src_x = model(src_data, activate_DefRec=False, return_intermediate=True)
-
-                trgt_data, trgt_label = data2[0].to(device), data2[1].to(device).squeeze()
-                trgt_data = trgt_data.permute(0, 2, 1)
-                batch_size = trgt_data.size()[0]
-                trgt_data_orig = trgt_data.clone()
-                device = torch.device("cuda:" + str(trgt_data.get_device()) if args.cuda else "cpu")
-
-                trgt_data = trgt_data_orig.clone()
-                trgt_cls_logits, trgt_x = model(trgt_data, activate_DefRec=False, return_intermediate=True)
+                # the coupling is computed locally, by the model of this process
+                model_ = unwrap_model(model) if args.distributed else model
+                with profiler.stage('forward'), autocast(args, device):
+                    src_cls_logits, src_x = model_(src_data, activate_DefRec=False, return_intermediate=True,
+                                                   valid=src.valid)
+
+                with profiler.stage('forward'), autocast(args, device):
+                    trgt_cls_logits, trgt_x = model_(trgt_data, activate_DefRec=False, return_intermediate=True,
+                                                     valid=trgt.valid)
+
+                # the OT cost is computed in fp32
+                src_x, trgt_x = src_x.float(), trgt_x.float()
+                trgt_cls_logits = {k: v.float() for k, v in trgt_cls_logits.items()}
 
                 # logits output
                 C0 = torch.cdist(src_x, trgt_x, p=2.0)**2
@@ -462,8 +675,9 @@ for epoch in range(args.epochs):
                 C= args.jdot_alpha*C0+args.jdot_tloss*C1
 
                 # JDOT optimal coupling (gamma)
-                gamma=ot.emd(ot.unif(src_x.cpu().shape[0]),
-                            ot.unif(trgt_x.cpu().shape[0]),C.cpu())
+                with profiler.stage('ot_emd'):
+                    gamma=ot.emd(ot.unif(src_x.cpu().shape[0]),
+                                ot.unif(trgt_x.cpu().shape[0]),C.cpu())
                 
                 # update the computed gamma                      
                 gamma = torch.as_tensor(gamma, device=src_x.device)
@@ -471,76 +685,108 @@ for epoch in range(args.epochs):
 
                 
             model.train()
-            # predict with undistorted shape
-            src_data, src_label = data1[0].to(device), data1[1].to(device).squeeze()
-            # change to [batch_size, num_coordinates, num_points]
-            src_data = src_data.permute(0, 2, 1)
-            batch_size = src_data.size()[0]
-            src_data_orig = src_data.clone()
-            device = torch.device("cuda:" + str(src_data.get_device()) if args.cuda else "cpu")
-
-            src_data = src_data_orig.clone()
-            src_cls_logits, src_x = model(src_data, activate_DefRec=False, return_intermediate=True)
-
-
-            trgt_data, trgt_label = data2[0].to(device), data2[1].to(device).squeeze()
-            trgt_data = trgt_data.permute(0, 2, 1)
-            batch_size = trgt_data.size()[0]
-            trgt_data_orig = trgt_data.clone()
-            device = torch.device("cuda:" + str(trgt_data.get_device()) if args.cuda else "cpu")
-
-            trgt_data = trgt_data_orig.clone()
-            trgt_cls_logits, trgt_x = model(trgt_data, activate_DefRec=False, return_intermediate=True)
-
-            cat_loss   = classifier_cat_loss(src_cls_logits[string_to_be_taken], trgt_cls_logits[string_to_be_taken], src_label, gamma)
-            align_loss_batch = align_loss(src_x, trgt_x, gamma)
-            
+            # the source and target micro-batches are paired, both batches are split into the same number of parts
+            accum_steps = min(args.accum_steps, src_batch_size, batch_size)
+            src_slices = micro_batch_slices(src_batch_size, accum_steps)
+            trgt_slices = micro_batch_slices(batch_size, accum_steps)
+            accumulate = accum_steps > 1
+            if accumulate:
+                # the alignment loss couples every source sample with every target sample: a micro-batch is
+                # aligned against the detached features of the full batch (same micro-batches, so the same
+                # batch norm statistics as the passes with gradients)
+                with torch.no_grad(), preserve_bn_stats([model_]), autocast(args, device):
+                    src_x_full = torch.cat([model_(src_data[s], activate_DefRec=False, return_intermediate=True,
+                                                   valid=src.valid_mask(s))[1] for s in src_slices]).float()
+                    trgt_x_full = torch.cat([model_(trgt_data[t], activate_DefRec=False, return_intermediate=True,
+                                                    valid=trgt.valid_mask(t))[1] for t in trgt_slices]).float()
+
+            # under DDP both forwards are followed by one backward: only the first goes through the wrapper
+            trgt_model = unwrap_model(model) if args.distributed else model
+            cat_loss = align_loss_batch = 0.0
+            for s, t in zip(src_slices, trgt_slices):
+                with no_sync(model, s.stop == src_batch_size):
+                    with profiler.stage('forward'), autocast(args, device):
+                        src_cls_logits, src_x = model(src_data[s], activate_DefRec=False, return_intermediate=True,
+                                                      valid=src.valid_mask(s))
+                        trgt_cls_logits, trgt_x = trgt_model(trgt_data[t], activate_DefRec=False,
+                                                             return_intermediate=True, valid=trgt.valid_mask(t))
+
+                    # the transport-weighted losses are computed in fp32
+                    mb_cat_loss = classifier_cat_loss(src_cls_logits[string_to_be_taken].float(), trgt_cls_logits[string_to_be_taken].float(),
+                                                      src_label, gamma[:, t], ys_s=src_label[s],
+                                                      s_weight=(s.stop - s.start) / src_batch_size)
+                    if accumulate:
+                        mb_align_loss = align_loss(src_x.float(), trgt_x_full, gamma[s, :]) + \
+                                        align_loss(src_x_full, trgt_x.float(), gamma[:, t])
+                    else:
+                        mb_align_loss = align_loss(src_x.float(), trgt_x.float(), gamma)
+                    with profiler.stage('backward'):
+                        scaler.scale(mb_cat_loss + mb_align_loss).backward()
+                    cat_loss = cat_loss + mb_cat_loss.detach()
+                    align_loss_batch = align_loss_batch + mb_align_loss.detach()
+            if accumulate:
+                align_loss_batch = align_loss(src_x_full, trgt_x_full, gamma)
+
             loss = cat_loss + align_loss_batch
 
-            deepjdot_print_losses['align'] += align_loss_batch.item() * batch_size
-            deepjdot_print_losses['cat'] += cat_loss.item() * batch_size
-            deepjdot_print_losses['total'] += loss.item() * batch_size
-            if cnt % 5 == 0:            
-                wandb.log({"deepJDOT_loss_total": loss.item()})
-                wandb.log({"deepJDOT_align_loss_total": align_loss_batch.item()})
-                wandb.log({"deepJDOT_cat_loss_total": cat_loss.item()})
-            loss.backward()
-            deepjdot_count += batch_size
-
-        opt.step()
+            loss_tracker.update('deepjdot', 'align', align_loss_batch, batch_size, log_name="deepJDOT_align_loss_total")
+            loss_tracker.update('deepjdot', 'cat', cat_loss, batch_size, log_name="deepJDOT_cat_loss_total")
+            loss_tracker.update('deepjdot', 'total', loss, batch_size, log_name="deepJDOT_loss_total")
+            loss_tracker.count('deepjdot', batch_size)
+
+        with profiler.stage('optimizer'):
+            scaler.step(opt)
+            scaler.update()
+        profiler.end_step(cnt)
         batch_idx += 1
 
+        step_losses = loss_tracker.step_values(cnt)
+        if step_losses is not None:
+            sink.log(step_losses)
+
+        if args.ckpt_interval > 0 and cnt % args.ckpt_interval == 0:
+            with profiler.stage('checkpoint'):
+                ckpt.save(epoch, cnt, model, opt, scheduler,
+                          extra=dict(best_state(), loss_tracker=loss_tracker.state_dict()), scaler=scaler)
+        if args.max_steps > 0 and cnt - skip >= args.max_steps:
+            break
+
     scheduler.step()
 
     # print progress
-    src_print_losses = {k: v * 1.0 / src_count for (k, v) in src_print_losses.items()}
+    src_print_losses = loss_tracker.flush('src')
     src_acc = io.print_progress("Source", "Trn", epoch, src_print_losses)
-    trgt_print_losses = {k: v * 1.0 / trgt_count for (k, v) in trgt_print_losses.items()}
+    trgt_print_losses = loss_tracker.flush('trgt')
     trgt_acc = io.print_progress("Target", "Trn", epoch, trgt_print_losses)
     if args.use_DeepJDOT:
-        deepjdot_print_losses = {k: v * 1.0 / deepjdot_count for (k, v) in deepjdot_print_losses.items()}
+        deepjdot_print_losses = loss_tracker.flush('deepjdot')
         deepjdot_acc = io.print_progress("DeepJDOT", "Trn", epoch, deepjdot_print_losses)
+    if teacher is not None:
+        io.print_progress("Source distillation", "Trn", epoch, loss_tracker.flush('kd_src'))
+        io.print_progress("Target distillation", "Trn", epoch, loss_tracker.flush('kd_trgt'))
 
     #===================
     # Validation
     #===================
-    src_val_acc, src_val_loss, src_conf_mat = test(src_val_loader, model, "Source", "Val", epoch)
-    trgt_val_acc, trgt_val_loss, trgt_conf_mat = test(trgt_val_loader, model, "Target", "Val", epoch)
+    with profiler.stage('validation'):
+        src_val_acc, src_val_loss, src_conf_mat = test(src_val_loader, model, "Source", "Val", epoch)
+        trgt_val_acc, trgt_val_loss, trgt_conf_mat = test(trgt_val_loader, model, "Target", "Val", epoch)
 
-    wandb.log({"src_val_acc": src_val_acc})
-    wandb.log({"src_val_loss": src_val_loss})
-    wandb.log({"trgt_val_acc": trgt_val_acc})
-    wandb.log({"trgt_val_loss": trgt_val_loss})
+    sink.log({"src_val_acc": src_val_acc, "src_val_loss": src_val_loss,
+              "trgt_val_acc": trgt_val_acc, "trgt_val_loss": trgt_val_loss})
 
     # save model according to best source model (since we don't have target labels)
-    if src_val_acc > src_best_val_acc:
+    is_best = src_val_acc > src_best_val_acc
+    if is_best:
         src_best_val_acc = src_val_acc
         src_best_val_loss = src_val_loss
         trgt_best_val_acc = trgt_val_acc
         trgt_best_val_loss = trgt_val_loss
         best_val_epoch = epoch
         best_epoch_conf_mat = trgt_conf_mat
-        best_model = io.save_model(model)
+    with profiler.stage('checkpoint'):
+        ckpt.save(epoch + 1, 0, model, opt, scheduler, extra=best_state(), is_best=is_best, scaler=scaler)
+    profiler.log(io, epoch, time.perf_counter() - epoch_start)
 
 io.cprint("Best model was found at epoch %d, source validation accuracy: %.4f, source validation loss: %.4f,"
           "target validation accuracy: %.4f, target validation loss: %.4f"
@@ -551,10 +797,19 @@ io.cprint('\n' + str(best_epoch_conf_mat))
 #===================
 # Test
 #===================
-model = best_model
+unwrap_model(model).load_state_dict(ckpt.best_state_dict())
 trgt_test_acc, trgt_test_loss, trgt_conf_mat = test(trgt_test_loader, model, "Target", "Test", 0)
 io.cprint("target test accuracy: %.4f, target test loss: %.4f" % (trgt_test_acc, trgt_best_val_loss))
 io.cprint("Test confusion matrix:")
 io.cprint('\n' + str(trgt_conf_mat))
 
-#1-72:00:00
\ No newline at end of file
+if teacher is not None:
+    teacher.close()
+ckpt.close()
+sink.close()
+if pool is not None:
+    pool.close()
+io.close()
+cleanup()
+
+#1-72:00:00
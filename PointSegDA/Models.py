@@ -2,30 +2,43 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from utils.activation_checkpoint import checkpoint_block
+from utils.amp_utils import fp32
+from utils.profiler import profiled
+from utils.pc_utils import masked_max
 
 K = 20
 
-def knn(x, k):
-    inner = -2*torch.matmul(x.transpose(2, 1), x)
-    xx = torch.sum(x**2, dim=1, keepdim=True)
-    pairwise_distance = -xx - inner - xx.transpose(2, 1)
+@profiled('knn')
+def knn(x, k, valid=None):
+    # distances are computed in fp32 also under autocast, the neighbours are sensitive to rounding
+    with fp32(x.device.type):
+        x = x.float()
+        inner = -2*torch.matmul(x.transpose(2, 1), x)
+        xx = torch.sum(x**2, dim=1, keepdim=True)
+        pairwise_distance = -xx - inner - xx.transpose(2, 1)
+        if valid is not None:
+            # the padding of the shapes is nobody's neighbour
+            pairwise_distance = pairwise_distance.masked_fill(~valid.unsqueeze(1), float('-inf'))
 
     # (batch_size, num_points, k)
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]
+    distance, idx = pairwise_distance.topk(k=k, dim=-1)
+    if valid is not None:
+        # shapes with fewer valid points than k: the missing neighbours repeat the nearest one, which
+        # leaves the max over the neighbours unchanged
+        idx = torch.where(torch.isinf(distance), idx[:, :, :1], idx)
     return idx
 
 
-def get_graph_feature(x, args, k=20, idx=None):
+@profiled('graph_feature')
+def get_graph_feature(x, k=20, idx=None, valid=None):
     batch_size = x.size(0)
     num_points = x.size(2)
     x = x.view(batch_size, -1, num_points)
     if idx is None:
-        idx = knn(x, k=k)   # (batch_size, num_points, k)
-    # Run on cpu or gpu
-    if x.get_device() == -1 and args.gpus[0] != -1:
-        device = torch.device("cpu")
-    else:
-        device = torch.device("cuda:" + str(x.get_device()) if args.gpus[0] != -1 else "cpu")
+        idx = knn(x, k=k, valid=valid)   # (batch_size, num_points, k)
+    # Run on the device of the input
+    device = x.device
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
 
@@ -45,6 +58,35 @@ def get_graph_feature(x, args, k=20, idx=None):
     return feature
 
 
+def edge_conv(x, layers, k=20, recompute=False, valid=None):
+    """
+    EdgeConv block: graph features of the k nearest neighbours, layers and max over the neighbours.
+    With recompute the [B, C, N, k] activations are recomputed in backward instead of kept.
+    The neighbours are valid points of the padded shapes (valid [B, N], None - all the points).
+    """
+    def block(x):
+        x = get_graph_feature(x, k=k, valid=valid)
+        for layer in layers:
+            x = layer(x)
+        return x.max(dim=-1, keepdim=False)[0]
+
+    if recompute and torch.is_grad_enabled():
+        return checkpoint_block(block, x, layers)
+    return block(x)
+
+
+def input_transform(x, transform_net, k=20, recompute=False, valid=None):
+    """
+    Transformation matrix predicted from the graph features of x (recomputed in backward as edge_conv)
+    """
+    def block(x):
+        return transform_net(get_graph_feature(x, k=k, valid=valid), valid)
+
+    if recompute and torch.is_grad_enabled():
+        return checkpoint_block(block, x, [transform_net])
+    return block(x)
+
+
 class conv_2d(nn.Module):
     def __init__(self, in_ch, out_ch, kernel, activation='relu', bias=True):
         super(conv_2d, self).__init__()
@@ -96,26 +138,22 @@ class transform_net(nn.Module):
         self.fc2 = fc_layer(512, 256, activation='leakyrelu')
         self.fc3 = nn.Linear(256, out * out)
 
-    def forward(self, x):
-        # Run on cpu or gpu
-        if x.get_device() == -1 and self.args.gpus[0] != -1:
-            device = torch.device("cpu")
-        else:
-            device = torch.device("cuda:" + str(x.get_device()) if self.args.gpus[0] != -1 else "cpu")
+    def forward(self, x, valid=None):
+        # Run on the device of the input
+        device = x.device
 
         x = self.conv2d1(x)
         x = self.conv2d2(x)
         x = x.max(dim=-1, keepdim=False)[0]
         x = torch.unsqueeze(x, dim=3)
         x = self.conv2d3(x)
-        x, _ = torch.max(x, dim=2, keepdim=False)
+        x = masked_max(x, valid)
         x = x.view(x.size(0), -1)
         x = self.fc1(x)
         x = self.fc2(x)
         x = self.fc3(x)
 
-        iden = torch.eye(self.K).view(1, self.K * self.K).repeat(x.size(0), 1)
-        iden = iden.to(device)
+        iden = torch.eye(self.K, device=device).view(1, self.K * self.K).repeat(x.size(0), 1)
         x = x + iden
         x = x.view(x.size(0), self.K, self.K)
         return x
@@ -126,6 +164,7 @@ class shared_layers(nn.Module):
         super(shared_layers, self).__init__()
         self.args = args
         self.k = K
+        self.checkpoint_edgeconv = getattr(args, 'checkpoint_edgeconv', False)
 
         self.of1 = 64
         self.of2 = 64
@@ -143,28 +182,16 @@ class shared_layers(nn.Module):
         self.conv6 = nn.Conv1d(num_f_prev, self.of6, kernel_size=1, bias=True)
 
 
-    def forward(self, x):
-
-        batch_size = x.size(0)
-
-        x = get_graph_feature(x, self.args, k=self.k)
-        x = self.conv1(x)
-        x = self.conv2(x)
-        x1 = x.max(dim=-1, keepdim=False)[0]
+    def forward(self, x, valid=None):
 
-        x = get_graph_feature(x1, self.args, k=self.k)
-        x = self.conv3(x)
-        x = self.conv4(x)
-        x2 = x.max(dim=-1, keepdim=False)[0]
-
-        x = get_graph_feature(x2, self.args, k=self.k)
-        x = self.conv5(x)
-        x3 = x.max(dim=-1, keepdim=False)[0]
+        x1 = edge_conv(x, [self.conv1, self.conv2], k=self.k, recompute=self.checkpoint_edgeconv, valid=valid)
+        x2 = edge_conv(x1, [self.conv3, self.conv4], k=self.k, recompute=self.checkpoint_edgeconv, valid=valid)
+        x3 = edge_conv(x2, [self.conv5], k=self.k, recompute=self.checkpoint_edgeconv, valid=valid)
 
         x123 = torch.cat((x1, x2, x3), dim=1)
         x4 = self.conv6(x123)
 
-        x5 = F.adaptive_max_pool1d(x4, 1).view(batch_size, -1)
+        x5 = masked_max(x4, valid)
 
         return x123, x5.unsqueeze(2)
 
@@ -178,6 +205,7 @@ class DGCNN_DefRec(nn.Module):
 
         self.args = args
         self.k = K
+        self.checkpoint_edgeconv = getattr(args, 'checkpoint_edgeconv', False)
 
         self.input_transform_net = transform_net(args, in_size*2, in_size)
         self.shared_layers = shared_layers(args, in_size=in_size)
@@ -186,16 +214,20 @@ class DGCNN_DefRec(nn.Module):
         self.seg = segmentation(args, input_size=1024 + self.num_f_prev, num_classes=num_classes)
         self.DefRec = DeformationReconstruction(args, 1024 + self.num_f_prev, out_size=in_size)
 
-    def forward(self, x, make_seg=True, activate_DefRec=True):
-
+    def forward(self, x, make_seg=True, activate_DefRec=True, valid=None):
+        """
+        Input:
+            x - point clouds [B, C, N]
+            valid - valid points of the padded shapes [B, N], None if all the points are valid
+        """
         num_points = x.size(2)
         logits = {}
 
         # Input transform net
-        x0 = get_graph_feature(x, self.args, k=self.k)
-        transformd_x0 = self.input_transform_net(x0)
+        transformd_x0 = input_transform(x, self.input_transform_net, k=self.k, recompute=self.checkpoint_edgeconv,
+                                        valid=valid)
         x = torch.matmul(transformd_x0, x)
-        x123, x5 = self.shared_layers(x)
+        x123, x5 = self.shared_layers(x, valid)
 
         x = torch.cat((x123, x5.repeat(1, 1, num_points)), dim=1)
         if make_seg:
@@ -27,4 +27,10 @@ class datareader(Dataset):
         return (pointcloud, label)
 
     def __len__(self):
-        return len(self.data)
\ No newline at end of file
+        return len(self.data)
+
+    def point_counts(self):
+        """
+        Return: number of points of every shape
+        """
+        return np.array([len(d) for d in self.data])
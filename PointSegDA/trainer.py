@@ -5,13 +5,28 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from torch.utils.data import DataLoader
+from torch.utils.data.sampler import BatchSampler
 import argparse
-import copy
+import time
 import utils.log
 from torchsummary import summary
 from PointSegDA.data.dataloader import datareader
 from PointSegDA.Models import DGCNN_DefRec
+from PointDA.Samplers import BucketBatchSampler, ResumableSubsetRandomSampler
 from utils import pc_utils
+from utils.metrics import LossTracker
+from utils.checkpoint import CheckpointManager, unwrap_model
+from utils.dist_utils import init_distributed, is_main_process, all_reduce_sum, cleanup
+from utils.amp_utils import autocast, grad_scaler
+from utils.train_utils import micro_batch_slices, no_sync
+from utils.batch_probe import auto_batch_size
+from utils.compile_utils import compile_model, check_compiled
+from utils.profiler import StageProfiler, set_profiler
+from utils.memory_tracker import MemoryTracker
+from utils.loader_tuning import DEFAULT_TUNING_FILE, dataset_key, trainer_loader_config, loader_kwargs
+from utils.worker_pool import WorkerPool, PooledLoader, EVAL
+from utils.point_batch import AugmentCollate, FPSOrderings, IGNORE_INDEX
+from utils.distillation import IndexedDataset
 from sklearn.metrics import jaccard_score
 from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 unused import
 from DefRec_and_PCM import DefRec, PCM
@@ -65,19 +80,58 @@ parser.add_argument('--noise_std', type=float, default=0.1, help='learning rate'
 parser.add_argument('--apply_PCM', type=str2bool, default=True, help='Using mixup in source')
 parser.add_argument('--DefRec_weight', type=float, default=0.05, help='weight of the DefRec loss')
 parser.add_argument('--mixup_params', type=float, default=1.0, help='a,b in beta distribution')
+parser.add_argument('--amp', type=str2bool, default=False, help='mixed precision (autocast) training and evaluation')
+parser.add_argument('--amp_dtype', type=str, default='fp16', choices=['fp16', 'bf16'],
+                    help='autocast dtype on accelerators (bf16 is always used on cpu)')
+parser.add_argument('--auto_batch_size', type=str2bool, default=False,
+                    help='set the train (micro-)batch size and the test batch size to the largest that fit in memory')
+parser.add_argument('--memory_fraction', type=float, default=0.9, help='memory budget of --auto_batch_size')
+parser.add_argument('--accum_steps', type=int, default=1,
+                    help='micro-batches per source/target batch, gradients are accumulated over them '
+                         '(batch norm normalizes each micro-batch with its own statistics)')
+parser.add_argument('--compile', type=str2bool, default=False, help='torch.compile the model')
+parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'])
+parser.add_argument('--checkpoint_edgeconv', type=str2bool, default=False,
+                    help='recompute the EdgeConv blocks in backward instead of keeping their activations')
+parser.add_argument('--profile', type=str2bool, default=False,
+                    help='time the stages of the training step (run log summary per epoch and a Chrome trace)')
+parser.add_argument('--profile_memory', type=str2bool, default=False,
+                    help='track the peak memory of the stages and model submodules (implies --profile)')
+parser.add_argument('--resume', type=str2bool, default=False, help='resume from the latest checkpoint of the experiment')
+parser.add_argument('--ckpt_interval', type=int, default=0, help='steps between mid-epoch checkpoints (0 - only at epoch end)')
+parser.add_argument('--keep_checkpoints', type=int, default=3, help='number of recent checkpoints to keep')
+parser.add_argument('--max_steps', type=int, default=0,
+                    help='train steps per epoch (0 - the full epoch), for short benchmark runs')
+parser.add_argument('--tune_loader', type=str2bool, default=False,
+                    help='benchmark the data loader configurations of the datasets on this host and keep the best')
+parser.add_argument('--tuned_loader', type=str2bool, default=True,
+                    help='use the loader configurations tuned for this host and the datasets (if any)')
+parser.add_argument('--loader_tuning_file', type=str, default=DEFAULT_TUNING_FILE,
+                    help='tuned loader configurations per host and dataset')
+parser.add_argument('--worker_pool', type=str2bool, default=False,
+                    help='load the batches of all the loaders with one persistent worker pool (training batches first)')
+parser.add_argument('--worker_augment', type=str2bool, default=False,
+                    help='draw the DefRec deformations and the PCM mixes of the train batches in the loader workers')
 
 args = parser.parse_args()
 # ==================
 # init
 # ==================
+args.cuda = (args.gpus[0] >= 0) and torch.cuda.is_available()
+# distributed when launched with torchrun
+device = init_distributed(args)
 io = utils.log.IOStream(args)
 io.cprint(str(args))
+io.save_args()
+memory_tracker = MemoryTracker(device, path=io.path + '/memory_rank%d.jsonl' % args.rank) if args.profile_memory else None
+profiler = set_profiler(StageProfiler(enabled=args.profile or args.profile_memory, device=device, pid=args.rank,
+                                      trace_path=io.path + '/trace_rank%d.json' % args.rank, memory=memory_tracker))
 
 random.seed(1)
 np.random.seed(1)  # to get the same point choice in ModelNet and ScanNet leave it fixed
 torch.manual_seed(args.seed)
-args.cuda = (args.gpus[0] >= 0) and torch.cuda.is_available()
-device = torch.device("cuda:" + str(args.gpus[0]) if args.cuda else "cpu")
+if args.distributed:
+    io.cprint('Distributed run with %d processes' % args.world_size)
 if args.cuda:
     io.cprint('Using GPUs ' + str(args.gpus) + ',' + ' from ' +
               str(torch.cuda.device_count()) + ' devices available')
@@ -98,15 +152,85 @@ trgt_trainset = datareader(args.dataroot, dataset=args.trgt_dataset, partition='
 trgt_valset = datareader(args.dataroot, dataset=args.trgt_dataset, partition='val', domain='target')
 trgt_testset = datareader(args.dataroot, dataset=args.trgt_dataset, partition='test', domain='target')
 
+if args.auto_batch_size:
+    auto_batch_size(DGCNN_DefRec(args, in_size=3, num_classes=8), args, 'seg', device, src_trainset[0][0].shape[0], io)
+
 # dataloaders for source and target
 batch_size = min(len(src_trainset), len(trgt_trainset), args.batch_size)
-src_train_loader = DataLoader(src_trainset, num_workers=NWORKERS, batch_size=batch_size,
-                               shuffle=True, drop_last=True)
-src_val_loader = DataLoader(src_valset, num_workers=NWORKERS, batch_size=args.test_batch_size)
-trgt_train_loader = DataLoader(trgt_trainset, num_workers=NWORKERS, batch_size=batch_size,
-                               shuffle=True, drop_last=True)
-trgt_val_loader = DataLoader(trgt_valset, num_workers=NWORKERS, batch_size=args.test_batch_size)
-trgt_test_loader = DataLoader(trgt_testset, num_workers=NWORKERS, batch_size=args.test_batch_size)
+
+
+def train_sampler(dataset, seed):
+    indices = list(range(len(dataset)))
+    if len(np.unique(dataset.point_counts())) > 1:
+        # shapes of varying point counts: batches of similar counts, little padding
+        return BucketBatchSampler(indices, dataset.point_counts(), batch_size, seed=seed,
+                                  num_replicas=args.world_size, rank=args.rank)
+    return ResumableSubsetRandomSampler(indices, seed=seed, num_replicas=args.world_size, rank=args.rank)
+
+
+def sampler_kwargs(sampler):
+    # keyword arguments of the train loaders (DataLoader or PooledLoader) of a train sampler
+    if isinstance(sampler, BatchSampler):
+        return {'batch_sampler': sampler}
+    return {'sampler': sampler, 'batch_size': batch_size, 'drop_last': True}
+
+
+# the source and target batches are drawn with different seeds, so their pairing changes every epoch
+src_train_sampler = train_sampler(src_trainset, args.seed)
+trgt_train_sampler = train_sampler(trgt_trainset, args.seed + 1)
+
+
+def eval_sampler(dataset):
+    # each process evaluates its own part, test() sums the statistics over all processes
+    return list(range(len(dataset)))[args.rank::args.world_size]
+
+
+# loader configurations (workers, prefetching, pinning) tuned per host and dataset
+src_loader_config = trainer_loader_config(args, dataset_key('PointSegDA', args.dataroot, args.src_dataset),
+                                          src_trainset, batch_size, NWORKERS, device, io)
+trgt_loader_config = trainer_loader_config(args, dataset_key('PointSegDA', args.dataroot, args.trgt_dataset),
+                                           trgt_trainset, batch_size, NWORKERS, device, io)
+
+# the DefRec deformations and the PCM mixes of the train batches are drawn by the loader workers
+src_train_data, src_collate, trgt_collate = src_trainset, None, None
+if args.worker_augment:
+    if args.apply_PCM:
+        # the shapes keep their point order, their farthest point orderings are cached by sample index
+        src_train_data = IndexedDataset(src_trainset)
+        src_collate = AugmentCollate(src_loader_config['pin_memory'], pcm=args.mixup_params,
+                                     orderings=FPSOrderings(fps_ordered=False), segmentation=True)
+    trgt_collate = AugmentCollate(trgt_loader_config['pin_memory'],
+                                  defrec=(pc_utils.region_mean(args.num_regions), args.DefRec_dist))
+
+pool = None
+if args.worker_pool:
+    # one persistent worker pool loads the batches of all the loaders, the training ones first
+    pool = WorkerPool.from_configs({'src_train': (src_train_data, src_loader_config),
+                                    'src_val': (src_valset, src_loader_config),
+                                    'trgt_train': (trgt_trainset, trgt_loader_config),
+                                    'trgt_val': (trgt_valset, trgt_loader_config),
+                                    'trgt_test': (trgt_testset, trgt_loader_config)}, seed=args.seed,
+                                   collate_fns={'src_train': src_collate, 'trgt_train': trgt_collate})
+    io.cprint("Worker pool of %d processes for all the loaders" % pool.num_workers)
+    src_train_loader = PooledLoader(pool, 'src_train', **sampler_kwargs(src_train_sampler))
+    src_val_loader = PooledLoader(pool, 'src_val', sampler=eval_sampler(src_valset), batch_size=args.test_batch_size,
+                                  priority=EVAL)
+    trgt_train_loader = PooledLoader(pool, 'trgt_train', **sampler_kwargs(trgt_train_sampler))
+    trgt_val_loader = PooledLoader(pool, 'trgt_val', sampler=eval_sampler(trgt_valset),
+                                   batch_size=args.test_batch_size, priority=EVAL)
+    trgt_test_loader = PooledLoader(pool, 'trgt_test', sampler=eval_sampler(trgt_testset),
+                                    batch_size=args.test_batch_size, priority=EVAL)
+else:
+    src_train_loader = DataLoader(src_train_data, **sampler_kwargs(src_train_sampler),
+                                  **loader_kwargs(src_loader_config, collate_fn=src_collate))
+    src_val_loader = DataLoader(src_valset, batch_size=args.test_batch_size,
+                                sampler=eval_sampler(src_valset), **loader_kwargs(src_loader_config, persistent=False))
+    trgt_train_loader = DataLoader(trgt_trainset, **sampler_kwargs(trgt_train_sampler),
+                                   **loader_kwargs(trgt_loader_config, collate_fn=trgt_collate))
+    trgt_val_loader = DataLoader(trgt_valset, batch_size=args.test_batch_size,
+                                 sampler=eval_sampler(trgt_valset), **loader_kwargs(trgt_loader_config, persistent=False))
+    trgt_test_loader = DataLoader(trgt_testset, batch_size=args.test_batch_size,
+                                  sampler=eval_sampler(trgt_testset), **loader_kwargs(trgt_loader_config, persistent=False))
 
 # ==================
 # Init Model
@@ -114,14 +238,25 @@ trgt_test_loader = DataLoader(trgt_testset, num_workers=NWORKERS, batch_size=arg
 num_classes = 8
 model = DGCNN_DefRec(args, in_size=3, num_classes=num_classes)
 
-summary(model, input_size=(3, 2048), device='cpu')
+if is_main_process():
+    summary(model, input_size=(3, 2048), device='cpu')
 
 model = model.to(device)
+if memory_tracker is not None and not args.compile:  # the hooks would break the compiled graph
+    memory_tracker.attach(model)
+if args.compile:
+    eager_model, model = model, compile_model(model, args)
+    example = torch.rand(2, 3, 2048, generator=torch.Generator().manual_seed(0)).to(device) * 2 - 1
+    max_diff, match = check_compiled(eager_model, model, example, make_seg=True, activate_DefRec=True)
+    io.cprint("Compiled model outputs %s the eager outputs (max abs diff %.2e)"
+              % ("match" if match else "DO NOT MATCH", max_diff))
 
 # Handle multi-gpu
-if (device.type == 'cuda') and len(args.gpus) > 1:
+if args.distributed:
+    model = nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank] if args.cuda else None,
+                                                find_unused_parameters=True)
+elif (device.type == 'cuda') and len(args.gpus) > 1:
     model = nn.DataParallel(model, args.gpus)
-best_model = copy.deepcopy(model)
 
 
 # ==================
@@ -138,6 +273,7 @@ scheduler = CosineAnnealingLR(opt, T_max=t_max, eta_min=0.0)
 # ==================
 criterion = nn.CrossEntropyLoss()  # return the mean of CE over the batch
 sample_criterion = nn.CrossEntropyLoss(reduction='none')  # to get the loss per shape
+scaler = grad_scaler(args, device)  # loss scaling for fp16 autocast (disabled otherwise)
 
 def seg_metrics(labels, preds):
     batch_size = labels.shape[0]
@@ -145,6 +281,9 @@ def seg_metrics(labels, preds):
     for b in range(batch_size):
         y_true = labels[b, :].detach().cpu().numpy()
         y_pred = preds[b, :].detach().cpu().numpy()
+        # the padding of the shapes with fewer points is not scored
+        scored = y_true != IGNORE_INDEX
+        y_true, y_pred = y_true[scored], y_pred[scored]
         # IOU per class and average
         mIOU += jaccard_score(y_true, y_pred, average='macro')
         accuracy += np.mean(y_true == y_pred)
@@ -159,17 +298,20 @@ def test(test_loader):
     # Run on cpu or gpu
     seg_loss = mIOU = accuracy = 0.0
     batch_idx = num_samples = 0
+    # evaluate the local model, the shards of the processes have different sizes
+    net = unwrap_model(model) if args.distributed else model
 
     with torch.no_grad():
-        model.eval()
-        for i, data in enumerate(test_loader):
-            data, labels = data[0].to(device), data[1].to(device)
-            data = data.permute(0, 2, 1)
-            batch_size = data.shape[0]
+        net.eval()
+        for i, batch in enumerate(test_loader):
+            batch = batch.to(device)
+            data, labels = batch.points, batch.labels
+            batch_size = len(batch)
 
-            logits = model(data, make_seg=True, activate_DefRec=False)
-            loss = criterion(logits["seg"].permute(0, 2, 1), labels)
-            seg_loss += loss.item() * batch_size
+            with autocast(args, device):
+                logits = net(data, make_seg=True, activate_DefRec=False, valid=batch.valid)
+                loss = criterion(logits["seg"].permute(0, 2, 1), labels)
+            seg_loss += loss.detach() * batch_size
 
             # evaluation metrics
             preds = logits["seg"].max(dim=2)[1]
@@ -180,6 +322,8 @@ def test(test_loader):
             num_samples += batch_size
             batch_idx += 1
 
+    stats = torch.tensor([float(seg_loss), mIOU, accuracy, num_samples], dtype=torch.float64, device=device)
+    seg_loss, mIOU, accuracy, num_samples = all_reduce_sum(stats).cpu().tolist()
     seg_loss /= num_samples
     mIOU /= num_samples
     accuracy /= num_samples
@@ -196,85 +340,152 @@ src_best_val_mIOU = trgt_best_val_mIOU = 0.0
 src_best_val_loss = trgt_best_val_loss = MAX_LOSS
 epoch = step = 0
 lookup = torch.Tensor(pc_utils.region_mean(args.num_regions)).to(device)
+loss_tracker = LossTracker(device=device)
+
+
+def best_state():
+    return {'src_best_val_mIOU': src_best_val_mIOU, 'src_best_val_acc': src_best_val_acc,
+            'src_best_val_loss': src_best_val_loss, 'trgt_best_val_mIOU': trgt_best_val_mIOU,
+            'trgt_best_val_acc': trgt_best_val_acc, 'trgt_best_val_loss': trgt_best_val_loss,
+            'best_val_epoch': best_val_epoch}
+
+
+def epoch_state():
+    return {'loss_tracker': loss_tracker.state_dict(), 'step': step,
+            'stats': (src_mIOU, src_accuracy, batch_idx, src_count, trgt_count)}
+
+
+ckpt = CheckpointManager(io.path, keep_last=args.keep_checkpoints, write=is_main_process())
+start_epoch = start_step = 0
+resumed = ckpt.resume(model, opt, scheduler, scaler=scaler) if args.resume else None
+if resumed is not None:
+    start_epoch, start_step = resumed['epoch'], resumed['step']
+    extra = resumed['extra']
+    src_best_val_mIOU, src_best_val_acc = extra['src_best_val_mIOU'], extra['src_best_val_acc']
+    src_best_val_loss, trgt_best_val_mIOU = extra['src_best_val_loss'], extra['trgt_best_val_mIOU']
+    trgt_best_val_acc, trgt_best_val_loss = extra['trgt_best_val_acc'], extra['trgt_best_val_loss']
+    best_val_epoch = extra['best_val_epoch']
+    step = extra.get('step', start_epoch * len(src_train_loader))
+    io.cprint("Resuming from epoch %d, step %d" % (start_epoch, start_step))
+else:
+    ckpt.save(0, 0, model, opt, scheduler, extra=dict(best_state(), step=step), is_best=True, scaler=scaler)
 
-for epoch in range(args.epochs):
+for epoch in range(start_epoch, args.epochs):
     model.train()
+    epoch_start = time.perf_counter()
+
+    # continue an interrupted epoch without replaying its first batches
+    skip = start_step if epoch == start_epoch else 0
+    for sampler in (src_train_sampler, trgt_train_sampler):
+        sampler.set_epoch(epoch)
+        sampler.set_start(skip if isinstance(sampler, BatchSampler) else skip * batch_size)
 
     # init data structures for saving epoch stats
     # Run on cpu or gpu
-    src_seg_loss = src_mIOU = src_accuracy = 0.0
-    trgt_rec_loss = total_loss = 0.0
-    batch_idx = src_count = trgt_count = 0
+    if skip > 0 and 'loss_tracker' in resumed['extra']:
+        loss_tracker.load_state_dict(resumed['extra']['loss_tracker'])
+        src_mIOU, src_accuracy, batch_idx, src_count, trgt_count = resumed['extra']['stats']
+    else:
+        src_mIOU = src_accuracy = 0.0
+        loss_tracker.reset('src', ['seg'])
+        loss_tracker.reset('trgt', ['DefRec'])
+        batch_idx = src_count = trgt_count = 0
 
-    for k, data in enumerate(zip(src_train_loader, trgt_train_loader)):
+    for k, data in enumerate(profiler.iterate(zip(src_train_loader, trgt_train_loader), 'data'), start=skip):
         step += 1
         opt.zero_grad()
-        trgt_batch_loss = src_batch_loss = batch_mIOU = batch_seg_acc = 0.0
+        batch_mIOU = batch_seg_acc = 0.0
+        # the batches are copied to the device once, the branches below use views of them
+        src, trgt = (batch.to(device) if batch is not None else None for batch in data)
 
         #### source data ####
-        if data[0] is not None:
-            src_data, src_labels = data[0][0].to(device), data[0][1].to(device)
-
-            # change to [batch_size, num_coordinates, num_points]
-            src_data = src_data.permute(0, 2, 1)
-            batch_size = src_data.shape[0]
+        if src is not None:
+            src_data, src_labels, src_valid = src.points, src.labels, src.valid
+            batch_size = len(src)
 
+            # the mixing is drawn for the full batch, forward/backward run per micro-batch
             if args.apply_PCM:
-                src_data, src_labels = PCM.mix_shapes_segmentation(args, src_data, src_labels)
-
-            logits = model(src_data, make_seg=True, activate_DefRec=False)
-            loss = (1 - args.DefRec_weight) * criterion(logits['seg'].permute(0, 2, 1), src_labels)
-            loss.backward()
-
-            src_batch_loss = loss.item()
-            src_seg_loss += loss.item() * batch_size
-            total_loss += loss.item() * batch_size
-
-            # evaluation metrics
-            preds = logits['seg'].max(dim=2)[1]
-
-            batch_mIOU, batch_seg_acc = seg_metrics(src_labels, preds)
-            src_mIOU += batch_mIOU
-            src_accuracy += batch_seg_acc
+                src_valid = None  # the mixes are made of points of the shapes
+                if args.worker_augment:
+                    src_data, src_labels = src.mixed, src.labels_a
+                else:
+                    src_data, src_labels = PCM.mix_shapes_segmentation(args, src_data, src_labels)
+
+            for mb in micro_batch_slices(batch_size, args.accum_steps):
+                with no_sync(model, mb.stop == batch_size):
+                    with profiler.stage('forward'), autocast(args, device):
+                        logits = model(src_data[mb], make_seg=True, activate_DefRec=False,
+                                       valid=None if src_valid is None else src_valid[mb])
+                        loss = (1 - args.DefRec_weight) * criterion(logits['seg'].permute(0, 2, 1), src_labels[mb])
+                    with profiler.stage('backward'):
+                        scaler.scale(loss * (mb.stop - mb.start) / batch_size).backward()
+                    loss_tracker.update('src', 'seg', loss, mb.stop - mb.start)
+
+                    # evaluation metrics
+                    preds = logits['seg'].max(dim=2)[1]
+
+                    with profiler.stage('metrics'):
+                        batch_mIOU, batch_seg_acc = seg_metrics(src_labels[mb], preds)
+                    src_mIOU += batch_mIOU
+                    src_accuracy += batch_seg_acc
             src_count += batch_size
+            loss_tracker.count('src', batch_size)
 
         #### target data ####
-        if data[1] is not None:
-            trgt_data, trgt_labels = data[1][0].to(device), data[1][1].to(device)
-            trgt_data = trgt_data.permute(0, 2, 1)
-            batch_size = trgt_data.shape[0]
-            trgt_data_orig = trgt_data.clone()
-
-            trgt_data, trgt_mask = DefRec.deform_input(trgt_data, lookup, args.DefRec_dist, device=device)
-            logits = model(trgt_data, make_seg=False, activate_DefRec=True)
-            loss = DefRec.calc_loss(args, logits, trgt_data_orig, trgt_mask)
-
-            trgt_batch_loss = loss.item()
-            trgt_rec_loss += loss.item() * batch_size
-            total_loss += loss.item() * batch_size
-            loss.backward()
+        if trgt is not None:
+            trgt_data_orig = trgt.points
+            batch_size = len(trgt)
+
+            if args.worker_augment:
+                trgt_data, trgt_mask = trgt.deformed, trgt.mask
+            else:
+                # deformed in place, the original shapes are the reconstruction targets
+                trgt_data, trgt_mask = DefRec.deform_input(trgt_data_orig.clone(), lookup, args.DefRec_dist,
+                                                           device=device, valid=trgt.valid)
+            for mb in micro_batch_slices(batch_size, args.accum_steps):
+                with no_sync(model, mb.stop == batch_size):
+                    with profiler.stage('forward'), autocast(args, device):
+                        logits = model(trgt_data[mb], make_seg=False, activate_DefRec=True, valid=trgt.valid_mask(mb))
+                        loss = DefRec.calc_loss(args, logits, trgt_data_orig[mb], trgt_mask[mb])
+                    loss_tracker.update('trgt', 'DefRec', loss, mb.stop - mb.start)
+                    with profiler.stage('backward'):
+                        scaler.scale(loss * (mb.stop - mb.start) / batch_size).backward()
 
             trgt_count += batch_size
+            loss_tracker.count('trgt', batch_size)
 
         batch_idx += 1
-        opt.step()
+        with profiler.stage('optimizer'):
+            scaler.step(opt)
+            scaler.update()
+        profiler.end_step(k + 1)
+
+        if args.ckpt_interval > 0 and (k + 1) % args.ckpt_interval == 0:
+            with profiler.stage('checkpoint'):
+                ckpt.save(epoch, k + 1, model, opt, scheduler, extra=dict(best_state(), **epoch_state()), scaler=scaler)
+        if args.max_steps > 0 and k + 1 - skip >= args.max_steps:
+            break
 
     scheduler.step(epoch=epoch)
 
     # print progress
-    trgt_rec_loss /= trgt_count
-    src_seg_loss /= src_count
+    trgt_rec_loss = loss_tracker.flush('trgt')['DefRec']
+    src_seg_loss = loss_tracker.flush('src')['seg']
+    stats = torch.tensor([src_mIOU, src_accuracy, src_count], dtype=torch.float64, device=device)
+    src_mIOU, src_accuracy, src_count = all_reduce_sum(stats).cpu().tolist()
     src_mIOU /= src_count
     src_accuracy /= src_count
 
     #===================
     # Validation
     #===================
-    src_val_loss, src_val_miou, src_val_acc = test(src_val_loader)
-    trgt_val_loss, trgt_val_miou, trgt_val_acc = test(trgt_val_loader)
+    with profiler.stage('validation'):
+        src_val_loss, src_val_miou, src_val_acc = test(src_val_loader)
+        trgt_val_loss, trgt_val_miou, trgt_val_acc = test(trgt_val_loader)
 
     # save model according to best source model (since we don't have target labels)
-    if src_val_loss < src_best_val_loss:
+    is_best = src_val_loss < src_best_val_loss
+    if is_best:
         src_best_val_mIOU = src_val_miou
         src_best_val_acc = src_val_acc
         src_best_val_loss = src_val_loss
@@ -282,7 +493,8 @@ for epoch in range(args.epochs):
         trgt_best_val_acc = trgt_val_acc
         trgt_best_val_loss = trgt_val_loss
         best_val_epoch = epoch
-        best_model = copy.deepcopy(model)
+    with profiler.stage('checkpoint'):
+        ckpt.save(epoch + 1, 0, model, opt, scheduler, extra=dict(best_state(), step=step), is_best=is_best, scaler=scaler)
 
     io.cprint(f"Epoch: {epoch}, "
               f"Target train rec loss: {trgt_rec_loss:.5f}, "
@@ -299,6 +511,7 @@ for epoch in range(args.epochs):
               f"Target val seg loss: {trgt_val_loss:.5f}, "
               f"Target val seg mIOU: {trgt_val_miou:.5f}, "
               f"Target val seg accuracy: {trgt_val_acc:.5f}")
+    profiler.log(io, epoch, time.perf_counter() - epoch_start)
 
 io.cprint("Best model was found at epoch %d\n"
           "source val seg loss: %.4f, source val seg mIOU: %.4f, source val seg accuracy: %.4f\n"
@@ -310,7 +523,12 @@ io.cprint("Best model was found at epoch %d\n"
 #===================
 # Test
 #===================
-model = best_model
+unwrap_model(model).load_state_dict(ckpt.best_state_dict())
 trgt_test_loss, trgt_test_miou, trgt_test_acc = test(trgt_test_loader)
 io.cprint("target test seg loss: %.4f, target test seg mIOU: %.4f, target test seg accuracy: %.4f"
-          % (trgt_test_loss, trgt_test_miou, trgt_test_acc))
\ No newline at end of file
+          % (trgt_test_loss, trgt_test_miou, trgt_test_acc))
+ckpt.close()
+if pool is not None:
+    pool.close()
+io.close()
+cleanup()
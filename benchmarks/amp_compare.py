@@ -0,0 +1,106 @@
+"""
+Compare fp32 and mixed precision (autocast) training/inference of the point cloud models:
+throughput (samples/s), peak memory and agreement of the predictions with fp32.
+Each precision runs in its own process, so the peak RSS on cpu is not shared between them.
+Accuracy on the real datasets is obtained by running the trainers with and without --amp.
+
+    python -m benchmarks.amp_compare --models dgcnn,pointnet,seg --batch_size 32 --num_points 1024
+"""
+import argparse
+import json
+import torch
+from utils.amp_utils import autocast
+from benchmarks.common import model_args, build_model, synthetic_batch, TrainStep, time_steps, \
+    reset_peak_memory, peak_memory_mb, spawn_worker
+
+
+def run_precision(opt):
+    """
+    Benchmark one model in one precision, return a dict of results
+    """
+    device = torch.device(opt.device)
+    task = 'seg' if opt.model == 'seg' else 'cls'
+    args = model_args(task, device, model=opt.model if task == 'cls' else 'dgcnn', amp=opt.amp,
+                      amp_dtype=opt.amp_dtype)
+    torch.manual_seed(opt.seed)
+    model = build_model(args, task).to(device)
+    x, y = synthetic_batch(task, opt.batch_size, opt.num_points, device)
+
+    # predictions of the initial weights in eval mode, compared with the fp32 run by the parent
+    model.eval()
+    with torch.no_grad(), autocast(args, device):
+        logits = model(x, make_seg=True, activate_DefRec=False)['seg'] if task == 'seg' \
+            else model(x, activate_DefRec=False)['cls']
+    logits = logits.float().cpu()
+
+    reset_peak_memory(device)
+    with torch.no_grad():
+        def infer():
+            with autocast(args, device):
+                model(x, activate_DefRec=False)
+        infer_time = time_steps(infer, opt.steps, opt.warmup, device)
+
+    model.train()
+    step = TrainStep(model, args, task, device)
+    train_time = time_steps(lambda: step(x, y), opt.steps, opt.warmup, device)
+    return {'model': opt.model,
+            'precision': (opt.amp_dtype if device.type == 'cuda' else 'bf16') if opt.amp else 'fp32',
+            'train_samples_per_s': opt.batch_size / train_time,
+            'infer_samples_per_s': opt.batch_size / infer_time,
+            'peak_memory_mb': peak_memory_mb(device),
+            'logits': logits.tolist()}
+
+
+def spawn(opt, model, amp):
+    argv = ['--models', model, '--device', opt.device, '--batch_size', opt.batch_size, '--num_points', opt.num_points,
+            '--steps', opt.steps, '--warmup', opt.warmup, '--seed', opt.seed, '--amp_dtype', opt.amp_dtype]
+    return spawn_worker('benchmarks.amp_compare', argv + (['--amp'] if amp else []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fp32 vs mixed precision comparison')
+    parser.add_argument('--models', type=str, default='dgcnn,pointnet,seg', help='dgcnn, pointnet, seg')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=10, help='timed steps')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--amp', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--amp_dtype', type=str, default='fp16', choices=['fp16', 'bf16'],
+                        help='autocast dtype on cuda (cpu always uses bf16)')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--out', type=str, default='', help='also write the report as json')
+    opt = parser.parse_args()
+
+    if opt.worker:
+        opt.model = opt.models
+        print(json.dumps(run_precision(opt)))
+        return
+
+    report = []
+    print("%-9s %-6s %14s %14s %10s %10s %12s" % ('model', 'prec', 'train smp/s', 'infer smp/s',
+                                                 'peak MB', 'pred agree', 'max |dlogit|'))
+    for model in opt.models.split(','):
+        ref = spawn(opt, model, amp=False)
+        res = spawn(opt, model, amp=True)
+        ref_logits, logits = torch.tensor(ref.pop('logits')), torch.tensor(res.pop('logits'))
+        ref['pred_agreement'], ref['max_abs_logit_diff'] = 1.0, 0.0
+        res['pred_agreement'] = (ref_logits.argmax(-1) == logits.argmax(-1)).float().mean().item()
+        res['max_abs_logit_diff'] = (ref_logits - logits).abs().max().item()
+        for r in (ref, res):
+            print("%-9s %-6s %14.1f %14.1f %10.1f %10.4f %12.4g" % (
+                r['model'], r['precision'], r['train_samples_per_s'], r['infer_samples_per_s'],
+                r['peak_memory_mb'], r['pred_agreement'], r['max_abs_logit_diff']))
+            report.append(r)
+        print("%-9s speedup train x%.2f, infer x%.2f, memory x%.2f" % (
+            model, res['train_samples_per_s'] / ref['train_samples_per_s'],
+            res['infer_samples_per_s'] / ref['infer_samples_per_s'],
+            res['peak_memory_mb'] / ref['peak_memory_mb']))
+    if opt.out:
+        with open(opt.out, 'w') as f:
+            json.dump({'config': vars(opt), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
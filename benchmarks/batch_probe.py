@@ -0,0 +1,55 @@
+"""
+Largest batch size per point count that fits under a memory budget, for training (DefRec and PCM
+branches, forward + backward + optimizer step) and evaluation (forward), with its samples/s.
+
+    python -m benchmarks.batch_probe --models dgcnn,pointnet,seg --points 1024,2048 --memory_fraction 0.9
+"""
+import argparse
+import json
+import torch
+from utils.batch_probe import probe, memory_budget_mb
+from benchmarks.common import model_args, build_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='max batch size / point count probe')
+    parser.add_argument('--models', type=str, default='dgcnn,pointnet,seg', help='dgcnn, pointnet, seg')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--points', type=str, default='1024,2048', help='comma delimited point counts')
+    parser.add_argument('--modes', type=str, default='train,eval')
+    parser.add_argument('--budget_mb', type=float, default=0, help='memory budget (0 - memory_fraction of the device)')
+    parser.add_argument('--memory_fraction', type=float, default=0.9)
+    parser.add_argument('--min_batch', type=int, default=2)
+    parser.add_argument('--max_batch', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=2, help='timed steps per configuration')
+    parser.add_argument('--jdot', action='store_true', help='include the DeepJDOT pass (classification)')
+    parser.add_argument('--amp', action='store_true')
+    parser.add_argument('--checkpoint_edgeconv', action='store_true')
+    parser.add_argument('--out', type=str, default='', help='also write the report as json')
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    budget_mb = opt.budget_mb if opt.budget_mb > 0 else memory_budget_mb(device, opt.memory_fraction)
+    print("memory budget: %.0f MB on %s" % (budget_mb, device))
+    print("%-9s %-6s %7s %10s %10s %12s" % ('model', 'mode', 'points', 'max batch', 'peak MB', 'samples/s'))
+    report = []
+    for name in opt.models.split(','):
+        task = 'seg' if name == 'seg' else 'cls'
+        args = model_args(task, device, model=name if task == 'cls' else 'dgcnn', amp=opt.amp,
+                          checkpoint_edgeconv=opt.checkpoint_edgeconv)
+        model = build_model(args, task)
+        results = probe(model, args, task, device, point_counts=[int(n) for n in opt.points.split(',')],
+                        modes=opt.modes.split(','), budget_mb=budget_mb, min_batch=opt.min_batch,
+                        max_batch=opt.max_batch, steps=opt.steps, jdot=opt.jdot)
+        for r in results:
+            r['model'] = name
+            report.append(r)
+            print("%-9s %-6s %7d %10d %10.1f %12.1f" % (name, r['mode'], r['num_points'], r['batch_size'],
+                                                       r['peak_memory_mb'], r['samples_per_s']))
+    if opt.out:
+        with open(opt.out, 'w') as f:
+            json.dump({'config': vars(opt), 'budget_mb': budget_mb, 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
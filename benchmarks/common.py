@@ -0,0 +1,53 @@
+"""
+Shared helpers of the benchmark scripts.
+Run them from the repository root, e.g. python -m benchmarks.amp_compare
+"""
+import json
+import subprocess
+import sys
+from types import SimpleNamespace
+import torch
+from PointDA.Models import PointNet, DGCNN
+from PointSegDA.Models import DGCNN_DefRec
+from utils.batch_probe import NUM_CLASSES, synthetic_batch, synchronize, reset_peak_memory, peak_memory_mb, \
+    time_steps, TrainStep  # noqa: F401 re-exported for the benchmark scripts
+
+# defaults of the command line arguments of the trainers
+CLS_ARGS = dict(model='dgcnn', dropout=0.5, use_sigmoid=True, DeepJDOT_head=False, DefRec_weight=0.5,
+                mixup_params=1.0, DefRec_dist='volume_based_voxels', num_regions=3, gpus=[0],
+                amp=False, amp_dtype='fp16', checkpoint_edgeconv=False)
+SEG_ARGS = dict(model='dgcnn', dropout=0.5, DefRec_weight=0.05, mixup_params=1.0, DefRec_dist='volume_based_radius',
+                num_regions=3, gpus=[0], amp=False, amp_dtype='fp16', checkpoint_edgeconv=False)
+
+
+def model_args(task='cls', device=torch.device('cpu'), **overrides):
+    """
+    Input:
+        task - cls (PointDA) or seg (PointSegDA)
+        overrides - command line arguments that differ from the trainer defaults
+    Return:
+        args namespace for the models and the DefRec/PCM functions
+    """
+    args = dict(CLS_ARGS if task == 'cls' else SEG_ARGS)
+    args.update(overrides)
+    args = SimpleNamespace(**args)
+    args.cuda = device.type == 'cuda'
+    if not args.cuda:
+        args.gpus = [-1]
+    return args
+
+
+def build_model(args, task='cls'):
+    if task == 'seg':
+        return DGCNN_DefRec(args, in_size=3, num_classes=NUM_CLASSES['seg'])
+    return PointNet(args) if args.model == 'pointnet' else DGCNN(args)
+
+
+def spawn_worker(module, argv):
+    """
+    Run "python -m module --worker argv" in a fresh process (own peak memory) and return the json
+    dict printed on its last output line
+    """
+    cmd = [sys.executable, '-m', module, '--worker'] + [str(a) for a in argv]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
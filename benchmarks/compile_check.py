@@ -0,0 +1,79 @@
+"""
+Check that torch.compile (and torch.jit.trace) versions of the models give the eager outputs, and
+compare their inference and training step times.
+
+    python -m benchmarks.compile_check --models dgcnn,pointnet,seg --batch_size 16 --num_points 1024
+"""
+import argparse
+import json
+import torch
+from utils.compile_utils import check_compiled
+from benchmarks.common import model_args, build_model, synthetic_batch, TrainStep, time_steps
+
+
+def forward_kwargs(task):
+    return {'make_seg': True, 'activate_DefRec': True} if task == 'seg' else {'activate_DefRec': True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compiled vs eager check')
+    parser.add_argument('--models', type=str, default='dgcnn,pointnet,seg', help='dgcnn, pointnet, seg')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--compile_mode', type=str, default='default',
+                        choices=['default', 'reduce-overhead', 'max-autotune'])
+    parser.add_argument('--steps', type=int, default=5, help='timed steps')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed steps (include the compilation)')
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--rtol', type=float, default=1e-3)
+    parser.add_argument('--trace', action='store_true', help='also check a torch.jit.trace of the eval forward')
+    parser.add_argument('--out', type=str, default='', help='also write the report as json')
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    mode = None if opt.compile_mode == 'default' else opt.compile_mode
+    report = []
+    print("%-9s %-8s %8s %12s %12s %12s" % ('model', 'variant', 'match', 'max |diff|', 'infer smp/s', 'train smp/s'))
+    for name in opt.models.split(','):
+        task = 'seg' if name == 'seg' else 'cls'
+        args = model_args(task, device, model=name if task == 'cls' else 'dgcnn')
+        torch.manual_seed(1)
+        model = build_model(args, task).to(device)
+        x, y = synthetic_batch(task, opt.batch_size, opt.num_points, device)
+        kwargs = forward_kwargs(task)
+
+        variants = [('eager', model), ('compiled', torch.compile(model, mode=mode))]
+        if opt.trace:
+            # the traced graph is the eval forward with the default options of the model
+            model.eval()
+            with torch.no_grad():
+                variants.append(('traced', torch.jit.trace(model, (x,), strict=False)))
+        for variant, net in variants:
+            traced = variant == 'traced'
+            max_diff, match = check_compiled(model, net, x, opt.atol, opt.rtol, **({} if traced else kwargs))
+
+            def infer():
+                with torch.no_grad():
+                    net(x) if traced else net(x, activate_DefRec=False)
+            model.eval()
+            infer_time = time_steps(infer, opt.steps, opt.warmup, device)
+            train_sps = float('nan')
+            if not traced:
+                model.train()
+                step = TrainStep(net, args, task, device)
+                train_sps = opt.batch_size / time_steps(lambda: step(x, y), opt.steps, opt.warmup, device)
+            res = {'model': name, 'variant': variant, 'match': match, 'max_abs_diff': max_diff,
+                   'infer_samples_per_s': opt.batch_size / infer_time, 'train_samples_per_s': train_sps}
+            report.append(res)
+            print("%-9s %-8s %8s %12.3g %12.1f %12.1f" % (name, variant, match, max_diff,
+                                                          res['infer_samples_per_s'], train_sps))
+    if opt.out:
+        with open(opt.out, 'w') as f:
+            json.dump({'config': vars(opt), 'results': report}, f, indent=2)
+    if not all(r['match'] for r in report):
+        raise SystemExit("compiled outputs do not match the eager outputs")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Memory/time trade-off of recomputing the EdgeConv blocks in backward (--checkpoint_edgeconv).
+For every model and batch size a training step (PCM on the source, DefRec on the target) is timed
+with and without checkpointing, each in its own process, and the peak memory is reported
+(torch allocator on cuda, process RSS on cpu). Out of memory runs are reported as OOM.
+
+    python -m benchmarks.edgeconv_checkpoint --models seg --batch_sizes 16,32,64 --num_points 2048
+"""
+import argparse
+import json
+import torch
+from benchmarks.common import model_args, build_model, synthetic_batch, TrainStep, time_steps, \
+    reset_peak_memory, peak_memory_mb, spawn_worker
+
+
+def run_config(opt):
+    device = torch.device(opt.device)
+    task = 'seg' if opt.model == 'seg' else 'cls'
+    args = model_args(task, device, model=opt.model if task == 'cls' else 'dgcnn', amp=opt.amp,
+                      checkpoint_edgeconv=opt.checkpoint_edgeconv)
+    torch.manual_seed(opt.seed)
+    res = {'model': opt.model, 'batch_size': opt.batch_size, 'num_points': opt.num_points,
+           'checkpoint_edgeconv': opt.checkpoint_edgeconv}
+    try:
+        model = build_model(args, task).to(device)
+        x, y = synthetic_batch(task, opt.batch_size, opt.num_points, device)
+        step = TrainStep(model, args, task, device)
+        reset_peak_memory(device)
+        step_time = time_steps(lambda: step(x, y), opt.steps, opt.warmup, device)
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        res['oom'] = True
+        return res
+    res.update({'oom': False, 'step_s': step_time, 'samples_per_s': opt.batch_size / step_time,
+                'peak_memory_mb': peak_memory_mb(device)})
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EdgeConv activation checkpointing trade-off')
+    parser.add_argument('--models', type=str, default='dgcnn,seg', help='dgcnn (PointDA) and/or seg (PointSegDA)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_sizes', type=str, default='16,32')
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=5, help='timed steps')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--amp', action='store_true', help='also use mixed precision')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--batch_size', type=int, default=16, help=argparse.SUPPRESS)
+    parser.add_argument('--checkpoint_edgeconv', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--out', type=str, default='', help='also write the report as json')
+    opt = parser.parse_args()
+
+    if opt.worker:
+        opt.model = opt.models
+        print(json.dumps(run_config(opt)))
+        return
+
+    report = []
+    print("%-6s %6s %7s %-5s %10s %12s %10s %9s %9s" % ('model', 'batch', 'points', 'ckpt', 'step s', 'samples/s',
+                                                       'peak MB', 'memory', 'time'))
+    for model in opt.models.split(','):
+        for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+            argv = ['--models', model, '--device', opt.device, '--batch_size', batch_size,
+                    '--num_points', opt.num_points, '--steps', opt.steps, '--warmup', opt.warmup, '--seed', opt.seed]
+            argv += ['--amp'] if opt.amp else []
+            ref = spawn_worker('benchmarks.edgeconv_checkpoint', argv)
+            res = spawn_worker('benchmarks.edgeconv_checkpoint', argv + ['--checkpoint_edgeconv'])
+            for r in (ref, res):
+                report.append(r)
+                if r['oom']:
+                    print("%-6s %6d %7d %-5s %10s" % (model, batch_size, opt.num_points, r['checkpoint_edgeconv'], 'OOM'))
+                    continue
+                rel_mem = rel_time = ''
+                if r is res and not ref['oom']:
+                    rel_mem = '%+.0f%%' % (100.0 * (res['peak_memory_mb'] / ref['peak_memory_mb'] - 1))
+                    rel_time = '%+.0f%%' % (100.0 * (res['step_s'] / ref['step_s'] - 1))
+                print("%-6s %6d %7d %-5s %10.3f %12.1f %10.1f %9s %9s" % (
+                    model, batch_size, opt.num_points, r['checkpoint_edgeconv'], r['step_s'], r['samples_per_s'],
+                    r['peak_memory_mb'], rel_mem, rel_time))
+    if opt.out:
+        with open(opt.out, 'w') as f:
+            json.dump({'config': vars(opt), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
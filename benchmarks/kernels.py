@@ -0,0 +1,247 @@
+"""
+Microbenchmarks of the geometry kernels (utils.pc_utils, DefRec, PCM, the DGCNN knn/graph features)
+over a grid of batch sizes and point counts on synthetic clouds. Every kernel and configuration
+reports the median/min time per call and the peak memory of one call above the start: torch allocator
+on cuda, process RSS on cpu, measured in a fresh process per configuration (in a warm process the
+allocator reuses freed pages and the RSS does not grow).
+A run can be saved as a json baseline and later runs compared with it: the script exits with status 1
+when a kernel is slower (min time, the least noisy statistic) or uses more memory than the baseline by more than the thresholds.
+
+    python -m benchmarks.kernels --batch_sizes 8,32 --points 1024,2048 --save_baseline kernels_cpu.json
+    python -m benchmarks.kernels --batch_sizes 8,32 --points 1024,2048 --baseline kernels_cpu.json
+    python -m benchmarks.kernels --devices cpu,cuda --kernels knn,chamfer_distance
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+import torch
+from types import SimpleNamespace
+from DefRec_and_PCM import DefRec, PCM
+from PointDA import Models
+from utils import pc_utils
+from utils.batch_probe import synthetic_batch, synchronize
+from utils.memory_tracker import host_rss, reset_host_peak
+from benchmarks.common import spawn_worker
+
+
+def kernel_setups(args):
+    """
+    Return: dict of kernel name to a setup function (x [B, 3, N], y [B], device) -> fn, with fn()
+    running the kernel once on the batch (inputs modified in place are cloned in fn)
+    """
+    def assign_region_to_point(x, y, device):
+        return lambda: pc_utils.assign_region_to_point(x, device)
+
+    def farthest_point_sample(x, y, device):
+        return lambda: pc_utils.farthest_point_sample(args, x, x.size(2) // 2)
+
+    def farthest_point_sample_np(x, y, device):
+        xyz = x.cpu().numpy()
+        return lambda: pc_utils.farthest_point_sample_np(xyz, xyz.shape[2] // 2)
+
+    def collapse_to_point(x, y, device):
+        def fn():
+            for b in range(x.size(0)):
+                pc_utils.collapse_to_point(x[b].clone(), device)
+        return fn
+
+    def deform_input(dist):
+        def setup(x, y, device):
+            lookup = torch.Tensor(pc_utils.region_mean(args.num_regions)).to(device)
+            return lambda: DefRec.deform_input(x.clone(), lookup, dist, device)
+        return setup
+
+    def chamfer_distance(x, y, device):
+        # point sets and deformed region mask [B, N, C], as in reconstruction_loss
+        lookup = torch.Tensor(pc_utils.region_mean(args.num_regions)).to(device)
+        _, mask = DefRec.deform_input(x.clone(), lookup, 'volume_based_voxels', device)
+        mask = mask.float().permute(0, 2, 1)
+        gold = x.permute(0, 2, 1)
+        pred = gold + 0.01 * torch.randn_like(gold)
+        return lambda: DefRec.chamfer_distance(gold, pred, mask)
+
+    def mix_shapes(x, y, device):
+        return lambda: PCM.mix_shapes(args, x, y)
+
+    def knn(x, y, device):
+        return lambda: Models.knn(x, k=args.k)
+
+    def graph_feature(channels):
+        def setup(x, y, device):
+            # channels > 3: features of the inner EdgeConv layers
+            features = x.repeat(1, -(-channels // 3), 1)[:, :channels].contiguous()
+            return lambda: Models.get_graph_feature(features, k=args.k)
+        return setup
+
+    return {'assign_region_to_point': assign_region_to_point,
+            'farthest_point_sample': farthest_point_sample,
+            'farthest_point_sample_np': farthest_point_sample_np,
+            'collapse_to_point': collapse_to_point,
+            'deform_input_voxels': deform_input('volume_based_voxels'),
+            'deform_input_radius': deform_input('volume_based_radius'),
+            'chamfer_distance': chamfer_distance,
+            'mix_shapes': mix_shapes,
+            'knn': knn,
+            'graph_feature': graph_feature(3),
+            'graph_feature_64': graph_feature(64)}
+
+
+def measure_time(fn, device, repeats, warmup, min_time):
+    """
+    Return: median and min seconds per call of fn over repeats measurements; a measurement runs fn
+    at least once and until min_time seconds passed
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    times = []
+    for _ in range(repeats):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            calls += 1
+            synchronize(device)
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        times.append(elapsed / calls)
+    return float(np.median(times)), float(np.min(times))
+
+
+def measure_memory(fn, device):
+    """
+    Return: peak memory of one call of fn above the memory at its start (MB)
+    """
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        fn()
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        reset_host_peak()
+        start = host_rss()[0]
+        fn()
+        peak = host_rss()[1]
+    return max(peak - start, 0) / 2 ** 20
+
+
+def result_key(r):
+    return "%s/%s/B%d/N%d" % (r['kernel'], r['device'], r['batch_size'], r['num_points'])
+
+
+def compare(results, baseline, time_threshold, memory_threshold, memory_slack_mb):
+    """
+    Return: lines describing the regressions of results against the baseline results
+    """
+    reference = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        ref = reference.get(result_key(r))
+        if ref is None:
+            continue
+        if r['min_ms'] > ref['min_ms'] * (1 + time_threshold):
+            regressions.append("%s: min time %.3f ms, baseline %.3f ms (+%.0f%%)"
+                               % (result_key(r), r['min_ms'], ref['min_ms'], 100 * (r['min_ms'] / ref['min_ms'] - 1)))
+        if r['memory_mb'] > ref['memory_mb'] * (1 + memory_threshold) + memory_slack_mb:
+            regressions.append("%s: memory %.1f MB, baseline %.1f MB"
+                               % (result_key(r), r['memory_mb'], ref['memory_mb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='geometry kernel microbenchmarks')
+    parser.add_argument('--kernels', type=str, default='all', help='comma delimited kernel names (all - every kernel)')
+    parser.add_argument('--devices', type=str, default='cpu', help='comma delimited devices, e.g. cpu,cuda')
+    parser.add_argument('--batch_sizes', type=str, default='8,32')
+    parser.add_argument('--points', type=str, default='1024,2048', help='comma delimited point counts')
+    parser.add_argument('--repeats', type=int, default=5, help='measurements per configuration (the median is kept)')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--min_time', type=float, default=0.05, help='minimum seconds per measurement')
+    parser.add_argument('--threads', type=int, default=0, help='torch cpu threads (0 - torch default)')
+    parser.add_argument('--k', type=int, default=Models.K, help='neighbours of knn/graph_feature')
+    parser.add_argument('--num_regions', type=int, default=3)
+    parser.add_argument('--mixup_params', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', type=str, default='', help='json baseline to compare with')
+    parser.add_argument('--save_baseline', type=str, default='', help='write the results as a json baseline')
+    parser.add_argument('--time_threshold', type=float, default=0.1,
+                        help='allowed relative increase of the min time over the baseline')
+    parser.add_argument('--memory_threshold', type=float, default=0.1,
+                        help='allowed relative increase of the memory over the baseline')
+    parser.add_argument('--memory_slack_mb', type=float, default=4.0,
+                        help='allowed absolute increase of the memory over the baseline (allocator/RSS noise)')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--batch_size', type=int, default=8, help=argparse.SUPPRESS)
+    parser.add_argument('--num_points', type=int, default=1024, help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    args = SimpleNamespace(k=opt.k, num_regions=opt.num_regions, mixup_params=opt.mixup_params)
+    setups = kernel_setups(args)
+
+    def setup(name, device, batch_size, num_points):
+        torch.manual_seed(opt.seed)
+        np.random.seed(opt.seed)
+        x, y = synthetic_batch('cls', batch_size, num_points, device)
+        return setups[name](x, y, device)
+
+    if opt.worker:  # memory of one configuration on cpu
+        fn = setup(opt.kernels, torch.device(opt.devices), opt.batch_size, opt.num_points)
+        print(json.dumps({'memory_mb': measure_memory(fn, torch.device(opt.devices))}))
+        return
+    names = list(setups) if opt.kernels == 'all' else opt.kernels.split(',')
+    unknown = [n for n in names if n not in setups]
+    if unknown:
+        parser.error("unknown kernels %s, choose from %s" % (unknown, ', '.join(setups)))
+
+    print("%-26s %-6s %5s %6s %11s %11s %10s" % ('kernel', 'device', 'B', 'N', 'median ms', 'min ms', 'memory MB'))
+    results = []
+    for device_name in opt.devices.split(','):
+        device = torch.device(device_name)
+        for name in names:
+            for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+                for num_points in [int(n) for n in opt.points.split(',')]:
+                    fn = setup(name, device, batch_size, num_points)
+                    median, minimum = measure_time(fn, device, opt.repeats, opt.warmup, opt.min_time)
+                    if device.type == 'cuda':
+                        memory = measure_memory(fn, device)
+                    else:
+                        memory = spawn_worker('benchmarks.kernels', [
+                            '--kernels', name, '--devices', device_name, '--batch_size', batch_size,
+                            '--num_points', num_points, '--threads', torch.get_num_threads(), '--k', opt.k,
+                            '--num_regions', opt.num_regions, '--mixup_params', opt.mixup_params,
+                            '--seed', opt.seed])['memory_mb']
+                    r = {'kernel': name, 'device': device.type, 'batch_size': batch_size, 'num_points': num_points,
+                         'median_ms': median * 1000, 'min_ms': minimum * 1000, 'memory_mb': memory}
+                    results.append(r)
+                    print("%-26s %-6s %5d %6d %11.3f %11.3f %10.1f" % (name, device.type, batch_size, num_points,
+                                                                      r['median_ms'], r['min_ms'], memory))
+                    del fn
+
+    report = {'config': vars(opt), 'host': platform.node(), 'torch': torch.__version__,
+              'threads': torch.get_num_threads(), 'results': results}
+    if opt.save_baseline:
+        with open(opt.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    if opt.baseline:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('threads') != report['threads'] or baseline.get('torch') != report['torch']:
+            print("warning: baseline taken with torch %s and %s threads, this run torch %s and %s threads"
+                  % (baseline.get('torch'), baseline.get('threads'), report['torch'], report['threads']))
+        regressions = compare(results, baseline, opt.time_threshold, opt.memory_threshold, opt.memory_slack_mb)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            sys.exit(1)
+        print("no regression against %s" % opt.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Tune the data loader configuration (workers, prefetch depth, pinning, worker threads, persistent
+workers) of the train datasets on this host and persist the best one per dataset; the trainers load
+it automatically (--tuned_loader, default on). Same as running a trainer with --tune_loader.
+
+    python -m benchmarks.loader_tune --task cls --dataroot ./data --datasets shapenet,scannet,modelnet
+    python -m benchmarks.loader_tune --task seg --dataroot ./data/PointSegDAdataset --datasets adobe,faust
+"""
+import argparse
+import os
+import torch
+from types import SimpleNamespace
+from utils.loader_tuning import DEFAULT_TUNING_FILE, dataset_key, default_config, tune_loader, save_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='data loader autotuning')
+    parser.add_argument('--task', type=str, default='cls', choices=['cls', 'seg'])
+    parser.add_argument('--dataroot', type=str, default='./data')
+    parser.add_argument('--datasets', type=str, default='shapenet,scannet,modelnet')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='batches are copied to cuda devices (pinning is only tuned for them)')
+    parser.add_argument('--num_batches', type=int, default=20, help='batches per benchmark pass')
+    parser.add_argument('--epochs', type=int, default=2, help='benchmark passes (the worker startup is paid per pass)')
+    parser.add_argument('--max_workers', type=int, default=0, help='largest worker count tried (0 - cpu count)')
+    parser.add_argument('--loader_tuning_file', type=str, default=DEFAULT_TUNING_FILE)
+    opt = parser.parse_args()
+
+    io = SimpleNamespace(cprint=print)
+    device = torch.device(opt.device)
+    for name in opt.datasets.split(','):
+        if opt.task == 'cls':
+            from PointDA.data.dataloader import ScanNet, ModelNet, ShapeNet
+            dataset = {'modelnet': ModelNet, 'scannet': ScanNet, 'shapenet': ShapeNet}[name](io, opt.dataroot, 'train')
+            key = dataset_key('PointDA', opt.dataroot, name)
+            start = default_config(20)
+        else:
+            from PointSegDA.data.dataloader import datareader
+            dataset = datareader(opt.dataroot, dataset=name, partition='train', domain='source')
+            key = dataset_key('PointSegDA', opt.dataroot, name)
+            start = default_config(4)
+        print("Tuning the loader of %s (%d samples)" % (key, len(dataset)))
+        config, results = tune_loader(dataset, opt.batch_size, device, start=dict(start, num_workers=min(
+            start['num_workers'], os.cpu_count() or 1)), num_batches=opt.num_batches, epochs=opt.epochs,
+            max_workers=opt.max_workers or None)
+        save_config(key, config, results, opt.loader_tuning_file)
+        print("best: %s" % ', '.join('%s=%s' % kv for kv in sorted(config.items())))
+
+
+if __name__ == '__main__':
+    main()
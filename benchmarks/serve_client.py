@@ -0,0 +1,114 @@
+"""
+Load generator for the prediction server (serve.py): concurrent clients send random point clouds and
+the client side latency percentiles and throughput are reported, together with the server statistics.
+
+    python serve.py --checkpoint experiments/run/model.pt &
+    python -m benchmarks.serve_client --url http://127.0.0.1:8000 --clients 16 --requests 2000
+
+With --checkpoint the server is started (and stopped) by the client.
+"""
+import argparse
+import http.client
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import numpy as np
+
+
+def encode(points):
+    buf = io.BytesIO()
+    np.save(buf, points)
+    return buf.getvalue()
+
+
+def client(url, clouds, num_requests, latencies, errors):
+    """
+    Send num_requests requests over one keep-alive connection, appending the latencies (ms)
+    """
+    conn = http.client.HTTPConnection(url.hostname, url.port)
+    rng = np.random.default_rng(threading.get_ident() % (2 ** 32))
+    for _ in range(num_requests):
+        body = clouds[rng.integers(len(clouds))]
+        start = time.perf_counter()
+        conn.request('POST', '/predict', body=body, headers={'Content-Type': 'application/octet-stream'})
+        reply = conn.getresponse()
+        reply.read()
+        latencies.append((time.perf_counter() - start) * 1000)
+        if reply.status != 200:
+            errors.append(reply.status)
+    conn.close()
+
+
+def get_json(url, path):
+    conn = http.client.HTTPConnection(url.hostname, url.port)
+    conn.request('GET', path)
+    reply = json.loads(conn.getresponse().read())
+    conn.close()
+    return reply
+
+
+def wait_for_server(url, timeout=300):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            return get_json(url, '/health')
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError("server at %s did not start" % url.geturl())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='prediction server benchmark')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--checkpoint', type=str, default='', help='start a server for this checkpoint')
+    parser.add_argument('--server_args', type=str, default='', help='extra serve.py arguments')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent connections')
+    parser.add_argument('--requests', type=int, default=1000, help='total number of requests')
+    parser.add_argument('--points', type=int, nargs='+', default=[1024, 2048],
+                        help='point counts of the random clouds')
+    parser.add_argument('--out', type=str, default='', help='also write the report as json')
+    opt = parser.parse_args()
+
+    url = urllib.parse.urlparse(opt.url)
+    server = None
+    if opt.checkpoint:
+        server = subprocess.Popen([sys.executable, 'serve.py', '--checkpoint', opt.checkpoint,
+                                   '--host', url.hostname, '--port', str(url.port)] + opt.server_args.split())
+    try:
+        print("server: %s" % wait_for_server(url))
+        rng = np.random.default_rng(0)
+        clouds = [encode(rng.random((n, 3), dtype=np.float32)) for n in opt.points for _ in range(8)]
+        latencies, errors = [], []
+        per_client = [opt.requests // opt.clients + (i < opt.requests % opt.clients) for i in range(opt.clients)]
+        threads = [threading.Thread(target=client, args=(url, clouds, n, latencies, errors)) for n in per_client]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        report = {'clients': opt.clients, 'requests': len(latencies), 'errors': len(errors),
+                  'requests_per_s': len(latencies) / elapsed}
+        for p in (50, 90, 99):
+            report['client_p%d_ms' % p] = float(np.percentile(latencies, p))
+        report['server'] = get_json(url, '/stats')
+        print("%d requests from %d clients: %.1f requests/s, latency p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, "
+              "%d errors" % (report['requests'], opt.clients, report['requests_per_s'], report['client_p50_ms'],
+                             report['client_p90_ms'], report['client_p99_ms'], report['errors']))
+        print("server: %s" % json.dumps(report['server']))
+        if opt.out:
+            with open(opt.out, 'w') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Synthetic datasets in the on-disk layouts of the loaders, for running the trainers and the
+benchmarks without downloading PointDA-10 and PointSegDA:
+    <out>/PointDA_data/{modelnet,shapenet}/<class>/{train,test}/<i>.npy  [P, 3] points
+    <out>/PointDA_data/scannet/{train,test}_<k>.h5                       data [S, P, 6], label [S]
+    <out>/PointSegDAdataset/{adobe,faust,mit,scape}/{train,val,test}/<i>.npy  [P, 4], labels 1-8
+The shapes are made of class specific primitives (boxes, cylinders, ellipsoids) with random
+proportions, so the models learn them. ShapeNet and ScanNet are written y-up as the originals (the
+loaders rotate them), ScanNet is partial, noisy and has color channels. The segmentation shapes are
+humanoids with one label per body part.
+Pass --dataroot <out> to PointDA/trainer.py and --dataroot <out>/PointSegDAdataset to PointSegDA/trainer.py.
+
+    python -m benchmarks.synthetic_data --out ./data_synthetic --samples 100 --seg_samples 200
+"""
+import argparse
+import os
+import h5py
+import numpy as np
+from PointDA.data.dataloader import label_to_idx
+from utils.pc_utils import rotate_shape
+
+CLS_DOMAINS = ('modelnet', 'shapenet', 'scannet')
+SEG_DOMAINS = ('adobe', 'faust', 'mit', 'scape')
+
+# parts of the classes: (primitive, center, size) in a z-up frame
+LEGS = [('cylinder', (x, y, 0.25), (0.05, 0.05, 0.5)) for x in (-0.4, 0.4) for y in (-0.3, 0.3)]
+CLASS_PARTS = {
+    'bathtub': [('box', (0, 0, 0.25), (1.6, 0.8, 0.5))],
+    'bed': [('box', (0, 0, 0.2), (1.0, 2.0, 0.3)), ('box', (0, -0.95, 0.5), (1.0, 0.1, 0.6))],
+    'bookshelf': [('box', (0, 0, 0.9), (0.9, 0.35, 1.8))] +
+                 [('box', (0, 0, z), (0.85, 0.3, 0.03)) for z in (0.4, 0.8, 1.2, 1.6)],
+    'cabinet': [('box', (0, 0, 0.5), (0.8, 0.6, 1.0))],
+    'chair': [('box', (0, 0, 0.5), (0.9, 0.7, 0.08)), ('box', (0, -0.35, 0.95), (0.9, 0.08, 0.9))] + LEGS,
+    'lamp': [('cylinder', (0, 0, 0.75), (0.04, 0.04, 1.5)), ('ellipsoid', (0, 0, 1.5), (0.3, 0.3, 0.2)),
+             ('cylinder', (0, 0, 0.02), (0.25, 0.25, 0.04))],
+    'monitor': [('box', (0, 0, 0.7), (1.0, 0.05, 0.6)), ('cylinder', (0, 0, 0.2), (0.05, 0.05, 0.4)),
+                ('box', (0, 0, 0.01), (0.4, 0.25, 0.02))],
+    'plant': [('cylinder', (0, 0, 0.2), (0.25, 0.25, 0.4)), ('ellipsoid', (0, 0, 0.8), (0.45, 0.45, 0.45))],
+    'sofa': [('box', (0, 0, 0.2), (2.0, 0.9, 0.4)), ('box', (0, -0.4, 0.6), (2.0, 0.15, 0.5)),
+             ('box', (-0.95, 0, 0.45), (0.12, 0.9, 0.3)), ('box', (0.95, 0, 0.45), (0.12, 0.9, 0.3))],
+    'table': [('box', (0, 0, 0.55), (1.2, 0.8, 0.05))] + LEGS,
+}
+
+# humanoid body parts (label = position + 1)
+BODY_PARTS = [('ellipsoid', (0, 0, 1.65), (0.11, 0.11, 0.13)),    # head
+              ('box', (0, 0, 1.2), (0.4, 0.22, 0.6)),              # torso
+              ('cylinder', (-0.3, 0, 1.15), (0.05, 0.05, 0.6)),    # arms
+              ('cylinder', (0.3, 0, 1.15), (0.05, 0.05, 0.6)),
+              ('cylinder', (-0.11, 0, 0.5), (0.07, 0.07, 0.8)),    # legs
+              ('cylinder', (0.11, 0, 0.5), (0.07, 0.07, 0.8)),
+              ('box', (-0.11, 0.06, 0.04), (0.1, 0.25, 0.08)),     # feet
+              ('box', (0.11, 0.06, 0.04), (0.1, 0.25, 0.08))]
+
+
+def part_area(primitive, size):
+    a, b, c = size
+    if primitive == 'box':
+        return 2 * (a * b + b * c + a * c)
+    if primitive == 'cylinder':
+        return np.pi * (a + b) * c + np.pi * a * b
+    return 4 * np.pi * ((a * b) ** 1.6 / 3 + (a * c) ** 1.6 / 3 + (b * c) ** 1.6 / 3) ** (1 / 1.6)
+
+
+def sample_part(primitive, center, size, num_points, rng):
+    """
+    Return: num_points points on the surface of the primitive [num_points, 3]
+    """
+    half = np.asarray(size) / 2
+    if primitive == 'box':
+        pts = rng.uniform(-1, 1, (num_points, 3))
+        # project to a face chosen proportionally to its area
+        face_area = np.array([size[1] * size[2], size[0] * size[2], size[0] * size[1]])
+        axis = rng.choice(3, num_points, p=face_area / face_area.sum())
+        pts[np.arange(num_points), axis] = rng.choice([-1.0, 1.0], num_points)
+        pts = pts * half
+    elif primitive == 'cylinder':
+        angle = rng.uniform(0, 2 * np.pi, num_points)
+        radius = np.where(rng.uniform(size=num_points) < 0.8, 1.0, np.sqrt(rng.uniform(size=num_points)))
+        z = np.where(radius < 1.0, rng.choice([-1.0, 1.0], num_points), rng.uniform(-1, 1, num_points))
+        pts = np.stack([radius * np.cos(angle) * size[0], radius * np.sin(angle) * size[1], z * half[2]], axis=1)
+    else:  # ellipsoid with radii size
+        pts = rng.normal(size=(num_points, 3))
+        pts = pts / np.linalg.norm(pts, axis=1, keepdims=True) * np.asarray(size)
+    return pts + np.asarray(center)
+
+
+def sample_parts(parts, num_points, rng, jitter=0.1):
+    """
+    Sample the union of parts with random proportions (per axis scale and part size jitter)
+    Return: points [num_points, 3] and the part index of every point [num_points]
+    """
+    sizes = [np.asarray(size) * rng.uniform(1 - jitter, 1 + jitter, 3) for _, _, size in parts]
+    areas = np.array([part_area(p[0], s) for p, s in zip(parts, sizes)])
+    counts = rng.multinomial(num_points, areas / areas.sum())
+    points = [sample_part(p[0], p[1], s, n, rng) for p, s, n in zip(parts, sizes, counts)]
+    labels = np.concatenate([np.full(n, i) for i, n in enumerate(counts)])
+    points = np.concatenate(points) * rng.uniform(1 - jitter, 1 + jitter, 3)
+    perm = rng.permutation(num_points)
+    return points[perm].astype(np.float32), labels[perm]
+
+
+def classification_shape(class_name, domain, num_points, rng):
+    """
+    Return: a shape of class_name as stored by the domain dataset ([P, 6] with colors for scannet)
+    """
+    points, _ = sample_parts(CLASS_PARTS[class_name], num_points, rng)
+    if domain == 'scannet':
+        # partial scan: the points behind a random cut plane are replaced by visible ones
+        normal = rng.normal(size=3) * np.array([1, 1, 0.2])
+        visible = points.dot(normal) < np.percentile(points.dot(normal), rng.uniform(70, 100))
+        points = points[rng.choice(np.nonzero(visible)[0], num_points)]
+        points = points + rng.normal(scale=0.01, size=points.shape)
+        points = np.concatenate([points, rng.uniform(0, 1, (num_points, 3))], axis=1)
+    if domain != 'modelnet' and not (domain == 'shapenet' and class_name == 'plant'):
+        points[:, :3] = rotate_shape(points[:, :3], 'x', np.pi / 2)  # y-up, undone by the loaders
+    return points.astype(np.float32)
+
+
+def write_classification(root, domain, samples, test_fraction, num_points, rng, shard_size=2048):
+    """
+    Write samples train shapes per class and test_fraction of that test shapes of domain under root/PointDA_data
+    Return: number of written train and test shapes
+    """
+    domain_dir = os.path.join(root, 'PointDA_data', domain)
+    counts = {'train': samples, 'test': max(1, int(round(samples * test_fraction)))}
+    for partition, count in counts.items():
+        if domain == 'scannet':
+            data, label = [], []
+            for class_name, idx in label_to_idx.items():
+                for _ in range(count):
+                    data.append(classification_shape(class_name, domain, num_points, rng))
+                    label.append(idx)
+            order = rng.permutation(len(data))
+            data, label = np.stack(data)[order], np.asarray(label, dtype=np.int64)[order]
+            os.makedirs(domain_dir, exist_ok=True)
+            for k, start in enumerate(range(0, len(data), shard_size)):
+                with h5py.File(os.path.join(domain_dir, '%s_%d.h5' % (partition, k)), 'w') as f:
+                    f.create_dataset('data', data=data[start:start + shard_size])
+                    f.create_dataset('label', data=label[start:start + shard_size])
+        else:
+            for class_name in label_to_idx:
+                class_dir = os.path.join(domain_dir, class_name, partition)
+                os.makedirs(class_dir, exist_ok=True)
+                for i in range(count):
+                    np.save(os.path.join(class_dir, '%d.npy' % i),
+                            classification_shape(class_name, domain, num_points, rng))
+    return counts['train'] * len(label_to_idx), counts['test'] * len(label_to_idx)
+
+
+def write_segmentation(root, domain, samples, eval_fraction, num_points, rng):
+    """
+    Write samples train humanoids and eval_fraction of that val and test humanoids of domain under
+    root/PointSegDAdataset ([P, 4]: points and the body part label 1-8)
+    Return: number of written shapes per partition
+    """
+    # the domains differ in the proportions and the scan noise
+    jitter, noise = {'adobe': (0.1, 0.0), 'faust': (0.15, 0.003), 'mit': (0.2, 0.0), 'scape': (0.1, 0.006)}[domain]
+    counts = {'train': samples}
+    counts['val'] = counts['test'] = max(1, int(round(samples * eval_fraction)))
+    for partition, count in counts.items():
+        partition_dir = os.path.join(root, 'PointSegDAdataset', domain, partition)
+        os.makedirs(partition_dir, exist_ok=True)
+        for i in range(count):
+            points, parts = sample_parts(BODY_PARTS, num_points, rng, jitter)
+            points = points + rng.normal(scale=noise, size=points.shape) if noise else points
+            shape = np.concatenate([points, parts[:, None] + 1], axis=1).astype(np.float32)
+            np.save(os.path.join(partition_dir, '%d.npy' % i), shape)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic PointDA-10 / PointSegDA datasets')
+    parser.add_argument('--out', type=str, default='./data_synthetic')
+    parser.add_argument('--cls_domains', type=str, default=','.join(CLS_DOMAINS),
+                        help='comma delimited classification domains (empty - none)')
+    parser.add_argument('--seg_domains', type=str, default=','.join(SEG_DOMAINS),
+                        help='comma delimited segmentation domains (empty - none)')
+    parser.add_argument('--samples', type=int, default=100, help='train shapes per class of the classification domains')
+    parser.add_argument('--seg_samples', type=int, default=200, help='train shapes of the segmentation domains')
+    parser.add_argument('--test_fraction', type=float, default=0.25, help='test (and seg val) shapes per train shape')
+    parser.add_argument('--points', type=int, default=2048, help='points per classification shape')
+    parser.add_argument('--seg_points', type=int, default=2048, help='points per segmentation shape')
+    parser.add_argument('--shard_size', type=int, default=2048, help='shapes per ScanNet h5 shard')
+    parser.add_argument('--seed', type=int, default=0)
+    opt = parser.parse_args()
+
+    rng = np.random.default_rng(opt.seed)
+    for domain in filter(None, opt.cls_domains.split(',')):
+        train, test = write_classification(opt.out, domain, opt.samples, opt.test_fraction, opt.points, rng,
+                                           opt.shard_size)
+        print("%s: %d train, %d test shapes" % (domain, train, test))
+    for domain in filter(None, opt.seg_domains.split(',')):
+        counts = write_segmentation(opt.out, domain, opt.seg_samples, opt.test_fraction, opt.seg_points, rng)
+        print("%s: %s shapes" % (domain, ', '.join('%d %s' % (n, p) for p, n in counts.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+End-to-end training throughput of the trainer configurations on synthetic data (benchmarks.synthetic_data).
+Every configuration runs its trainer for --steps steps of one epoch with --profile in its own process
+and is reported with:
+    samples/s - source + target samples per second of the steps after the warmup steps
+    stages    - time per step of the profiled stages (data, forward, backward, optimizer, ...)
+    peak RSS  - peak resident memory of the trainer process
+    peak dev  - peak torch allocator memory (cuda, with --memory: the stages are memory tracked too)
+
+    python -m benchmarks.throughput --configs defrec,pcm,deepjdot,seg --steps 30 --batch_size 16
+    python -m benchmarks.throughput --dataroot ./data_synthetic --configs seg --gpus 0 --memory
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from benchmarks import synthetic_data
+
+# trainer and arguments of the configurations
+CONFIGS = {
+    'defrec': ('PointDA/trainer.py', ['--apply_PCM', 'False', '--DefRec_on_trgt', 'True', '--use_DeepJDOT', 'False']),
+    'pcm': ('PointDA/trainer.py', ['--apply_PCM', 'True', '--DefRec_on_trgt', 'False', '--use_DeepJDOT', 'False']),
+    'defrec_pcm': ('PointDA/trainer.py', ['--apply_PCM', 'True', '--DefRec_on_trgt', 'True',
+                                          '--use_DeepJDOT', 'False']),
+    'deepjdot': ('PointDA/trainer.py', ['--apply_PCM', 'False', '--DefRec_on_trgt', 'False',
+                                        '--use_DeepJDOT', 'True']),
+    'seg': ('PointSegDA/trainer.py', []),
+}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate_data(dataroot, opt):
+    """
+    Write the synthetic datasets the configurations need under dataroot, if missing
+    """
+    rng = np.random.default_rng(opt.seed)
+    for domain in (opt.src_dataset, opt.trgt_dataset):
+        if not os.path.exists(os.path.join(dataroot, 'PointDA_data', domain)):
+            synthetic_data.write_classification(dataroot, domain, opt.samples, 0.1, 2048, rng)
+    for domain in (opt.seg_src_dataset, opt.seg_trgt_dataset):
+        if not os.path.exists(os.path.join(dataroot, 'PointSegDAdataset', domain)):
+            synthetic_data.write_segmentation(dataroot, domain, opt.samples * 4, 0.1, 2048, rng)
+
+
+def run_config(name, opt, dataroot, out_path):
+    """
+    Run the trainer of configuration name
+    Return: (return code, peak RSS of the process in MB)
+    """
+    script, config_args = CONFIGS[name]
+    seg = script.startswith('PointSegDA')
+    argv = [sys.executable, os.path.join(ROOT, script),
+            '--dataroot', os.path.join(dataroot, 'PointSegDAdataset') if seg else dataroot,
+            '--src_dataset', opt.seg_src_dataset if seg else opt.src_dataset,
+            '--trgt_dataset', opt.seg_trgt_dataset if seg else opt.trgt_dataset,
+            '--epochs', '1', '--max_steps', str(opt.steps), '--batch_size', str(opt.batch_size),
+            '--gpus', opt.gpus, '--out_path', out_path, '--exp_name', name, '--metrics_backends', 'jsonl',
+            '--profile', 'True', '--profile_memory', str(opt.memory)]
+    if not seg:
+        argv += ['--model', opt.model]
+    argv += config_args + opt.trainer_args
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    with open(os.path.join(out_path, name + '.out'), 'w') as log:
+        process = subprocess.Popen(argv, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, rusage.ru_maxrss / 1024
+
+
+def analyze(trace_path, memory_path, steps, warmup, batch_size):
+    """
+    Return: samples/s and per stage ms per step of the steps after warmup, from the Chrome trace of
+    the run, and the peak device memory of the memory tracker rows (MB, None without them)
+    """
+    with open(trace_path) as f:
+        events = json.load(f)['traceEvents']
+    optimizer_ends = sorted(e['ts'] + e['dur'] for e in events if e['name'] == 'optimizer')
+    if len(optimizer_ends) <= warmup:
+        raise ValueError("%d steps in the trace, %d warmup steps" % (len(optimizer_ends), warmup))
+    start, end = (optimizer_ends[warmup - 1] if warmup > 0 else min(e['ts'] for e in events)), optimizer_ends[-1]
+    timed_steps = len(optimizer_ends) - warmup
+    stages = {}
+    for e in events:
+        if start <= e['ts'] and e['ts'] + e['dur'] <= end:
+            stages[e['name']] = stages.get(e['name'], 0.0) + e['dur'] / 1000 / timed_steps
+    samples_per_s = 2 * batch_size * timed_steps / ((end - start) / 1e6)  # source and target batches
+    peak_dev = None
+    if memory_path is not None and os.path.exists(memory_path):
+        with open(memory_path) as f:
+            rows = [json.loads(line) for line in f]
+        peak_dev = max((s['dev_peak'] for r in rows for s in r['stages'].values()), default=None)
+    return samples_per_s, dict(sorted(stages.items(), key=lambda kv: -kv[1])), peak_dev
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end trainer throughput on synthetic data')
+    parser.add_argument('--configs', type=str, default='defrec,pcm,deepjdot,seg',
+                        help='comma delimited configurations out of %s' % ', '.join(CONFIGS))
+    parser.add_argument('--dataroot', type=str, default='',
+                        help='synthetic data root (generated if missing; default - a temporary directory)')
+    parser.add_argument('--samples', type=int, default=40, help='train shapes per class of generated data')
+    parser.add_argument('--src_dataset', type=str, default='shapenet')
+    parser.add_argument('--trgt_dataset', type=str, default='scannet')
+    parser.add_argument('--seg_src_dataset', type=str, default='adobe')
+    parser.add_argument('--seg_trgt_dataset', type=str, default='faust')
+    parser.add_argument('--model', type=str, default='dgcnn', choices=['pointnet', 'dgcnn'])
+    parser.add_argument('--batch_size', type=int, default=16, help='batch size per domain')
+    parser.add_argument('--steps', type=int, default=20, help='train steps per configuration')
+    parser.add_argument('--warmup', type=int, default=3, help='steps left out of the measurement')
+    parser.add_argument('--gpus', type=str, default='-1', help='--gpus of the trainers (-1 - cpu)')
+    parser.add_argument('--memory', action='store_true', help='track the stage memory (slower steps)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default='', help='also write the report as json')
+    parser.add_argument('trainer_args', nargs=argparse.REMAINDER, help='more trainer arguments after --')
+    opt = parser.parse_args()
+    opt.trainer_args = [a for a in opt.trainer_args if a != '--']
+
+    names = opt.configs.split(',')
+    unknown = [n for n in names if n not in CONFIGS]
+    if unknown:
+        parser.error("unknown configurations %s" % unknown)
+    with tempfile.TemporaryDirectory() as tmp:
+        dataroot = opt.dataroot or os.path.join(tmp, 'data')
+        generate_data(dataroot, opt)
+        report = []
+        for name in names:
+            returncode, peak_rss = run_config(name, opt, dataroot, tmp)
+            result = {'config': name, 'returncode': returncode, 'peak_rss_mb': peak_rss}
+            run_dir = os.path.join(tmp, name)
+            if returncode != 0:
+                with open(os.path.join(tmp, name + '.out')) as f:
+                    result['error'] = f.read().strip().splitlines()[-1:]
+                print("%-10s failed (exit %d): %s" % (name, returncode, ' '.join(result['error'])))
+                report.append(result)
+                continue
+            samples_per_s, stages, peak_dev = analyze(os.path.join(run_dir, 'trace_rank0.json'),
+                                                      os.path.join(run_dir, 'memory_rank0.jsonl') if opt.memory
+                                                      else None, opt.steps, opt.warmup, opt.batch_size)
+            result.update({'samples_per_s': samples_per_s, 'stage_ms_per_step': stages, 'peak_dev_mb': peak_dev})
+            report.append(result)
+            print("%-10s %8.1f samples/s, peak RSS %7.0f MB%s" % (name, samples_per_s, peak_rss,
+                                                                  ", peak dev %7.0f MB" % peak_dev if peak_dev else ""))
+            for stage, ms in stages.items():
+                print("    %-20s %9.2f ms/step" % (stage, ms))
+    if opt.out:
+        with open(opt.out, 'w') as f:
+            json.dump({'config': vars(opt), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Export a trained model for inference: the BatchNorms are folded into the preceding conv/linear layers,
+dropout and the heads not needed for the predictions (DefRec, the unused classifier) are removed.
+The exported model is checked against the original on random inputs and both are timed.
+
+    python export.py --checkpoint experiments/DefRec_PCM/model.pt --out experiments/DefRec_PCM/model_export.pt
+
+The exported file is loaded by predict.py and serve.py like a checkpoint.
+"""
+import argparse
+import os
+import sys
+import torch
+from utils.batch_probe import synthetic_batch, time_steps
+from utils.compile_utils import compare_outputs
+from utils.export import export_model
+from utils.inference import load_config, load_state_dict, build_model, output_head
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a model for inference')
+    parser.add_argument('--checkpoint', type=str, required=True, help='model.pt or a training checkpoint')
+    parser.add_argument('--config', type=str, default=None, help='args.json of the run (default: of the experiment)')
+    parser.add_argument('--out', type=str, default='', help='exported model (default: <checkpoint>_export.pt)')
+    parser.add_argument('--head', type=str, default='', choices=['', 'cls', 'DeepJDOT', 'seg'],
+                        help='output head (default: the head used in test)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=16, help='batch size of the check and the timing')
+    parser.add_argument('--num_points', type=int, default=0, help='points per cloud (default: 1024 / 2048)')
+    parser.add_argument('--steps', type=int, default=10, help='timed forward passes')
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--rtol', type=float, default=1e-3)
+    opt = parser.parse_args()
+
+    config = load_config(opt.checkpoint, opt.config)
+    model, task = build_model(config)
+    model.load_state_dict(load_state_dict(opt.checkpoint))
+    model.eval()
+    head = opt.head or output_head(config, task)
+    exported, folded = export_model(model, task, head, config)
+
+    device = torch.device(opt.device)
+    model, exported = model.to(device), exported.to(device)
+    num_points = opt.num_points or (1024 if task == 'cls' else 2048)
+    torch.manual_seed(0)
+    x, _ = synthetic_batch(task, opt.batch_size, num_points, device)
+    kwargs = {'make_seg': True} if task == 'seg' else {}
+
+    def reference():
+        return model(x, activate_DefRec=False, **kwargs)[head]
+
+    with torch.no_grad():
+        max_diff, match = compare_outputs(reference(), exported(x), opt.atol, opt.rtol)
+        original_time = time_steps(reference, opt.steps, 2, device)
+        exported_time = time_steps(lambda: exported(x), opt.steps, 2, device)
+
+    out = opt.out or os.path.splitext(opt.checkpoint)[0] + '_export.pt'
+    torch.save(exported.cpu(), out)
+    print("%s head %s: %d BatchNorms folded, %d -> %d parameters" %
+          (task, head, folded, sum(p.numel() for p in model.parameters()),
+           sum(p.numel() for p in exported.parameters())))
+    print("outputs %s (max |diff| %.2e)" % ("match" if match else "DO NOT MATCH", max_diff))
+    print("forward %.2f ms -> %.2f ms (batch %d, %d points, %s)" %
+          (original_time * 1000, exported_time * 1000, opt.batch_size, num_points, device))
+    print("checkpoint %.1f MB -> %.1f MB (%s)" %
+          (os.path.getsize(opt.checkpoint) / 2 ** 20, os.path.getsize(out) / 2 ** 20, out))
+    if not match:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Batched inference with a trained checkpoint:
+
+    python predict.py --checkpoint experiments/DefRec_PCM/model.pt --inputs data/clouds/ --out predictions.npz
+
+Inputs are .npy files ([N, C], xyz first), .h5 files ('data' [M, N, C]), directories of them or text files
+listing them. The model is rebuilt from the args.json (or run.log) of the experiment. The output .npz holds
+the sample names and the predicted labels (classification), or the per point labels of all samples with
+their offsets (segmentation), and optionally the logits.
+"""
+import argparse
+import json
+from PointDA.data.dataloader import NUM_POINTS
+from utils.inference import Predictor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Point cloud inference')
+    parser.add_argument('--checkpoint', type=str, required=True, help='model.pt, a training checkpoint or an exported model')
+    parser.add_argument('--config', type=str, default=None, help='args.json of the run (default: of the experiment)')
+    parser.add_argument('--inputs', type=str, nargs='+', required=True, help='files, directories or file lists')
+    parser.add_argument('--out', type=str, default='predictions.npz', help='output .npz file')
+    parser.add_argument('--save_logits', action='store_true', help='also save the logits (float16)')
+    parser.add_argument('--device', type=str, default=None, help='cuda, cuda:1, cpu (default: cuda if available)')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--num_points', type=int, default=NUM_POINTS, help='points per shape (classification)')
+    parser.add_argument('--rotate', action='store_true', help='rotate -90 degrees around x (ScanNet/ShapeNet frame)')
+    parser.add_argument('--amp', action='store_true', help='mixed precision inference')
+    opt = parser.parse_args()
+
+    predictor = Predictor(opt.checkpoint, config=opt.config, device=opt.device, batch_size=opt.batch_size,
+                          num_workers=opt.num_workers, amp=opt.amp, num_points=opt.num_points, rotate=opt.rotate)
+    results = predictor.predict(opt.inputs, out_path=opt.out, save_logits=opt.save_logits)
+    stats = results['stats']
+    print("%s predictions of %d samples written to %s" % (predictor.task, stats['samples'], opt.out))
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Post training int8 quantization of a trained PointNet/DGCNN classifier for CPU inference.
+The model is exported first (BatchNorms folded, see export.py), then the 1x1 convs are statically quantized,
+calibrated on a sample of the source train set, and the linear layers are dynamically quantized.
+The accuracy on the test set of each domain and the latency are compared with the float model,
+for the dynamic, static and combined variants.
+
+    python quantize.py --checkpoint experiments/DefRec_PCM/model.pt --dataroot ./data
+
+The results are also appended to run.log of the experiment. The quantized model (--save variant)
+is loaded by predict.py and serve.py like a checkpoint.
+"""
+import argparse
+import os
+import warnings
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import SubsetRandomSampler
+import utils.log
+from PointDA.data.dataloader import ScanNet, ModelNet, ShapeNet, label_to_idx, NUM_POINTS
+from utils.batch_probe import time_steps
+from utils.export import export_model
+from utils.inference import load_config, load_state_dict, build_model, output_head
+from utils.metrics import ClassificationEvaluator
+from utils.quantization import quantize_model, quantized_state
+
+VARIANTS = {'dynamic': dict(static=False, dynamic=True),
+            'static': dict(static=True, dynamic=False),
+            'both': dict(static=True, dynamic=True)}
+data_func = {'modelnet': ModelNet, 'scannet': ScanNet, 'shapenet': ShapeNet}
+
+
+def evaluate(model, loader):
+    evaluator = ClassificationEvaluator(num_classes=len(label_to_idx))
+    with torch.no_grad():
+        for data, labels in loader:
+            evaluator.update(model(data.permute(0, 2, 1)), labels.view(-1))
+    return evaluator.compute()['acc']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='int8 quantization of a classifier')
+    parser.add_argument('--checkpoint', type=str, required=True, help='model.pt or a training checkpoint')
+    parser.add_argument('--config', type=str, default=None, help='args.json of the run (default: of the experiment)')
+    parser.add_argument('--dataroot', type=str, default='./data', help='data path')
+    parser.add_argument('--domains', type=str, nargs='+', default=['modelnet', 'shapenet', 'scannet'],
+                        help='domains whose test sets are evaluated')
+    parser.add_argument('--variants', type=str, nargs='+', default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument('--calib_samples', type=int, default=256, help='source train samples for calibration')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=0, help='cpu threads (default: torch default)')
+    parser.add_argument('--steps', type=int, default=10, help='timed forward passes')
+    parser.add_argument('--save', type=str, default='both', choices=list(VARIANTS), help='variant to save')
+    parser.add_argument('--out', type=str, default='', help='quantized model (default: <checkpoint>_int8.pt)')
+    parser.add_argument('--seed', type=int, default=1)
+    opt = parser.parse_args()
+
+    warnings.filterwarnings('ignore', module='torch.ao')  # deprecation notices of the eager mode quantization
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    np.random.seed(opt.seed)
+    torch.manual_seed(opt.seed)
+
+    config = load_config(opt.checkpoint, opt.config)
+    exp_dir = os.path.dirname(os.path.abspath(opt.checkpoint))
+    if os.path.basename(exp_dir) == 'checkpoints':
+        exp_dir = os.path.dirname(exp_dir)
+    io = utils.log.IOStream(argparse.Namespace(out_path=os.path.dirname(exp_dir), exp_name=os.path.basename(exp_dir)))
+
+    model, task = build_model(config)
+    if task != 'cls':
+        raise ValueError("quantization is supported for the classifiers, %s is a segmentation run" % opt.checkpoint)
+    model.load_state_dict(load_state_dict(opt.checkpoint))
+    head = output_head(config, task)
+    float_model, _ = export_model(model, task, head, config)
+
+    # calibration sample of the source train set
+    src_trainset = data_func[config.src_dataset](io, opt.dataroot, 'train')
+    calib_ind = np.random.choice(src_trainset.train_ind, min(opt.calib_samples, len(src_trainset.train_ind)),
+                                 replace=False)
+    calib_loader = DataLoader(src_trainset, num_workers=opt.num_workers, batch_size=opt.batch_size,
+                              sampler=SubsetRandomSampler(calib_ind))
+    calib_batches = [data.permute(0, 2, 1) for data, _ in calib_loader]
+    test_loaders = {d: DataLoader(data_func[d](io, opt.dataroot, 'test'), num_workers=opt.num_workers,
+                                  batch_size=opt.batch_size) for d in opt.domains}
+
+    x = calib_batches[0]
+    models = {'float': float_model}
+    for variant in opt.variants:
+        models[variant] = quantize_model(float_model, calib_batches, **VARIANTS[variant])
+
+    cpu = torch.device('cpu')
+    results = {}
+    for name, net in models.items():
+        with torch.no_grad():
+            latency = time_steps(lambda: net(x), opt.steps, 2, cpu)
+        results[name] = {'latency': latency, 'acc': {d: evaluate(net, loader) for d, loader in test_loaders.items()}}
+
+    io.cprint("int8 quantization of %s (%s, head %s, %d calibration samples, batch %d, %d points, %d threads)" %
+              (opt.checkpoint, config.model, head, len(calib_ind), x.size(0), NUM_POINTS, torch.get_num_threads()))
+    ref = results['float']
+    for name, res in results.items():
+        outstr = "%-8s latency %8.2f ms (x%.2f)" % (name, res['latency'] * 1000, ref['latency'] / res['latency'])
+        for d in opt.domains:
+            outstr += ", %s acc: %.4f (%+.4f)" % (d, res['acc'][d], res['acc'][d] - ref['acc'][d])
+        io.cprint(outstr)
+
+    quantized = models[opt.save] if opt.save in models else quantize_model(float_model, calib_batches,
+                                                                             **VARIANTS[opt.save])
+    out = opt.out or os.path.splitext(opt.checkpoint)[0] + '_int8.pt'
+    torch.save(quantized_state(quantized, config, head, **VARIANTS[opt.save]), out)
+    io.cprint("%s model saved to %s (%.1f MB)" % (opt.save, out, os.path.getsize(out) / 2 ** 20))
+    io.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Local prediction server: keeps a trained model resident and batches concurrent requests.
+
+    python serve.py --checkpoint experiments/DefRec_PCM/model.pt --port 8000
+
+    POST /predict   body: .npy file of a [N, 3] point cloud (application/octet-stream)
+                    or json {"points": [[x, y, z], ...]} (application/json)
+                    reply: {"label", "class_name"} (classification) or {"labels"} (segmentation)
+    GET  /stats     latency percentiles (queue wait, batch compute, total) and mean batch size
+    GET  /health
+
+Load it with python -m benchmarks.serve_client.
+"""
+import argparse
+import json
+from PointDA.data.dataloader import NUM_POINTS
+from utils.inference import Predictor
+from utils.serving import DEFAULT_BUCKETS, DynamicBatcher, PredictionServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Point cloud prediction server')
+    parser.add_argument('--checkpoint', type=str, required=True, help='model.pt, a training checkpoint or an exported model')
+    parser.add_argument('--config', type=str, default=None, help='args.json of the run (default: of the experiment)')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--device', type=str, default=None, help='cuda, cuda:1, cpu (default: cuda if available)')
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_latency_ms', type=float, default=5.0,
+                        help='longest wait of a request for others to join its batch')
+    parser.add_argument('--buckets', type=int, nargs='+', default=list(DEFAULT_BUCKETS),
+                        help='point count buckets, batches are padded to their bucket size')
+    parser.add_argument('--num_points', type=int, default=NUM_POINTS, help='points per shape (classification)')
+    parser.add_argument('--rotate', action='store_true', help='rotate -90 degrees around x (ScanNet/ShapeNet frame)')
+    parser.add_argument('--amp', action='store_true', help='mixed precision inference')
+    parser.add_argument('--return_logits', action='store_true', help='include the logits in the replies')
+    parser.add_argument('--no_warmup', action='store_true')
+    opt = parser.parse_args()
+
+    predictor = Predictor(opt.checkpoint, config=opt.config, device=opt.device, amp=opt.amp,
+                          num_points=opt.num_points, rotate=opt.rotate)
+    batcher = DynamicBatcher(predictor, opt.max_batch_size, opt.max_latency_ms, opt.buckets)
+    if not opt.no_warmup:
+        batcher.warmup()
+    server = PredictionServer((opt.host, opt.port), predictor, batcher, return_logits=opt.return_logits)
+    print("serving %s predictions on http://%s:%d" % (predictor.task, opt.host, server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print(json.dumps(batcher.stats.summary()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+import argparse
+import os
+import sys
+import pytest
+
+# the packages of the repository are imported from its root, as by the trainers and scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def cls_args():
+    """
+    Return: command line arguments of the classification models
+    """
+    def make(model='dgcnn'):
+        return argparse.Namespace(model=model, dropout=0.5, DeepJDOT_head=False, use_sigmoid=False,
+                                  amp=False, amp_dtype='fp16')
+    return make
+
+
+@pytest.fixture
+def seg_args():
+    return argparse.Namespace(model='dgcnn', dropout=0.5, amp=False, amp_dtype='fp16')
@@ -0,0 +1,117 @@
+import threading
+import pytest
+import torch
+import utils.checkpoint
+from utils.checkpoint import CheckpointManager
+from utils.inference import DevicePrefetcher
+from utils.log import MetricsSink
+
+
+class RecordingBackend():
+    def __init__(self):
+        self.records = []
+        self.closed = False
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        self.closed = True
+
+
+class FailingBackend(RecordingBackend):
+    def write(self, record):
+        raise OSError("disk full")
+
+
+def run_with_timeout(fn, timeout=20):
+    # a hang fails the test instead of blocking the suite
+    thread = threading.Thread(target=fn, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "blocked"
+
+
+@pytest.mark.parametrize('policy', ['block', 'drop'])
+def test_metrics_sink_survives_a_failing_backend(policy, capsys):
+    good = RecordingBackend()
+    sink = MetricsSink([FailingBackend(), good], max_queue=2, policy=policy)
+
+    def log_and_close():
+        for step in range(50):
+            sink.log({'loss': float(step)}, step=step)
+        sink.close()
+
+    run_with_timeout(log_and_close)
+    assert sink.failed['FailingBackend'] == len(good.records) == 50 - sink.dropped
+    assert good.closed
+    assert capsys.readouterr().err.count("FailingBackend failed to write") == 1
+
+
+def test_metrics_sink_merges_uncommitted_scalars():
+    backend = RecordingBackend()
+    sink = MetricsSink([backend])
+    sink.log({'a': 1.0}, step=3, commit=False)
+    sink.log({'b': 2.0}, step=3)
+    sink.close()
+    assert [r['metrics'] for r in backend.records] == [{'a': 1.0, 'b': 2.0}]
+    assert backend.records[0]['step'] == 3
+
+
+def test_checkpoint_write_failure_is_raised_not_hung(tmp_path, monkeypatch):
+    ckpt = CheckpointManager(str(tmp_path), keep_last=2)
+    model = torch.nn.Linear(2, 2)
+
+    def disk_full(obj, path):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(utils.checkpoint, 'atomic_save', disk_full)
+    ckpt.save(0, 1, model)
+    errors = []
+
+    def save_again():
+        try:
+            ckpt.save(0, 2, model)
+        except RuntimeError as e:
+            errors.append(e)
+
+    run_with_timeout(save_again)
+    assert len(errors) == 1 and isinstance(errors[0].__cause__, OSError)
+
+    # the writer is still alive, the next checkpoints are written
+    monkeypatch.undo()
+    ckpt.save(0, 3, model, is_best=True)
+    run_with_timeout(ckpt.close)
+    assert ckpt.latest().endswith('ckpt_0000_0000003.pt')
+    assert (tmp_path / 'model.pt').exists()
+
+
+def test_checkpoint_resume_roundtrip(tmp_path):
+    model = torch.nn.Linear(3, 2)
+    ckpt = CheckpointManager(str(tmp_path))
+    ckpt.save(1, 5, model, extra={'best': 0.5}, is_best=True)
+    ckpt.close()
+    restored = torch.nn.Linear(3, 2)
+    state = CheckpointManager(str(tmp_path)).resume(restored)
+    assert (state['epoch'], state['step'], state['extra']) == (1, 5, {'best': 0.5})
+    torch.testing.assert_close(restored.weight, model.weight)
+
+
+def test_prefetcher_raises_loader_errors():
+    def loader():
+        yield torch.zeros(2, 3, 4), torch.tensor([4, 4]), torch.tensor([0, 1])
+        raise OSError("corrupt input")
+
+    class Loader():
+        def __iter__(self):
+            return loader()
+
+    batches = []
+
+    def consume():
+        with pytest.raises(OSError, match="corrupt input"):
+            for batch in DevicePrefetcher(Loader(), torch.device('cpu')):
+                batches.append(batch)
+
+    run_with_timeout(consume)
+    assert len(batches) == 1
@@ -0,0 +1,61 @@
+import warnings
+import pytest
+import torch
+from PointDA.Models import PointNet, DGCNN
+from PointSegDA.Models import DGCNN_DefRec
+from utils.export import export_model
+from utils.quantization import load_quantized, quantize_model, quantized_state
+
+
+def trained_like(model):
+    # non trivial batch norm statistics, as after training
+    torch.manual_seed(0)
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.rand(8, 3, 128) * 2 - 1, activate_DefRec=False)
+    return model.eval()
+
+
+@pytest.mark.parametrize('name', ['pointnet', 'dgcnn'])
+def test_exported_classifier_matches_eager(cls_args, name):
+    args = cls_args(name)
+    model = trained_like(PointNet(args) if name == 'pointnet' else DGCNN(args))
+    exported, folded = export_model(model, 'cls', 'cls', args)
+    assert folded > 0
+    assert not any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for m in exported.modules())
+    x = torch.rand(4, 3, 256) * 2 - 1
+    with torch.no_grad():
+        torch.testing.assert_close(exported(x), model(x, activate_DefRec=False)['cls'], atol=1e-4, rtol=1e-4)
+
+
+def test_exported_segmentation_model_matches_eager(seg_args):
+    torch.manual_seed(0)
+    model = DGCNN_DefRec(seg_args, in_size=3, num_classes=8)
+    model.train()
+    with torch.no_grad():
+        model(torch.rand(4, 3, 128), make_seg=True, activate_DefRec=False)
+    model.eval()
+    exported, _ = export_model(model, 'seg', 'seg', seg_args)
+    x = torch.rand(2, 3, 256)
+    with torch.no_grad():
+        torch.testing.assert_close(exported(x), model(x, make_seg=True, activate_DefRec=False)['seg'],
+                                   atol=1e-4, rtol=1e-4)
+
+
+def test_quantized_classifier_is_close_and_reloads(cls_args):
+    args = cls_args('pointnet')
+    exported, _ = export_model(trained_like(PointNet(args)), 'cls', 'cls', args)
+    torch.manual_seed(1)
+    calibration = [torch.rand(8, 3, 256) * 2 - 1 for _ in range(4)]
+    x = torch.rand(16, 3, 256) * 2 - 1
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # deprecation notices of the eager mode quantization
+        quantized = quantize_model(exported, calibration)
+        reloaded = load_quantized(export_model(trained_like(PointNet(args)), 'cls', 'cls', args)[0],
+                                  quantized_state(quantized, args, 'cls'))
+    with torch.no_grad():
+        ref, out = exported(x), quantized(x)
+        # int8 error is small relative to the logits, the reloaded model is the same quantized model
+        assert (out - ref).abs().max() <= 0.1 * ref.abs().max()
+        torch.testing.assert_close(reloaded(x), out)
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+import torch
+from DefRec_and_PCM import DefRec
+from PointDA.Models import PointNet, DGCNN
+from PointSegDA.Models import DGCNN_DefRec
+from utils import pc_utils
+from utils.inference import Predictor, collate_point_clouds, valid_mask
+from utils.point_batch import IGNORE_INDEX, AugmentCollate, FPSOrderings, PointCollate
+from utils.serving import DynamicBatcher
+
+COUNTS = (700, 1024, 900)
+
+
+def shapes(counts=COUNTS, per_point=False, seed=0):
+    rng = np.random.RandomState(seed)
+    return [(rng.rand(n, 3).astype(np.float32) * 2 - 1,
+             rng.randint(0, 8, n) if per_point else np.array([i % 10])) for i, n in enumerate(counts)]
+
+
+def alone(points):
+    return torch.from_numpy(np.ascontiguousarray(points.T[None]))
+
+
+def test_collate_pads_ragged_batches():
+    samples = shapes(per_point=True)
+    batch = PointCollate()(samples)
+    assert batch.points.shape == (3, 3, 1024)
+    np.testing.assert_array_equal(batch.valid.sum(dim=1).numpy(), COUNTS)
+    # the padding repeats the points of the shape, the per point labels are ignored
+    np.testing.assert_array_equal(batch.points[0, :, 700:].numpy(), samples[0][0][:324].T)
+    assert (batch.labels[0, 700:] == IGNORE_INDEX).all()
+    np.testing.assert_array_equal(batch.labels[0, :700].numpy(), samples[0][1])
+
+
+def test_collate_without_padding_has_no_mask():
+    batch = PointCollate()(shapes(counts=(512, 512)))
+    assert batch.valid is None and batch.valid_mask(slice(0, 1)) is None
+
+
+@pytest.mark.parametrize('name', ['pointnet', 'dgcnn'])
+def test_masked_classifier_matches_unpadded(cls_args, name):
+    torch.manual_seed(0)
+    model = (PointNet if name == 'pointnet' else DGCNN)(cls_args(name)).eval()
+    samples = shapes()
+    batch = PointCollate()(samples)
+    with torch.no_grad():
+        padded, embedding = model(batch.points, valid=batch.valid, return_intermediate=True)
+        for i, (points, _) in enumerate(samples):
+            logits, ref_embedding = model(alone(points), return_intermediate=True)
+            torch.testing.assert_close(padded['cls'][i], logits['cls'][0], atol=1e-5, rtol=1e-5)
+            torch.testing.assert_close(embedding[i], ref_embedding[0], atol=1e-5, rtol=1e-5)
+
+
+def test_masked_segmentation_model_matches_unpadded(seg_args):
+    torch.manual_seed(0)
+    model = DGCNN_DefRec(seg_args, in_size=3, num_classes=8).double().eval()
+    samples = shapes(counts=(1500, 2048), per_point=True)
+    batch = PointCollate()(samples)
+    with torch.no_grad():
+        padded = model(batch.points.double(), make_seg=True, activate_DefRec=True, valid=batch.valid)
+        ref = model(alone(samples[0][0]).double(), make_seg=True, activate_DefRec=True)
+    torch.testing.assert_close(padded['seg'][0, :1500], ref['seg'][0])
+    torch.testing.assert_close(padded['DefRec'][0, :1500], ref['DefRec'][0])
+
+
+@pytest.mark.parametrize('k_model', ['cls', 'seg'])
+def test_shapes_with_fewer_points_than_k_ignore_the_padding(cls_args, seg_args, k_model):
+    torch.manual_seed(0)
+    if k_model == 'cls':
+        model, kwargs, head, num_points = DGCNN(cls_args()).eval(), {}, 'cls', 4
+    else:
+        model, kwargs, head, num_points = DGCNN_DefRec(seg_args, in_size=3, num_classes=8).eval(), \
+            {'make_seg': True, 'activate_DefRec': False}, 'seg', 10
+    x = torch.rand(2, 3, 64)
+    valid = torch.ones(2, 64, dtype=torch.bool)
+    valid[0, num_points:] = False
+    other = x.clone()
+    other[0, :, num_points:] = torch.rand(3, 64 - num_points) * 5
+    with torch.no_grad():
+        a, b = model(x, valid=valid, **kwargs)[head][0], model(other, valid=valid, **kwargs)[head][0]
+    if head == 'seg':
+        a, b = a[:num_points], b[:num_points]
+    torch.testing.assert_close(a, b)
+
+
+def test_deformation_masks_exclude_the_padding():
+    batch = PointCollate()(shapes())
+    lookup = torch.Tensor(pc_utils.region_mean(3))
+    _, mask = DefRec.deform_input(batch.points.clone(), lookup, 'volume_based_voxels', 'cpu', valid=batch.valid)
+    assert mask[0, :, 700:].abs().sum() == 0 and mask[2, :, 900:].abs().sum() == 0
+
+    augment = AugmentCollate(defrec=(pc_utils.region_mean(3), 'volume_based_voxels'), pcm=1.0,
+                             orderings=FPSOrderings(True))
+    batch = augment(shapes())
+    assert batch.mask[0, :, 700:].sum() == 0
+    assert batch.mixed.shape == batch.points.shape
+
+
+def test_prediction_does_not_depend_on_the_batch(cls_args):
+    args = cls_args()
+    torch.manual_seed(0)
+    predictor = object.__new__(Predictor)  # without a checkpoint
+    predictor.model, predictor.config, predictor.task, predictor.head = DGCNN(args).eval(), args, 'cls', 'cls'
+    predictor.device, predictor.num_points = torch.device('cpu'), 1024
+    clouds = [points for points, _ in shapes()]
+
+    points, lengths, _ = collate_point_clouds([(c, i) for i, c in enumerate(clouds)])
+    batched = predictor.forward(points, valid_mask(lengths, points.size(2)))
+    batcher = DynamicBatcher(predictor, max_batch_size=4, max_latency_ms=1.0)
+    try:
+        served = batcher.run(1024, clouds)
+        single = batcher.submit(clouds[0], timeout=30)
+    finally:
+        batcher.close()
+    for i, cloud in enumerate(clouds):
+        ref = predictor.forward(alone(cloud))[0]
+        torch.testing.assert_close(batched[i], ref, atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(served[i], ref, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(single, predictor.forward(alone(clouds[0]))[0], atol=1e-5, rtol=1e-5)
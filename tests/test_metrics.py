@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import accuracy_score, balanced_accuracy_score, confusion_matrix
+from utils.metrics import ClassificationEvaluator, LossTracker, accuracy_from_conf_mat
+
+
+@pytest.mark.filterwarnings("ignore:y_pred contains classes not in y_true")
+def test_evaluator_matches_sklearn():
+    rng = np.random.RandomState(0)
+    evaluator = ClassificationEvaluator(num_classes=10)
+    all_labels, all_preds, losses = [], [], []
+    for batch_size in (7, 16, 1, 9):
+        logits = torch.from_numpy(rng.randn(batch_size, 10).astype(np.float32))
+        labels = torch.from_numpy(rng.randint(0, 8, batch_size))  # classes 8, 9 never occur
+        loss = torch.nn.functional.cross_entropy(logits, labels)
+        evaluator.update(logits, labels, loss)
+        all_labels.append(labels.numpy())
+        all_preds.append(logits.argmax(dim=1).numpy())
+        losses.append(float(loss) * batch_size)
+    labels, preds = np.concatenate(all_labels), np.concatenate(all_preds)
+    results = evaluator.compute()
+
+    assert results['count'] == len(labels)
+    assert results['acc'] == pytest.approx(accuracy_score(labels, preds))
+    assert results['avg_acc'] == pytest.approx(balanced_accuracy_score(labels, preds))
+    assert results['loss'] == pytest.approx(sum(losses) / len(labels))
+    np.testing.assert_array_equal(results['conf_mat'], confusion_matrix(labels, preds, labels=range(10)))
+
+
+def test_accuracy_from_empty_conf_mat():
+    assert accuracy_from_conf_mat(np.zeros((3, 3))) == (0.0, 0.0)
+
+
+def test_loss_tracker_weighted_mean_and_state():
+    tracker = LossTracker(log_interval=2)
+    tracker.reset('src', ['cls'])
+    for loss, batch_size in ((1.0, 4), (3.0, 2)):
+        tracker.update('src', 'cls', torch.tensor(loss), batch_size, log_name='cls_loss')
+        tracker.count('src', batch_size)
+    assert tracker.step_values(1) is None
+    assert tracker.step_values(2) == {'cls_loss': 3.0}
+
+    restored = LossTracker()
+    restored.load_state_dict(tracker.state_dict())
+    assert restored.flush('src')['cls'] == pytest.approx((1.0 * 4 + 3.0 * 2) / 6)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from PointDA.Samplers import BucketBatchSampler, ResumableSubsetRandomSampler
+
+
+def test_resumable_sampler_depends_on_seed_and_epoch():
+    sampler = ResumableSubsetRandomSampler(list(range(50)), seed=3)
+    sampler.set_epoch(2)
+    first = list(sampler)
+    assert list(sampler) == first and sorted(first) == list(range(50))
+    sampler.set_epoch(3)
+    assert list(sampler) != first
+    assert list(ResumableSubsetRandomSampler(list(range(50)), seed=4)) != \
+        list(ResumableSubsetRandomSampler(list(range(50)), seed=3))
+
+
+@pytest.mark.parametrize('num_replicas', [1, 3])
+def test_resumable_sampler_set_start(num_replicas):
+    sampler = ResumableSubsetRandomSampler(list(range(47)), seed=1, num_replicas=num_replicas, rank=num_replicas - 1)
+    sampler.set_epoch(5)
+    full = list(sampler)
+    assert len(full) == len(sampler)
+    sampler.set_start(10)
+    assert list(sampler) == full[10:]
+    assert list(sampler) == full  # the start only applies to the next iteration
+
+
+def test_resumable_sampler_shards_cover_the_indices():
+    shards = []
+    for rank in range(3):
+        sampler = ResumableSubsetRandomSampler(list(range(47)), seed=1, num_replicas=3, rank=rank)
+        shards.append(list(sampler))
+    assert len({len(s) for s in shards}) == 1
+    assert set(sum(shards, [])) == set(range(47))
+
+
+def bucket_sampler(num_replicas=1, rank=0, seed=0, drop_last=True):
+    counts = np.random.RandomState(0).randint(200, 3000, size=300)
+    indices = np.arange(0, 300, 2)  # a subset, e.g. the train part of a dataset
+    return BucketBatchSampler(indices, counts, batch_size=8, bucket_batches=4, drop_last=drop_last, seed=seed,
+                              num_replicas=num_replicas, rank=rank), counts, indices
+
+
+def test_bucket_sampler_batches_similar_point_counts():
+    sampler, counts, indices = bucket_sampler()
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == len(indices) // 8
+    assert all(len(b) == 8 for b in batches)
+    flat = sum(batches, [])
+    assert len(set(flat)) == len(flat) and set(flat) <= set(indices.tolist())
+    spread = np.mean([np.ptp(counts[b]) for b in batches])
+    random_spread = np.mean([np.ptp(counts[b]) for b in np.array_split(indices, len(batches))])
+    assert spread < random_spread / 2
+
+
+def test_bucket_sampler_set_start_and_epochs():
+    sampler, _, _ = bucket_sampler()
+    sampler.set_epoch(1)
+    full = list(sampler)
+    sampler.set_start(5)
+    assert list(sampler) == full[5:]
+    assert list(sampler) == full
+    sampler.set_epoch(2)
+    assert list(sampler) != full
+    assert list(bucket_sampler(seed=1)[0]) != list(bucket_sampler(seed=0)[0])
+
+
+def test_bucket_sampler_shards_are_even_and_disjoint():
+    shards = [list(bucket_sampler(num_replicas=4, rank=rank)[0]) for rank in range(4)]
+    assert len({len(s) for s in shards}) == 1
+    assert len(shards[0]) == len(bucket_sampler(num_replicas=4)[0])
+    flat = [i for shard in shards for batch in shard for i in batch]
+    assert len(set(flat)) == len(flat)
+
+
+def test_bucket_sampler_keeps_the_last_batches():
+    sampler, _, indices = bucket_sampler(drop_last=False)
+    assert sorted(sum(list(sampler), [])) == sorted(indices.tolist())
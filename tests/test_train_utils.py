@@ -0,0 +1,50 @@
+import contextlib
+import pytest
+import torch
+import torch.nn as nn
+from utils.train_utils import micro_batch_slices, no_sync, preserve_bn_stats
+
+
+@pytest.mark.parametrize('batch_size, accum_steps', [(32, 1), (32, 4), (10, 3), (3, 8), (1, 1)])
+def test_micro_batch_slices_partition_the_batch(batch_size, accum_steps):
+    slices = micro_batch_slices(batch_size, accum_steps)
+    assert len(slices) == min(accum_steps, batch_size)
+    assert slices[0].start == 0 and slices[-1].stop == batch_size
+    for prev, nxt in zip(slices, slices[1:]):
+        assert prev.stop == nxt.start
+    sizes = [s.stop - s.start for s in slices]
+    assert min(sizes) >= 1 and max(sizes) - min(sizes) <= 1
+
+
+def test_weighted_micro_batches_give_the_batch_gradient_without_batch_norm():
+    torch.manual_seed(0)
+    model = nn.Linear(5, 3)
+    x, y = torch.randn(10, 5), torch.randint(0, 3, (10,))
+    nn.functional.cross_entropy(model(x), y).backward()
+    full = model.weight.grad.clone()
+    model.zero_grad()
+    for mb in micro_batch_slices(10, 3):
+        loss = nn.functional.cross_entropy(model(x[mb]), y[mb])
+        (loss * (mb.stop - mb.start) / 10).backward()
+    torch.testing.assert_close(model.weight.grad, full)
+
+
+def test_no_sync_without_ddp_is_a_null_context():
+    assert isinstance(no_sync(nn.Linear(2, 2), sync=False), contextlib.nullcontext)
+
+
+def test_no_sync_skips_all_but_the_last_micro_batch():
+    class DDPLike(nn.Module):
+        def no_sync(self):
+            return 'no_sync'
+    assert no_sync(DDPLike(), sync=False) == 'no_sync'
+    assert isinstance(no_sync(DDPLike(), sync=True), contextlib.nullcontext)
+
+
+def test_preserve_bn_stats():
+    bn = nn.BatchNorm1d(4).train()
+    before = [b.clone() for b in bn.buffers()]
+    with preserve_bn_stats([bn]):
+        bn(torch.randn(8, 4))
+    for b, saved in zip(bn.buffers(), before):
+        torch.testing.assert_close(b, saved)
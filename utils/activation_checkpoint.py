@@ -0,0 +1,28 @@
+from torch.utils.checkpoint import checkpoint
+from utils.train_utils import preserve_bn_stats
+
+
+def checkpoint_block(fn, x, modules):
+    """
+    Run fn(x) without keeping its intermediate activations for backward; they are recomputed in the
+    backward pass. The RNG state is restored for the recomputation (dropout draws the same masks) and
+    the autocast state is the one of the forward pass.
+    Input:
+        fn - function of x built from the layers in modules
+        x - input tensor
+        modules - the modules used by fn; running statistics of their batch norm layers are updated by
+                  the forward pass only, not again by the recomputation
+    Return:
+        fn(x)
+    """
+    state = {'recompute': False}
+
+    def run(inp):
+        if not state['recompute']:
+            return fn(inp)
+        with preserve_bn_stats(modules):
+            return fn(inp)
+
+    out = checkpoint(run, x, use_reentrant=False, preserve_rng_state=True)
+    state['recompute'] = True
+    return out
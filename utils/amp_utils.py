@@ -0,0 +1,41 @@
+import contextlib
+import torch
+
+
+def amp_dtype(args, device):
+    """
+    Input:
+        args - command line arguments (amp, amp_dtype)
+        device - torch.device of the model
+    Return:
+        the autocast dtype, None if mixed precision is disabled
+    """
+    if not getattr(args, 'amp', False):
+        return None
+    if device.type == 'cpu' or args.amp_dtype == 'bf16':
+        return torch.bfloat16
+    return torch.float16
+
+
+def autocast(args, device):
+    """
+    Autocast context for the forward pass and the loss computation (a no-op context when disabled)
+    """
+    dtype = amp_dtype(args, device)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def fp32(device_type):
+    """
+    Context that disables autocast, for numerically sensitive computations
+    """
+    return torch.autocast(device_type=device_type, enabled=False)
+
+
+def grad_scaler(args, device):
+    """
+    Return: a GradScaler, enabled only for fp16 (bf16 has the range of fp32 and needs no scaling)
+    """
+    return torch.amp.GradScaler(device.type, enabled=amp_dtype(args, device) == torch.float16)
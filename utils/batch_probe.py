@@ -0,0 +1,257 @@
+import copy
+import resource
+import time
+import torch
+import torch.nn as nn
+from DefRec_and_PCM import DefRec, PCM
+from utils import pc_utils
+from utils.amp_utils import autocast, grad_scaler
+from utils.checkpoint import get_rng_state, set_rng_state
+from utils.dist_utils import all_reduce_min
+
+NUM_CLASSES = {'cls': 10, 'seg': 8}
+
+
+def synthetic_batch(task, batch_size, num_points, device):
+    """
+    Return: point clouds [B, 3, N] in the unit cube made of a few dense clusters (so that DefRec
+    finds regions to deform) and class labels [B] or point labels [B, N]
+    """
+    centers = torch.rand(batch_size, 3, 4, device=device) * 1.2 - 0.6
+    assign = torch.randint(0, 4, (batch_size, 1, num_points), device=device).expand(-1, 3, -1)
+    x = centers.gather(2, assign) + 0.1 * torch.randn(batch_size, 3, num_points, device=device)
+    x = x.clamp(-0.99, 0.99)
+    if task == 'seg':
+        y = torch.randint(0, NUM_CLASSES['seg'], (batch_size, num_points), device=device)
+    else:
+        y = torch.randint(0, NUM_CLASSES['cls'], (batch_size,), device=device)
+    return x, y
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """
+    Return: peak memory of the torch allocator on cuda, peak RSS of the process on cpu (MB)
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def memory_budget_mb(device, fraction=0.9):
+    """
+    Return: fraction of the device memory (cuda) or of the available host memory (cpu) in MB
+    """
+    if device.type == 'cuda':
+        return fraction * torch.cuda.get_device_properties(device).total_memory / 2 ** 20
+    with open('/proc/meminfo') as f:
+        info = dict(line.split(':', 1) for line in f)
+    available = int(info['MemAvailable'].split()[0]) / 2 ** 10
+    # the process peak RSS includes what is already allocated
+    return fraction * available + peak_memory_mb(device)
+
+
+def is_oom(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def time_steps(fn, num_steps, warmup, device):
+    """
+    Return: average seconds per call of fn() after warmup calls
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / max(num_steps, 1)
+
+
+class TrainStep():
+    """
+    One training step on a batch with the DefRec and PCM branches of the trainers:
+    PCM on the source (classification / segmentation) and DefRec on the target, each with its own backward.
+    With jdot the DeepJDOT pass is added (a source and a target forward followed by one backward).
+    """
+    def __init__(self, model, args, task, device, defrec=True, pcm=True, jdot=False):
+        self.model = model
+        self.args = args
+        self.task = task
+        self.device = device
+        self.defrec = defrec
+        self.pcm = pcm
+        self.jdot = jdot and task == 'cls'
+        self.opt = torch.optim.Adam(model.parameters(), lr=1e-4)
+        self.scaler = grad_scaler(args, device)
+        self.criterion = nn.CrossEntropyLoss()
+        self.lookup = torch.Tensor(pc_utils.region_mean(args.num_regions)).to(device)
+
+    def __call__(self, x, y):
+        args, model = self.args, self.model
+        self.opt.zero_grad()
+        with autocast(args, self.device):
+            if self.task == 'seg':
+                src_x, src_y = PCM.mix_shapes_segmentation(args, x, y) if self.pcm else (x, y)
+                logits = model(src_x, make_seg=True, activate_DefRec=False)
+                loss = self.criterion(logits['seg'].permute(0, 2, 1), src_y)
+            elif self.pcm:
+                src_x, mixup_vals = PCM.mix_shapes(args, x.clone(), y)
+                loss = PCM.calc_loss(args, model(src_x, activate_DefRec=False), mixup_vals, self.criterion)
+            else:
+                loss = self.criterion(model(x, activate_DefRec=False)['cls'], y)
+        self.scaler.scale(loss).backward()
+        if self.defrec:
+            trgt_x, mask = DefRec.deform_input(x.clone(), self.lookup, args.DefRec_dist, self.device)
+            with autocast(args, self.device):
+                if self.task == 'seg':
+                    logits = model(trgt_x, make_seg=False, activate_DefRec=True)
+                else:
+                    logits = model(trgt_x, activate_DefRec=True)
+                rec_loss = DefRec.calc_loss(args, logits, x, mask)
+            self.scaler.scale(rec_loss).backward()
+            loss = loss + rec_loss
+        if self.jdot:
+            with autocast(args, self.device):
+                src_logits, src_f = model(x, activate_DefRec=False, return_intermediate=True)
+                trgt_logits, trgt_f = model(x.flip(0), activate_DefRec=False, return_intermediate=True)
+            jdot_loss = self.criterion(src_logits['cls'].float(), y) + \
+                torch.cdist(src_f.float(), trgt_f.float()).mean() + trgt_logits['cls'].float().logsumexp(1).mean()
+            self.scaler.scale(jdot_loss).backward()
+            loss = loss + jdot_loss
+        self.scaler.step(self.opt)
+        self.scaler.update()
+        return loss.detach()
+
+
+def _try_batch(model, args, task, device, batch_size, num_points, mode, steps, jdot):
+    """
+    Run steps synthetic steps at one configuration
+    Return: (peak memory MB, seconds per step), None on out of memory
+    """
+    try:
+        x, y = synthetic_batch(task, batch_size, num_points, device)
+        reset_peak_memory(device)
+        if mode == 'train':
+            model.train()
+            step = TrainStep(model, args, task, device, jdot=jdot)
+            fn = lambda: step(x, y)
+        else:
+            model.eval()
+
+            def fn():
+                with torch.no_grad(), autocast(args, device):
+                    if task == 'seg':
+                        model(x, make_seg=True, activate_DefRec=False)
+                    else:
+                        model(x, activate_DefRec=False)
+        step_time = time_steps(fn, steps, 1, device)
+        return peak_memory_mb(device), step_time
+    except RuntimeError as e:
+        if not is_oom(e):
+            raise
+        return None
+    finally:
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+
+def probe_batch_size(model, args, task, device, num_points=1024, mode='train', budget_mb=None,
+                     min_batch=2, max_batch=1024, steps=2, jdot=False):
+    """
+    Find the largest batch size whose synthetic steps fit under a memory budget.
+    Batch sizes are doubled until a step runs out of memory, exceeds the budget or is predicted to exceed
+    it (peak memory grows linearly with the batch size); on cuda the last interval is then bisected.
+    On cpu the peak RSS of the process cannot be reset, so the search only goes up.
+    The model is copied and the RNG state is restored, training is not affected.
+    Input:
+        model - DGCNN/PointNet (task cls) or DGCNN_DefRec (task seg)
+        args - command line arguments of the trainer (DefRec/PCM parameters, amp, checkpoint_edgeconv)
+        mode - train (forward + backward of the DefRec and PCM branches, optimizer step) or eval (forward)
+        budget_mb - memory budget, memory_budget_mb(device) by default
+        jdot - add the DeepJDOT pass to the train step
+    Return:
+        dict with batch_size (0 if even min_batch does not fit), num_points, peak_memory_mb and samples_per_s
+    """
+    budget_mb = memory_budget_mb(device) if budget_mb is None else budget_mb
+    rng_state = get_rng_state()
+    model = copy.deepcopy(model).to(device)
+    best = {'batch_size': 0, 'num_points': num_points, 'peak_memory_mb': 0.0, 'samples_per_s': 0.0, 'mode': mode}
+    measured = []
+
+    def fits(batch_size):
+        res = _try_batch(model, args, task, device, batch_size, num_points, mode, steps, jdot)
+        if res is None or res[0] > budget_mb:
+            return False
+        measured.append((batch_size, res[0]))
+        if batch_size > best['batch_size']:
+            best.update(batch_size=batch_size, peak_memory_mb=res[0], samples_per_s=batch_size / res[1])
+        return True
+
+    def predicted(batch_size):
+        if len(measured) < 2:
+            return 0.0
+        (b0, m0), (b1, m1) = measured[-2], measured[-1]
+        return m1 + (m1 - m0) / (b1 - b0) * (batch_size - b1)
+
+    try:
+        batch_size, fail = min_batch, None
+        while batch_size <= max_batch:
+            if predicted(batch_size) > budget_mb or not fits(batch_size):
+                fail = batch_size
+                break
+            batch_size *= 2
+        if device.type == 'cuda' and fail is not None and best['batch_size'] > 0:
+            low, high = best['batch_size'], fail
+            while high - low > 1:
+                mid = (low + high) // 2
+                if fits(mid):
+                    low = mid
+                else:
+                    high = mid
+    finally:
+        del model
+        set_rng_state(rng_state)
+    return best
+
+
+def probe(model, args, task, device, point_counts=(1024,), modes=('train', 'eval'), budget_mb=None, **kwargs):
+    """
+    probe_batch_size for every point count and mode
+    Return: list of results, the largest fitting configuration per point count and mode
+    """
+    return [probe_batch_size(model, args, task, device, num_points=n, mode=mode, budget_mb=budget_mb, **kwargs)
+            for n in point_counts for mode in modes]
+
+
+def auto_batch_size(model, args, task, device, num_points, io=None):
+    """
+    Set args.batch_size and args.test_batch_size to the largest batch sizes that fit under
+    args.memory_fraction of the memory (the smallest over the processes of a distributed run).
+    With gradient accumulation the micro-batch is probed, the batch size is accum_steps micro-batches.
+    """
+    train_res, eval_res = probe(model, args, task, device, point_counts=[num_points],
+                                budget_mb=memory_budget_mb(device, args.memory_fraction),
+                                jdot=getattr(args, 'use_DeepJDOT', False))
+    sizes = all_reduce_min(torch.tensor([train_res['batch_size'], eval_res['batch_size']], device=device))
+    train_batch, eval_batch = sizes.tolist()
+    if train_batch == 0 or eval_batch == 0:
+        raise RuntimeError("no batch size fits in %.0f%% of the memory with %d points"
+                           % (100 * args.memory_fraction, num_points))
+    args.batch_size = train_batch * getattr(args, 'accum_steps', 1)
+    args.test_batch_size = eval_batch
+    if io is not None:
+        io.cprint("Probed batch sizes for %d points: train %d (%.1f samples/s, %.0f MB), test %d (%.1f samples/s)"
+                  % (num_points, train_batch, train_res['samples_per_s'], train_res['peak_memory_mb'],
+                     eval_batch, eval_res['samples_per_s']))
+    return train_res, eval_res
@@ -0,0 +1,225 @@
+import copy
+import glob
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def unwrap_model(model):
+    """
+    Return the underlying model of DataParallel/DistributedDataParallel/torch.compile wrappers
+    """
+    while True:
+        if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            model = model.module
+        elif hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        else:
+            return model
+
+
+def get_rng_state():
+    """
+    Return: state of the python, numpy and torch random generators
+    """
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    Restore a state returned by get_rng_state
+    """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file which is then renamed, so path always holds a complete file
+    """
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager():
+    """
+    Asynchronous checkpointing.
+    Model/optimizer/scheduler states are copied into reusable (pinned, when cuda is available) host
+    buffers and written atomically from a background thread, so training only waits for the
+    device to host copy. The last keep_last checkpoints are kept, together with the best one
+    (best.pt) and the weights of the best model (model.pt).
+    With write=False (non main processes of a distributed run) nothing is written, but the best
+    weights are still kept on the host.
+    A checkpoint that fails to be written (full disk, permissions) is raised by the next save/wait.
+    """
+    def __init__(self, path, keep_last=3, write=True):
+        self.path = path
+        self.ckpt_dir = os.path.join(path, 'checkpoints')
+        self.write = write
+        if self.write and not os.path.exists(self.ckpt_dir):
+            os.makedirs(self.ckpt_dir)
+        self.keep_last = keep_last
+        self.pin_memory = torch.cuda.is_available()
+        self.buffers = {}
+        self.best_weights = None
+        self.queue = queue.Queue()
+        self.error = None  # first failure of the writer, raised by the next save/wait
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _to_host(self, obj, key, buffers):
+        if torch.is_tensor(obj):
+            buf = buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory and obj.is_cuda)
+                buffers[key] = buf
+            buf.copy_(obj.detach(), non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            return {k: self._to_host(v, key + (k,), buffers) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._to_host(v, key + (i,), buffers) for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def snapshot(self, obj, slot):
+        """
+        Copy obj (nested dicts/lists of tensors) to the host buffers of slot
+        """
+        return self._to_host(obj, (), self.buffers.setdefault(slot, {}))
+
+    def _writer(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            event, items = job
+            try:
+                if event is not None:
+                    event.synchronize()  # wait for the non blocking copies
+                for obj, path in items:
+                    atomic_save(obj, path)
+                self.cleanup()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def cleanup(self):
+        ckpts = sorted(glob.glob(os.path.join(self.ckpt_dir, 'ckpt_*.pt')))
+        for path in ckpts[:max(len(ckpts) - self.keep_last, 0)]:
+            os.remove(path)
+
+    def wait(self):
+        """
+        Block until all pending checkpoints are written, raise the failure of a pending checkpoint
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint to %s failed" % self.ckpt_dir) from error
+
+    def save(self, epoch, step, model, opt=None, scheduler=None, extra=None, is_best=False, scaler=None):
+        """
+        Input:
+            epoch, step - position to resume training from (step is the number of batches done in epoch)
+            model, opt, scheduler, scaler - objects whose state_dict is saved
+            extra - dict of picklable training state (e.g. best metrics, sampler state)
+            is_best - also save as best.pt and keep the model weights as the best model
+        """
+        # the host buffers are reused, make sure the previous checkpoint left them
+        self.wait()
+        model_state = unwrap_model(model).state_dict()
+        if not self.write:
+            if is_best:
+                self.best_weights = self.snapshot(model_state, 'best')
+                if torch.cuda.is_available():
+                    torch.cuda.current_stream().synchronize()
+            return
+        state = {'epoch': epoch,
+                 'step': step,
+                 'model': self.snapshot(model_state, 'model'),
+                 'rng': get_rng_state(),
+                 'extra': copy.deepcopy(extra)}
+        if opt is not None:
+            state['opt'] = self.snapshot(opt.state_dict(), 'opt')
+        if scheduler is not None:
+            state['scheduler'] = copy.deepcopy(scheduler.state_dict())
+        if scaler is not None:
+            state['scaler'] = copy.deepcopy(scaler.state_dict())
+
+        items = [(state, os.path.join(self.ckpt_dir, 'ckpt_%04d_%07d.pt' % (epoch, step)))]
+        if is_best:
+            # the best weights are kept in their own buffers, the latest checkpoint buffers are reused
+            self.best_weights = self.snapshot(model_state, 'best')
+            items.append((state, os.path.join(self.ckpt_dir, 'best.pt')))
+            items.append((self.best_weights, os.path.join(self.path, 'model.pt')))
+
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((event, items))
+
+    def latest(self):
+        """
+        Return: path of the most recent checkpoint, None if there is none
+        """
+        ckpts = sorted(glob.glob(os.path.join(self.ckpt_dir, 'ckpt_*.pt')))
+        return ckpts[-1] if len(ckpts) > 0 else None
+
+    def resume(self, model, opt=None, scheduler=None, path=None, scaler=None):
+        """
+        Restore model/optimizer/scheduler/grad scaler/RNG state from a checkpoint (the latest one by default)
+        and the best model weights from best.pt.
+        Return:
+            the loaded checkpoint (epoch, step and extra hold the position and training state),
+            None if no checkpoint was found
+        """
+        path = path if path is not None else self.latest()
+        if path is None:
+            return None
+        state = torch.load(path, map_location='cpu', weights_only=False)
+        unwrap_model(model).load_state_dict(state['model'])
+        if opt is not None and 'opt' in state:
+            opt.load_state_dict(state['opt'])
+        if scheduler is not None and 'scheduler' in state:
+            scheduler.load_state_dict(state['scheduler'])
+        if scaler is not None and 'scaler' in state:
+            scaler.load_state_dict(state['scaler'])
+        best_path = os.path.join(self.ckpt_dir, 'best.pt')
+        if os.path.exists(best_path):
+            self.best_weights = torch.load(best_path, map_location='cpu', weights_only=False)['model']
+        else:
+            self.best_weights = state['model']
+        set_rng_state(state['rng'])
+        return state
+
+    def best_state_dict(self):
+        """
+        Return: host copy of the best model weights
+        """
+        self.wait()
+        return self.best_weights
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
@@ -0,0 +1,46 @@
+import torch
+
+
+def compile_model(model, args):
+    """
+    Return: torch.compile(model) with args.compile, model otherwise
+    """
+    if not getattr(args, 'compile', False):
+        return model
+    return torch.compile(model, mode=None if args.compile_mode == 'default' else args.compile_mode)
+
+
+def compare_outputs(reference, other, atol=1e-4, rtol=1e-3):
+    """
+    Input:
+        reference, other - outputs of two models: tensors, or (nested) dicts/tuples of tensors
+    Return:
+        max absolute difference, True if all the outputs match within the tolerances
+    """
+    if isinstance(reference, dict):
+        pairs = [(reference[k], other[k]) for k in reference]
+    elif isinstance(reference, (list, tuple)):
+        pairs = list(zip(reference, other))
+    else:
+        ref, out = reference.float(), other.float()
+        return (ref - out).abs().max().item(), torch.allclose(ref, out, atol=atol, rtol=rtol)
+    results = [compare_outputs(r, o, atol, rtol) for r, o in pairs]
+    return max(r[0] for r in results), all(r[1] for r in results)
+
+
+def check_compiled(eager_model, compiled_model, inputs, atol=1e-4, rtol=1e-3, **kwargs):
+    """
+    Compare the eval mode outputs of a compiled (or traced) model with the eager model on inputs.
+    Both share the weights; the train/eval mode of the eager model is restored.
+    Return:
+        max absolute difference, True if the outputs match
+    """
+    training = eager_model.training
+    eager_model.eval()
+    compiled_model.eval()
+    with torch.no_grad():
+        reference = eager_model(inputs, **kwargs)
+        other = compiled_model(inputs, **kwargs)
+    eager_model.train(training)
+    compiled_model.train(training)
+    return compare_outputs(reference, other, atol, rtol)
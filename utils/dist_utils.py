@@ -0,0 +1,70 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """
+    Initialize the default process group when launched with torchrun (WORLD_SIZE > 1).
+    Sets args.distributed, args.rank, args.local_rank and args.world_size.
+    Input:
+        args - command line arguments (args.cuda decides between the nccl and gloo backends)
+    Return:
+        the device of this process
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.distributed = world_size > 1
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.world_size = world_size
+    if not args.distributed:
+        return torch.device("cuda:" + str(args.gpus[0]) if args.cuda else "cpu")
+
+    if args.cuda:
+        torch.cuda.set_device(args.local_rank)
+    dist.init_process_group(backend='nccl' if args.cuda else 'gloo')
+    return torch.device("cuda:" + str(args.local_rank) if args.cuda else "cpu")
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    """
+    In-place sum of a tensor over all processes (no-op if not distributed)
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_reduce_min(tensor):
+    """
+    In-place minimum of a tensor over all processes (no-op if not distributed)
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return tensor
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
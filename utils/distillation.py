@@ -0,0 +1,149 @@
+import json
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+from utils.amp_utils import autocast
+from utils.dist_utils import barrier, is_main_process
+from utils.inference import load_config, load_state_dict, build_model, output_head
+
+
+def distillation_loss(student_logits, teacher_logits, temperature=4.0):
+    """
+    KL divergence between the temperature softened teacher and student distributions,
+    scaled by T^2 so its gradients keep the magnitude of the hard label loss
+    """
+    log_p_student = F.log_softmax(student_logits.float() / temperature, dim=-1)
+    p_teacher = F.softmax(teacher_logits.float() / temperature, dim=-1)
+    return F.kl_div(log_p_student, p_teacher, reduction='batchmean') * temperature ** 2
+
+
+def embedding_loss(student_x, teacher_x):
+    """
+    Squared distance between the L2 normalized shape embeddings (the teacher embedding is
+    sigmoid/average pooled and the student one max pooled, only their directions are matched)
+    """
+    student_x = F.normalize(student_x.float(), dim=-1)
+    teacher_x = F.normalize(teacher_x.float(), dim=-1)
+    return (student_x - teacher_x).pow(2).sum(dim=-1).mean()
+
+
+class IndexedDataset(Dataset):
+    """
+    Dataset wrapper that adds the sample index to the items, to look up cached teacher outputs
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, item):
+        return tuple(self.dataset[item]) + (item,)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class TeacherCache():
+    """
+    Teacher logits and embeddings per sample of a dataset, in .npy files memory mapped from disk
+    (float16), so the teacher runs once per sample over all epochs and resumed runs.
+    The outputs of a sample are those of the first augmented version of it the teacher saw.
+    """
+    def __init__(self, path, num_samples, num_classes, embed_dim, key):
+        files = {name: os.path.join(path, name + '.npy') for name in ('logits', 'embeddings', 'filled')}
+        meta_path = os.path.join(path, 'meta.json')
+        meta = {'key': key, 'num_samples': num_samples}
+        if is_main_process():
+            valid = os.path.exists(meta_path) and all(os.path.exists(f) for f in files.values())
+            if valid:
+                with open(meta_path) as f:
+                    valid = json.load(f) == meta
+            if not valid:
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                np.lib.format.open_memmap(files['logits'], 'w+', np.float16, (num_samples, num_classes))
+                np.lib.format.open_memmap(files['embeddings'], 'w+', np.float16, (num_samples, embed_dim))
+                np.lib.format.open_memmap(files['filled'], 'w+', np.bool_, (num_samples,))
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+        barrier()  # the files exist for all processes
+        # processes fill disjoint samples of the shared mappings
+        self.logits = np.load(files['logits'], mmap_mode='r+')
+        self.embeddings = np.load(files['embeddings'], mmap_mode='r+')
+        self.filled = np.load(files['filled'], mmap_mode='r+')
+
+    def missing(self, indices):
+        """
+        Return: mask of the indices without cached outputs
+        """
+        return ~self.filled[indices]
+
+    def store(self, indices, logits, embeddings):
+        self.logits[indices] = logits.float().cpu().numpy()
+        self.embeddings[indices] = embeddings.float().cpu().numpy()
+        self.filled[indices] = True
+
+    def get(self, indices, device):
+        logits = torch.from_numpy(self.logits[indices].astype(np.float32)).to(device)
+        embeddings = torch.from_numpy(self.embeddings[indices].astype(np.float32)).to(device)
+        return logits, embeddings
+
+    def flush(self):
+        for arr in (self.logits, self.embeddings, self.filled):
+            arr.flush()
+
+
+class Teacher():
+    """
+    Frozen teacher model of a trained run (model.pt or a training checkpoint), with optional
+    per domain output caches.
+    """
+    def __init__(self, checkpoint, device, config=None):
+        self.config = load_config(checkpoint, config)
+        self.model, task = build_model(self.config)
+        if task != 'cls':
+            raise ValueError("the teacher %s is not a classifier" % checkpoint)
+        self.model.load_state_dict(load_state_dict(checkpoint))
+        self.model = self.model.to(device).eval()
+        for p in self.model.parameters():
+            p.requires_grad_(False)
+        self.head = output_head(self.config, task)
+        self.checkpoint = os.path.abspath(checkpoint)
+        self.device = device
+        self.caches = {}
+
+    def add_cache(self, name, path, num_samples, num_classes=10, embed_dim=1024):
+        """
+        Cache the outputs of the samples of dataset name in path
+        """
+        key = "%s:%d" % (self.checkpoint, int(os.path.getmtime(self.checkpoint)))
+        self.caches[name] = TeacherCache(path, num_samples, num_classes, embed_dim, key)
+
+    def forward(self, x, args, valid=None):
+        with torch.no_grad(), autocast(args, self.device):
+            logits, embeddings = self.model(x, activate_DefRec=False, return_intermediate=True, valid=valid)
+        return logits[self.head].float(), embeddings.float()
+
+    def outputs(self, x, args, name=None, indices=None, valid=None):
+        """
+        Input:
+            x - point clouds [B, 3, N]
+            name, indices - dataset and sample indices of x, for the cached outputs
+            valid - valid points of padded point clouds [B, N], None if all are valid
+        Return:
+            teacher logits [B, C] and shape embeddings [B, D] (fp32)
+        """
+        if name not in self.caches:
+            return self.forward(x, args, valid)
+        cache = self.caches[name]
+        indices = np.asarray(indices)
+        missing = cache.missing(indices)
+        if missing.any():
+            sel = torch.from_numpy(np.nonzero(missing)[0]).to(x.device)
+            logits, embeddings = self.forward(x[sel], args, None if valid is None else valid[sel])
+            cache.store(indices[missing], logits, embeddings)
+        return cache.get(indices, x.device)
+
+    def close(self):
+        for cache in self.caches.values():
+            cache.flush()
@@ -0,0 +1,108 @@
+import copy
+import re
+import torch
+import torch.nn as nn
+
+CONV_TYPES = (nn.Conv1d, nn.Conv2d, nn.Linear)
+BN_TYPES = (nn.BatchNorm1d, nn.BatchNorm2d)
+
+
+def fold_bn(layer, bn):
+    """
+    Fold the eval mode affine transform of bn into the weights of the preceding conv/linear layer
+    """
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias.detach() - bn.running_mean * scale
+    weight = layer.weight.detach()
+    layer.weight.data = weight * scale.view(-1, *([1] * (weight.dim() - 1)))
+    bias = layer.bias.detach() * scale + shift if layer.bias is not None else shift
+    layer.bias = nn.Parameter(bias.clone())
+
+
+def fold_batchnorm(model):
+    """
+    Fold every BatchNorm into the conv/linear layer it follows, in place; the BatchNorms become identities.
+    A BatchNorm follows a layer when it comes next in an nn.Sequential, or when the module applies
+    its bn<i> to its conv<i> (the segmentation/reconstruction heads and DGCNN.bn5).
+    Return: number of folded BatchNorms
+    """
+    folded = 0
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if isinstance(module[i], CONV_TYPES) and isinstance(module[i + 1], BN_TYPES):
+                    fold_bn(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+                    folded += 1
+        for name, bn in list(module.named_children()):
+            match = re.fullmatch(r'bn(\d+)', name)
+            layer = getattr(module, 'conv%s' % match.group(1), None) if match else None
+            if isinstance(bn, BN_TYPES) and isinstance(layer, CONV_TYPES) and layer.out_channels == bn.num_features:
+                fold_bn(layer, bn)
+                setattr(module, name, nn.Identity())
+                folded += 1
+    return folded
+
+
+def strip_dropout(model):
+    """
+    Replace the Dropout layers (identities in eval mode) with nn.Identity, in place
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+
+
+class InferenceModel(nn.Module):
+    """
+    Inference-only model: forward(x [B, 3, N], valid [B, N] of padded clouds) returns the logits of
+    one head, [B, C] for classification and [B, N, C] for segmentation. Built by export_model.
+    """
+    def __init__(self, model, task, head, config=None):
+        super(InferenceModel, self).__init__()
+        self.model = model
+        self.task = task
+        self.head = head
+        self.config = config
+
+    def forward(self, x, valid=None):
+        if self.task == 'cls':
+            return self.model(x, activate_DefRec=False, valid=valid)[self.head]
+        return self.model(x, make_seg=True, activate_DefRec=False, valid=valid)['seg']
+
+
+def prune_heads(model, task, head):
+    """
+    Remove the heads not needed for the output head, in place
+    """
+    del model.DefRec
+    if task == 'cls':
+        if head != 'DeepJDOT' and hasattr(model, 'DeepJDOT'):
+            del model.DeepJDOT
+            model.DeepJDOT_head = False
+        if head == 'DeepJDOT':
+            # the forward pass still applies C, an identity makes it free
+            model.C = nn.Identity()
+
+
+def export_model(model, task, head, config=None):
+    """
+    Input:
+        model - trained PointNet/DGCNN/DGCNN_DefRec (not modified)
+        task - cls or seg
+        head - output head (cls or DeepJDOT for classification, seg for segmentation)
+    Return:
+        eval mode InferenceModel with the BatchNorms folded, without dropout and unused heads,
+        and the number of folded BatchNorms
+    """
+    model = copy.deepcopy(model).eval()
+    model.checkpoint_edgeconv = False
+    if hasattr(model, 'shared_layers'):
+        model.shared_layers.checkpoint_edgeconv = False
+    prune_heads(model, task, head)
+    folded = fold_batchnorm(model)
+    strip_dropout(model)
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return InferenceModel(model, task, head, config).eval(), folded
@@ -0,0 +1,406 @@
+import argparse
+import ast
+import copy
+import glob
+import json
+import os
+import re
+import queue
+import threading
+import time
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from PointDA.data.dataloader import NUM_POINTS, idx_to_label
+from PointDA.Models import PointNet, DGCNN
+from PointSegDA.Models import DGCNN_DefRec
+from utils.pc_utils import farthest_point_sample_np, scale_to_unit_cube, rotate_shape
+from utils.amp_utils import autocast
+from utils.export import InferenceModel, export_model
+from utils.quantization import load_quantized
+
+CLS_DATASETS = ('modelnet', 'shapenet', 'scannet')
+SEG_NUM_CLASSES = 8
+
+
+def load_config(checkpoint, config=None):
+    """
+    Load the command line arguments of the run that saved a checkpoint.
+    Input:
+        checkpoint - model.pt or a checkpoint of the experiment directory (or of its checkpoints directory)
+        config - args.json path; by default args.json of the experiment, or the arguments printed
+                 at the top of its run.log (runs from before args.json was saved)
+    Return:
+        argparse.Namespace
+    """
+    exp_dir = os.path.dirname(os.path.abspath(checkpoint))
+    if os.path.basename(exp_dir) == 'checkpoints':
+        exp_dir = os.path.dirname(exp_dir)
+    config = config if config is not None else os.path.join(exp_dir, 'args.json')
+    if os.path.exists(config):
+        with open(config) as f:
+            return argparse.Namespace(**json.load(f))
+    run_log = os.path.join(exp_dir, 'run.log')
+    if os.path.exists(run_log):
+        with open(run_log) as f:
+            for line in f:
+                match = re.search(r'(Namespace\(.*\))\s*$', line)
+                if match:
+                    return parse_namespace(match.group(1))
+    raise FileNotFoundError("no args.json or run.log found for %s" % checkpoint)
+
+
+def parse_namespace(text):
+    """
+    Parse the repr of an argparse.Namespace without evaluating it: only the literal values (numbers,
+    strings, lists, ...) of its keyword arguments are read, the others are skipped
+    Return:
+        argparse.Namespace
+    """
+    call = ast.parse(text.strip(), mode='eval').body
+    if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name) or call.func.id != 'Namespace':
+        raise ValueError("not a Namespace: %.80s" % text)
+    config = argparse.Namespace()
+    for keyword in call.keywords:
+        try:
+            setattr(config, keyword.arg, ast.literal_eval(keyword.value))
+        except ValueError:
+            continue
+    return config
+
+
+def load_state_dict(checkpoint, state=None):
+    """
+    Input:
+        checkpoint - path of model.pt (state dict) or of a CheckpointManager checkpoint
+        state - its already loaded content, optional
+    Return: the model weights without the DataParallel/torch.compile prefixes
+    """
+    if state is None:
+        state = torch.load(checkpoint, map_location='cpu', weights_only=False)
+    if 'model' in state and isinstance(state['model'], dict):
+        state = state['model']
+    prefixes = ('module.', '_orig_mod.')
+    clean = {}
+    for k, v in state.items():
+        while k.startswith(prefixes):
+            k = k.split('.', 1)[1]
+        clean[k] = v
+    return clean
+
+
+def build_model(config):
+    """
+    Return: (model, task) for the command line arguments of a run (task is cls or seg)
+    """
+    config.checkpoint_edgeconv = False
+    # options added after the first runs, with their trainer defaults
+    for name, default in (('model', 'dgcnn'), ('use_sigmoid', True), ('DeepJDOT_head', False), ('dropout', 0.5)):
+        if not hasattr(config, name):
+            setattr(config, name, default)
+    if config.src_dataset in CLS_DATASETS:
+        model = PointNet(config) if config.model == 'pointnet' else DGCNN(config)
+        return model, 'cls'
+    return DGCNN_DefRec(config, in_size=3, num_classes=SEG_NUM_CLASSES), 'seg'
+
+
+def output_head(config, task):
+    """
+    Return: the head used for predictions, as in the test function of the trainers
+    """
+    if task == 'seg':
+        return "seg"
+    use_DeepJDOT_head = getattr(config, 'use_DeepJDOT', False) and getattr(config, 'DeepJDOT_head', False) and \
+        getattr(config, 'DeepJDOT_classifier', False)
+    return "DeepJDOT" if use_DeepJDOT_head else "cls"
+
+
+def load_model(checkpoint, config=None):
+    """
+    Input:
+        checkpoint - model.pt, a training checkpoint, a model exported by export.py or quantized by quantize.py
+        config - args.json path (see load_config), for the checkpoints without one
+    Return:
+        eval mode model, its config, task (cls/seg) and output head
+    """
+    state = torch.load(checkpoint, map_location='cpu', weights_only=False)
+    if isinstance(state, InferenceModel):  # written by export.py
+        config = copy.copy(state.config) if state.config is not None else argparse.Namespace()
+        return state.eval(), config, state.task, state.head
+    if isinstance(state, dict) and 'quantization' in state:  # written by quantize.py
+        config = argparse.Namespace(**state['config'])
+        config.quantized = True
+        model, task = build_model(config)
+        model, _ = export_model(model, task, state['head'], config)
+        return load_quantized(model, state), config, task, state['head']
+    config = load_config(checkpoint, config)
+    model, task = build_model(config)
+    model.load_state_dict(load_state_dict(checkpoint, state))
+    return model.eval(), config, task, output_head(config, task)
+
+
+def list_inputs(paths):
+    """
+    Input:
+        paths - .npy/.h5 files, directories (searched recursively) or text files with one path per line
+    Return:
+        list of (file, index) samples; index is the sample of an .h5 file, None for .npy files
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '**', '*.npy'), recursive=True) +
+                            glob.glob(os.path.join(path, '**', '*.h5'), recursive=True))
+        elif path.endswith('.txt'):
+            with open(path) as f:
+                files += [line.strip() for line in f if line.strip()]
+        else:
+            files.append(path)
+    samples = []
+    for file in files:
+        if file.endswith('.h5'):
+            with h5py.File(file, 'r') as f:
+                samples += [(file, i) for i in range(f['data'].shape[0])]
+        else:
+            samples.append((file, None))
+    return samples
+
+
+def preprocess(pointcloud, task='cls', num_points=NUM_POINTS, rotate=False, seed=0):
+    """
+    Input:
+        pointcloud - [N, C] array, xyz first
+        task - cls: preprocessing of the PointDA datasets (scaled to the unit cube, optionally rotated to
+               a y-up frame, reduced to num_points by farthest point sampling); seg: xyz only
+        seed - seed of the farthest point sampling start point
+    Return:
+        [N', 3] float32 array
+    """
+    pointcloud = pointcloud[:, :3].astype(np.float32)
+    if task == 'cls':
+        pointcloud = scale_to_unit_cube(pointcloud)
+        if rotate:
+            pointcloud = rotate_shape(pointcloud, 'x', -np.pi / 2)
+        if pointcloud.shape[0] > num_points:
+            # deterministic sampling, with a generator of its own (preprocess runs in the server threads)
+            pointcloud = np.swapaxes(np.expand_dims(pointcloud, 0), 1, 2)
+            _, pointcloud = farthest_point_sample_np(pointcloud, num_points, rng=np.random.RandomState(seed))
+            pointcloud = np.swapaxes(pointcloud.squeeze(), 1, 0).astype('float32')
+    return pointcloud
+
+
+class PointCloudFiles(Dataset):
+    """
+    Point clouds of .npy files ([N, C], xyz first) and .h5 files ('data' [M, N, C]) for inference.
+    Classification inputs are preprocessed as in the PointDA datasets: scaled to the unit cube,
+    optionally rotated to a y-up frame, and reduced to num_points by farthest point sampling.
+    """
+    def __init__(self, samples, task='cls', num_points=NUM_POINTS, rotate=False, seed=0):
+        self.samples = samples
+        self.task = task
+        self.num_points = num_points
+        self.rotate = rotate
+        self.seed = seed
+        self.h5_files = {}
+
+    def read(self, item):
+        file, index = self.samples[item]
+        if index is None:
+            return np.load(file)
+        if file not in self.h5_files:  # one handle per file and worker
+            self.h5_files[file] = h5py.File(file, 'r')
+        return self.h5_files[file]['data'][index]
+
+    def __getitem__(self, item):
+        pointcloud = preprocess(self.read(item), self.task, self.num_points, self.rotate, self.seed + item)
+        return pointcloud, item
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def collate_point_clouds(batch, num_points=None):
+    """
+    Batch point clouds with different numbers of points: the smaller ones are padded by repeating
+    their points, the models skip the padding given valid_mask(lengths) (predictions of the padding
+    are dropped).
+    Input:
+        batch - list of (pointcloud [N, 3], sample index)
+        num_points - size to pad to (default: the largest cloud)
+    Return:
+        points [B, 3, N], number of points per cloud [B], sample indices [B]
+    """
+    lengths = [pc.shape[0] for pc, _ in batch]
+    num_points = max(lengths) if num_points is None else num_points
+    points = np.stack([pc[np.arange(num_points) % pc.shape[0]] for pc, _ in batch])
+    points = torch.from_numpy(points).permute(0, 2, 1)
+    return points, torch.tensor(lengths), torch.tensor([item for _, item in batch])
+
+
+def valid_mask(lengths, num_points):
+    """
+    Input:
+        lengths - number of points of the clouds of a padded batch [B]
+        num_points - size of the padded clouds
+    Return:
+        valid points of the clouds [B, num_points] (the models' valid argument), None without padding
+    """
+    if bool((lengths == num_points).all()):
+        return None
+    return torch.arange(num_points) < lengths.view(-1, 1)
+
+
+class DevicePrefetcher():
+    """
+    Iterate a DataLoader with the host to device copy of the next batches done by a background thread
+    (non blocking copies from pinned memory), so the copies overlap the forward passes.
+    An error of the loader is raised by the iteration, it does not end it early.
+    """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+
+        def producer():
+            stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+            try:
+                for points, lengths, items in self.loader:
+                    if stream is not None:
+                        with torch.cuda.stream(stream):
+                            points = points.to(self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    else:
+                        points, event = points.to(self.device), None
+                    batches.put((points, lengths, items, event))
+                batches.put(None)
+            except Exception as e:  # a truncated prediction must not look like the end of the inputs
+                batches.put(e)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                thread.join()
+                raise batch
+            points, lengths, items, event = batch
+            if event is not None:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_event(event)
+                # allocated on the copy stream and used on this one: not reused before the forward is done
+                points.record_stream(stream)
+            yield points, lengths, items
+        thread.join()
+
+
+class Predictor():
+    """
+    Batched no-grad inference with a trained checkpoint.
+        predictor = Predictor('experiments/run/model.pt')
+        results = predictor.predict(['data/scans/'], out_path='predictions.npz')
+    """
+    def __init__(self, checkpoint, config=None, device=None, batch_size=32, num_workers=4, amp=False,
+                 num_points=NUM_POINTS, rotate=False):
+        self.model, self.config, self.task, self.head = load_model(checkpoint, config)
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if getattr(self.config, 'quantized', False):
+            device = 'cpu'  # int8 kernels are cpu only
+        self.device = torch.device(device)
+        self.model = self.model.to(self.device).eval()
+        self.config.amp = amp
+        self.config.amp_dtype = getattr(self.config, 'amp_dtype', 'fp16')
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.num_points = num_points
+        self.rotate = rotate
+
+    def loader(self, samples):
+        dataset = PointCloudFiles(samples, self.task, self.num_points, self.rotate)
+        return DataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+                          collate_fn=collate_point_clouds, pin_memory=self.device.type == 'cuda',
+                          prefetch_factor=4 if self.num_workers > 0 else None)
+
+    def stream(self, samples):
+        """
+        Yield (sample indices, logits, number of points) per batch; logits are [B, C] for classification
+        and [B, N, C] for segmentation (host tensors, padding included)
+        """
+        for points, lengths, items in DevicePrefetcher(self.loader(samples), self.device):
+            valid = valid_mask(lengths, points.size(2))
+            valid = valid.to(self.device) if valid is not None else None
+            yield items, self.forward(points, valid).cpu(), lengths
+
+    def forward(self, points, valid=None):
+        """
+        Input:
+            points - [B, 3, N] device tensor
+            valid - valid points of padded clouds [B, N] device tensor (see valid_mask), None without padding
+        Return:
+            float32 logits, [B, C] for classification and [B, N, C] for segmentation
+        """
+        with torch.no_grad(), autocast(self.config, self.device):
+            if isinstance(self.model, InferenceModel):
+                logits = self.model(points, valid=valid)
+            elif self.task == 'cls':
+                logits = self.model(points, activate_DefRec=False, valid=valid)[self.head]
+            else:
+                logits = self.model(points, make_seg=True, activate_DefRec=False, valid=valid)['seg']
+        return logits.float()
+
+    def predict(self, inputs, out_path=None, save_logits=False):
+        """
+        Input:
+            inputs - .npy/.h5 files, directories or file lists (see list_inputs)
+            out_path - optional .npz output file
+            save_logits - also keep the logits (float16)
+        Return:
+            dict with the sample names, the predicted labels (classification: [M]; segmentation: the per point
+            labels of all samples concatenated, with offsets [M + 1]), optionally the logits, and throughput stats
+        """
+        samples = list_inputs(inputs)
+        labels, logits, lengths_all, order = [], [], [], []
+        num_samples = num_points = 0
+        start = time.perf_counter()
+        for items, batch_logits, lengths in self.stream(samples):
+            preds = batch_logits.argmax(dim=-1)
+            for i in range(len(items)):
+                if self.task == 'cls':
+                    labels.append(preds[i:i + 1])
+                    if save_logits:
+                        logits.append(batch_logits[i:i + 1])
+                else:
+                    labels.append(preds[i, :lengths[i]])
+                    if save_logits:
+                        logits.append(batch_logits[i, :lengths[i]])
+            order.append(items)
+            lengths_all.append(lengths)
+            num_samples += len(items)
+            num_points += int(lengths.sum())
+        elapsed = time.perf_counter() - start
+
+        names = np.array([f if i is None else "%s:%d" % (f, i) for f, i in samples])
+        order = torch.cat(order).numpy() if order else np.zeros(0, dtype=np.int64)
+        lengths_all = torch.cat(lengths_all).numpy() if lengths_all else np.zeros(0, dtype=np.int64)
+        results = {'names': names[order]}
+        if self.task == 'cls':
+            results['labels'] = torch.cat(labels).numpy().astype(np.int16) if labels else np.zeros(0, np.int16)
+            results['class_names'] = np.array([idx_to_label[i] for i in range(len(idx_to_label))])
+        else:
+            results['labels'] = torch.cat(labels).numpy().astype(np.uint8) if labels else np.zeros(0, np.uint8)
+            results['offsets'] = np.concatenate(([0], np.cumsum(lengths_all))).astype(np.int64)
+        if save_logits and logits:
+            results['logits'] = torch.cat(logits).numpy().astype(np.float16)
+        if out_path is not None:
+            np.savez_compressed(out_path, **results)
+        results['stats'] = {'samples': num_samples, 'points': num_points, 'seconds': elapsed,
+                            'samples_per_s': num_samples / elapsed if elapsed > 0 else 0.0,
+                            'points_per_s': num_points / elapsed if elapsed > 0 else 0.0}
+        return results
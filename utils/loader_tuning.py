@@ -0,0 +1,185 @@
+import json
+import os
+import platform
+import time
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+from utils.dist_utils import barrier
+from utils.point_batch import PointCollate
+
+DEFAULT_TUNING_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'DefRec_and_PCM', 'loader_tuning.json')
+
+
+def default_config(num_workers):
+    """
+    Return: loader configuration of the trainers without tuning
+    """
+    return {'num_workers': num_workers, 'prefetch_factor': 2, 'pin_memory': False, 'persistent_workers': False,
+            'worker_threads': 0}
+
+
+class WorkerInit():
+    """
+    worker_init_fn setting the torch intra-op threads of the loader workers (0 - torch default)
+    """
+    def __init__(self, threads):
+        self.threads = threads
+
+    def __call__(self, worker_id):
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+
+
+def loader_kwargs(config, persistent=True, collate_fn=None):
+    """
+    Return: DataLoader keyword arguments of a loader configuration (the batches are collated into PointBatch)
+    Input:
+        persistent - keep persistent workers if configured (False for the evaluation loaders, their
+                     workers would stay alive next to those of the train loaders)
+        collate_fn - collate function instead of PointCollate (AugmentCollate)
+    """
+    kwargs = {'num_workers': config['num_workers'], 'pin_memory': config['pin_memory'],
+              'collate_fn': collate_fn or PointCollate(config['pin_memory'])}
+    if config['num_workers'] > 0:
+        kwargs.update(prefetch_factor=config['prefetch_factor'],
+                      persistent_workers=config['persistent_workers'] and persistent,
+                      worker_init_fn=WorkerInit(config['worker_threads']))
+    return kwargs
+
+
+def host_key():
+    """
+    Return: the machine the configurations are tuned for (host name, cpus and accelerator)
+    """
+    gpu = torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'cpu'
+    return "%s/%dcpu/%s" % (platform.node(), os.cpu_count() or 1, gpu)
+
+
+def load_config(dataset_key, path=DEFAULT_TUNING_FILE):
+    """
+    Return: the tuned loader configuration of dataset_key on this host, None if not tuned
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        entry = json.load(f).get(host_key(), {}).get(dataset_key)
+    return entry['config'] if entry else None
+
+
+def save_config(dataset_key, config, results=None, path=DEFAULT_TUNING_FILE):
+    """
+    Persist the loader configuration of dataset_key on this host (with the benchmark results of the tuning)
+    """
+    tuned = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            tuned = json.load(f)
+    tuned.setdefault(host_key(), {})[dataset_key] = {'config': config, 'results': results or [],
+                                                     'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(tuned, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def resolve_config(dataset_key, num_workers, path=DEFAULT_TUNING_FILE, use_tuned=True):
+    """
+    Return: the tuned configuration of dataset_key if there is one (and use_tuned), else the
+    default configuration with num_workers, and whether it is tuned
+    """
+    config = load_config(dataset_key, path) if use_tuned else None
+    if config is None:
+        return default_config(num_workers), False
+    if config['pin_memory'] and not torch.cuda.is_available():
+        config = dict(config, pin_memory=False)
+    return config, True
+
+
+def benchmark_loader(dataset, batch_size, config, num_batches=20, epochs=2, device=None):
+    """
+    Time loading num_batches random batches in each of epochs passes over one DataLoader (the worker
+    startup is paid per pass unless the workers are persistent); the batches are copied to device
+    when it is cuda (non blocking from pinned memory).
+    Return: samples per second over all the passes
+    """
+    num_samples = min(len(dataset), num_batches * batch_size)
+    sampler = RandomSampler(dataset, num_samples=num_samples)
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=True, **loader_kwargs(config))
+    copy = device is not None and device.type == 'cuda'
+    loaded = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch in loader:
+            if copy:
+                batch = batch.to(device)
+            loaded += len(batch)
+        if copy:
+            torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    del loader
+    return loaded / elapsed
+
+
+def candidate_values(device, max_workers=None):
+    """
+    Return: the searched values of every loader option (pinning only with cuda)
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    workers = sorted({w for w in (0, 1, 2, 4, 8, 12, 16, 24, 32) if w <= max_workers} | {max_workers})
+    return {'num_workers': workers,
+            'prefetch_factor': [2, 4, 8],
+            'worker_threads': [1, 2, 0],
+            'persistent_workers': [False, True],
+            'pin_memory': [False, True] if device is not None and device.type == 'cuda' else [False]}
+
+
+def tune_loader(dataset, batch_size, device=None, start=None, num_batches=20, epochs=2, max_workers=None,
+                min_gain=0.03, log=print):
+    """
+    Coordinate search of the loader configuration: the options are tuned one after the other in the
+    order of candidate_values, each keeping the best values found so far for the others. A value
+    replaces the best one when it is faster by more than min_gain (relative), not on noise.
+    Return: the best configuration and the benchmark results ([config, samples/s] per run)
+    """
+    best = dict(start or default_config(min(4, os.cpu_count() or 1)))
+    results = []
+    best_rate = None
+    for option, values in candidate_values(device, max_workers).items():
+        if best['num_workers'] == 0 and option in ('prefetch_factor', 'worker_threads', 'persistent_workers'):
+            continue  # options of the worker processes
+        for value in values:
+            config = dict(best, **{option: value})
+            if best_rate is not None and config == best:
+                continue
+            rate = benchmark_loader(dataset, batch_size, config, num_batches, epochs, device)
+            results.append([config, rate])
+            log("  %-50s %10.1f samples/s" % (' '.join('%s=%s' % kv for kv in sorted(config.items())), rate))
+            if best_rate is None or rate > best_rate * (1 + min_gain):
+                best, best_rate = config, rate
+    return best, results
+
+
+def dataset_key(task, dataroot, dataset):
+    """
+    Return: key of the tuned configurations of a dataset (the data root tells real and synthetic data apart)
+    """
+    return "%s/%s:%s" % (task, dataset, os.path.abspath(dataroot))
+
+
+def trainer_loader_config(args, key, dataset, batch_size, num_workers, device, io):
+    """
+    Loader configuration of a trainer dataset: tuned and persisted first with --tune_loader (by the
+    main process), the persisted one of this host with --tuned_loader, else the defaults with num_workers
+    """
+    if args.tune_loader:
+        if getattr(args, 'rank', 0) == 0:
+            io.cprint("Tuning the loader of %s" % key)
+            config, results = tune_loader(dataset, batch_size, device, start=default_config(num_workers),
+                                          log=io.cprint)
+            save_config(key, config, results, args.loader_tuning_file)
+        barrier()
+    config, tuned = resolve_config(key, num_workers, args.loader_tuning_file, args.tuned_loader or args.tune_loader)
+    io.cprint("Loader of %s (%s): %s" % (key, "tuned" if tuned else "default",
+                                         ', '.join('%s=%s' % kv for kv in sorted(config.items()))))
+    return config
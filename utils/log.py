@@ -1,10 +1,16 @@
 import datetime
+import json
+import queue
+import sys
+import threading
+import time
 import pandas as pd
 import copy
 import torch
 import os
 import sklearn.metrics as metrics
 from PointDA.data.dataloader import label_to_idx
+from utils.metrics import accuracy_from_conf_mat
 
 
 class IOStream():
@@ -13,20 +19,40 @@ class IOStream():
     """
     def __init__(self, args):
         self.path = args.out_path + '/' + args.exp_name
-        if not os.path.exists(self.path):
+        # in distributed runs only the first process logs
+        self.is_main = getattr(args, 'rank', 0) == 0
+        if self.is_main and not os.path.exists(self.path):
             os.makedirs(self.path)
-        self.f = open(self.path + '/run.log', 'a')
+        self.f = open(self.path + '/run.log', 'a') if self.is_main else None
         self.args = args
+        # the log file is flushed at most every flush_interval seconds (and on close)
+        self.flush_interval = getattr(args, 'log_flush_interval', 1.0)
+        self.last_flush = time.time()
 
     def cprint(self, text):
+        if not self.is_main:
+            return
         datetime_string = datetime.datetime.now().strftime("%d-%m-%y %H:%M:%S")
         to_print = "%s: %s" % (datetime_string, text)
         print(to_print)
         self.f.write(to_print + "\n")
-        self.f.flush()
+        now = time.time()
+        if now - self.last_flush >= self.flush_interval:
+            self.f.flush()
+            self.last_flush = now
 
     def close(self):
-        self.f.close()
+        if self.f is not None:
+            self.f.close()
+
+    def save_args(self):
+        """
+        Write the command line arguments to args.json, the config used to rebuild the model for inference
+        """
+        if not self.is_main:
+            return
+        with open(self.path + '/args.json', 'w') as f:
+            json.dump(vars(self.args), f, indent=2, default=str)
 
     def save_model(self, model):
         path = self.path + '/model.pt'
@@ -39,10 +65,13 @@ class IOStream():
         fname = domain_set + "_" + fname
         df.to_csv(self.path + "/" + fname)
 
-    def print_progress(self, domain_set, partition, epoch, print_losses, true=None, pred=None):
+    def print_progress(self, domain_set, partition, epoch, print_losses, true=None, pred=None, conf_mat=None):
         outstr = "%s - %s %d" % (partition, domain_set, epoch)
         acc = 0
-        if true is not None and pred is not None:
+        if conf_mat is not None:
+            acc, avg_per_class_acc = accuracy_from_conf_mat(conf_mat)
+            outstr += ", acc: %.4f, avg acc: %.4f" % (acc, avg_per_class_acc)
+        elif true is not None and pred is not None:
             acc = metrics.accuracy_score(true, pred)
             avg_per_class_acc = metrics.balanced_accuracy_score(true, pred)
             outstr += ", acc: %.4f, avg acc: %.4f" % (acc, avg_per_class_acc)
@@ -51,3 +80,170 @@ class IOStream():
             outstr += ", %s loss: %.4f" % (loss, loss_val)
         self.cprint(outstr)
         return acc
+
+
+class StdoutBackend():
+    """
+    Print metric records to the screen
+    """
+    def write(self, record):
+        step = "" if record.get('step') is None else " step %d:" % record['step']
+        print("metrics%s %s" % (step, ", ".join("%s: %.4f" % (k, v) for k, v in record['metrics'].items())))
+
+    def close(self):
+        pass
+
+
+class JsonlBackend():
+    """
+    Write metric records as json lines to a local file, rotated when it exceeds max_bytes
+    """
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.f = open(self.path, 'a')
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src, dst = "%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1)
+            if os.path.exists(src):
+                os.replace(src, dst)
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.f = open(self.path, 'a')
+
+    def write(self, record):
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        if self.max_bytes > 0 and self.f.tell() >= self.max_bytes:
+            self.rotate()
+
+    def close(self):
+        self.f.close()
+
+
+class WandbBackend():
+    """
+    Send metric records to Weights & Biases
+    """
+    def __init__(self, **init_kwargs):
+        import wandb
+        self.wandb = wandb
+        self.run = wandb.init(**init_kwargs)
+
+    def write(self, record):
+        if record.get('step') is None:
+            self.wandb.log(record['metrics'])
+        else:
+            self.wandb.log(record['metrics'], step=record['step'])
+
+    def close(self):
+        self.run.finish()
+
+
+class MetricsSink():
+    """
+    Buffered asynchronous metrics logging.
+    Scalars logged for the same step are merged into one record which is written to all backends
+    from a background thread. When the queue is full, policy 'block' waits for the writer
+    (back-pressure) and policy 'drop' discards the record.
+    A backend that fails to write a record (network error, full disk) is reported once and skipped
+    for that record, the writer keeps draining the queue for the other records and backends.
+    """
+    def __init__(self, backends, max_queue=1024, policy='block'):
+        assert policy in ('block', 'drop')
+        self.backends = backends
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = {}
+        self.pending_step = None
+        self.dropped = 0
+        self.failed = {}  # backend name -> number of records it failed to write
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def log(self, metrics, step=None, commit=True):
+        """
+        Input:
+            metrics - dict of scalars (python numbers)
+            step - optional global step of the record
+            commit - if False, the scalars are merged with the following log calls into a single record
+        """
+        if step is not None and self.pending_step is not None and step != self.pending_step:
+            self.commit()
+        self.pending.update(metrics)
+        if step is not None:
+            self.pending_step = step
+        if commit:
+            self.commit()
+
+    def commit(self):
+        if len(self.pending) == 0:
+            return
+        record = {'time': time.time(), 'step': self.pending_step, 'metrics': self.pending}
+        self.pending = {}
+        self.pending_step = None
+        if self.policy == 'block':
+            self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+    def _writer(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for backend in self.backends:
+                try:
+                    backend.write(record)
+                except Exception as e:
+                    self.report(backend, 'write', e)
+
+    def report(self, backend, action, error):
+        name = type(backend).__name__
+        if name not in self.failed:
+            print("metrics backend %s failed to %s (reported once, its failures are counted): %r"
+                  % (name, action, error), file=sys.stderr)
+        self.failed[name] = self.failed.get(name, 0) + 1
+
+    def close(self):
+        self.commit()
+        self.queue.put(None)
+        self.thread.join()
+        for backend in self.backends:
+            try:
+                backend.close()
+            except Exception as e:
+                self.report(backend, 'close', e)
+
+
+def build_metrics_sink(args, path, wandb_kwargs=None):
+    """
+    Input:
+        args - command line arguments (metrics_backends, metrics_queue_size, metrics_policy)
+        path - experiment folder for the jsonl backend
+        wandb_kwargs - arguments of wandb.init
+    Return:
+        MetricsSink with the requested backends
+    """
+    backends = []
+    # in distributed runs only the first process logs
+    names = args.metrics_backends.split(',') if getattr(args, 'rank', 0) == 0 else []
+    for name in names:
+        name = name.strip()
+        if name == 'wandb':
+            backends.append(WandbBackend(**(wandb_kwargs or {})))
+        elif name == 'jsonl':
+            backends.append(JsonlBackend(os.path.join(path, 'metrics.jsonl')))
+        elif name == 'stdout':
+            backends.append(StdoutBackend())
+        elif name != '':
+            raise ValueError("Unknown metrics backend: " + name)
+    return MetricsSink(backends, max_queue=args.metrics_queue_size, policy=args.metrics_policy)
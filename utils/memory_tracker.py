@@ -0,0 +1,229 @@
+import json
+import os
+import resource
+import torch
+
+MB = 1024.0 ** 2
+
+
+def host_rss():
+    """
+    Return: current and peak resident set size of the process (bytes); the peak is the one since
+    the last reset_host_peak (Linux), or since the process start
+    """
+    current = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return current if current is not None else peak, peak
+
+
+def reset_host_peak():
+    """
+    Reset the peak RSS of the process to its current RSS (Linux >= 4.0)
+    Return: whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class MemoryTracker():
+    """
+    Peak and current memory of the stages of a training step and of the model submodules, for the
+    torch allocator of the device (cuda) and the host RSS.
+        tracker = MemoryTracker(device, path='memory.jsonl')
+        tracker.attach(model)            # a stage per submodule forward, through forward hooks
+        with tracker.stage('forward'):
+            ...
+        tracker.end_step(step)           # a row of the per-step table
+        tracker.log(io, epoch)           # per stage maxima of the epoch, top allocators flagged
+    The peak counters are reset when a stage starts, so a stage reports its own high water mark;
+    nested stages are also charged to their parents. Per stage call it records the peak (absolute),
+    the transient allocation (peak - current at the stage start) and the retained allocation
+    (current at the end - current at the start). Without the host peak reset (not Linux), the
+    host peak is the maximum of the RSS at the stage start and end.
+    Stages of a StageProfiler created with memory=tracker are tracked too (see utils.profiler).
+    """
+    def __init__(self, device, top_k=5, path=None):
+        self.cuda = device is not None and device.type == 'cuda'
+        self.device = device
+        self.top_k = top_k
+        self.path = path
+        self.host_reset = reset_host_peak()
+        self.stack = []
+        self.step_stats = {}
+        self.epoch_stats = {}
+        self.hooks = []
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def read(self):
+        """
+        Return: current and peak device allocator memory, current and peak host RSS (bytes)
+        """
+        if self.cuda:
+            dev_current = torch.cuda.memory_allocated(self.device)
+            dev_peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            dev_current = dev_peak = 0
+        host_current, host_peak = host_rss()
+        if not self.host_reset:
+            host_peak = host_current
+        return dev_current, dev_peak, host_current, host_peak
+
+    def reset_peaks(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        if self.host_reset:
+            reset_host_peak()
+
+    def enter(self, name):
+        dev_current, dev_peak, host_current, host_peak = self.read()
+        if self.stack:  # the peak of the parent until now, before the reset
+            parent = self.stack[-1]
+            parent['dev_peak'] = max(parent['dev_peak'], dev_peak)
+            parent['host_peak'] = max(parent['host_peak'], host_peak)
+        self.reset_peaks()
+        self.stack.append({'name': name, 'dev_start': dev_current, 'host_start': host_current,
+                           'dev_peak': dev_current, 'host_peak': host_current})
+
+    def exit(self, name):
+        # frames of stages left by an exception (forward hooks are not called) are dropped
+        while self.stack and self.stack[-1]['name'] != name:
+            self.stack.pop()
+        if not self.stack:
+            return
+        frame = self.stack.pop()
+        dev_current, dev_peak, host_current, host_peak = self.read()
+        dev_peak = max(frame['dev_peak'], dev_peak)
+        host_peak = max(frame['host_peak'], host_peak, host_current)
+        if self.stack:
+            parent = self.stack[-1]
+            parent['dev_peak'] = max(parent['dev_peak'], dev_peak)
+            parent['host_peak'] = max(parent['host_peak'], host_peak)
+        self.reset_peaks()
+        self.record(name, {'dev_peak': dev_peak, 'dev_alloc': dev_peak - frame['dev_start'],
+                           'dev_retained': dev_current - frame['dev_start'], 'host_peak': host_peak,
+                           'host_alloc': host_peak - frame['host_start'],
+                           'host_retained': host_current - frame['host_start']})
+
+    def record(self, name, values):
+        stats = self.step_stats.get(name)
+        if stats is None:
+            self.step_stats[name] = dict(values, calls=1)
+            return
+        stats['calls'] += 1
+        for key, value in values.items():
+            stats[key] = max(stats[key], value)
+
+    def stage(self, name):
+        """
+        Context tracking the memory of the enclosed code as stage name
+        """
+        return _TrackedStage(self, name)
+
+    def attach(self, model, depth=1, prefix='module:'):
+        """
+        Track the forward pass of the submodules of model down to depth (1 - its children) as stages
+        prefix + submodule name, through forward hooks. Attach before wrapping the model
+        (DistributedDataParallel, torch.compile).
+        """
+        for name, module in model.named_modules():
+            if not name or name.count('.') >= depth:
+                continue
+            stage_name = prefix + name
+            self.hooks.append(module.register_forward_pre_hook(
+                lambda m, inputs, stage_name=stage_name: self.enter(stage_name)))
+            self.hooks.append(module.register_forward_hook(
+                lambda m, inputs, outputs, stage_name=stage_name: self.exit(stage_name)))
+
+    def detach(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def end_step(self, step):
+        """
+        Close the row of step: appended to the jsonl file and merged into the epoch maxima
+        """
+        if not self.step_stats:
+            return
+        if self.path is not None:
+            row = {'step': step, 'stages': {name: {key: (value / MB if key != 'calls' else value)
+                                                   for key, value in stats.items()}
+                                            for name, stats in self.step_stats.items()}}
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(row) + '\n')
+        for name, stats in self.step_stats.items():
+            epoch = self.epoch_stats.get(name)
+            if epoch is None:
+                self.epoch_stats[name] = dict(stats)
+                continue
+            for key, value in stats.items():
+                epoch[key] = epoch[key] + value if key == 'calls' else max(epoch[key], value)
+        self.step_stats = {}
+
+    def top_allocators(self, stats=None):
+        """
+        Return: names of the top_k stages/submodules by transient allocation (device memory on cuda,
+        host RSS otherwise); the outer stages of the step are left out
+        """
+        stats = self.epoch_stats if stats is None else stats
+        key = 'dev_alloc' if self.cuda else 'host_alloc'
+        names = [n for n in stats if n not in ('forward', 'backward', 'validation') and stats[n][key] > 0]
+        return sorted(names, key=lambda n: -stats[n][key])[:self.top_k]
+
+    def table(self, stats=None):
+        """
+        Return: lines of the memory table of stats (default: the epoch maxima), sorted by peak
+        """
+        stats = self.epoch_stats if stats is None else stats
+        key = 'dev_peak' if self.cuda else 'host_peak'
+        top = self.top_allocators(stats)
+        lines = ["  %-28s %7s %10s %10s %10s %10s %10s %10s"
+                 % ('stage', 'calls', 'dev peak', 'dev alloc', 'dev kept', 'rss peak', 'rss alloc', 'rss kept')]
+        for name, s in sorted(stats.items(), key=lambda kv: -kv[1][key]):
+            flag = "  <- top %d" % (top.index(name) + 1) if name in top else ""
+            lines.append("  %-28s %7d %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f%s"
+                         % (name, s['calls'], s['dev_peak'] / MB, s['dev_alloc'] / MB, s['dev_retained'] / MB,
+                            s['host_peak'] / MB, s['host_alloc'] / MB, s['host_retained'] / MB, flag))
+        return lines
+
+    def log(self, io, epoch):
+        """
+        Write the memory table of the epoch (MB, maxima over the steps) to the run log
+        """
+        self.end_step('epoch_%d' % epoch)  # stages after the last step (validation, checkpoint)
+        if not self.epoch_stats:
+            return
+        io.cprint("Memory of epoch %d (MB, max over the calls; alloc - peak above the stage start, "
+                  "kept - retained at the stage end)%s" % (epoch, "" if self.host_reset else
+                                                           ", no host peak reset: rss peak at the stage ends"))
+        for line in self.table():
+            io.cprint(line)
+        self.epoch_stats = {}
+
+
+class _TrackedStage():
+    def __init__(self, tracker, name):
+        self.tracker = tracker
+        self.name = name
+
+    def __enter__(self):
+        self.tracker.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.tracker.exit(self.name)
+        return False
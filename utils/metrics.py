@@ -0,0 +1,160 @@
+import numpy as np
+import torch
+from utils.dist_utils import all_reduce_sum
+
+
+def accuracy_from_conf_mat(conf_mat):
+    """
+    Input:
+        conf_mat - confusion matrix [num_classes, num_classes], rows are true labels
+    Return:
+        accuracy, average per class accuracy (balanced accuracy)
+    """
+    conf_mat = np.asarray(conf_mat, dtype=np.float64)
+    total = conf_mat.sum()
+    acc = np.trace(conf_mat) / total if total > 0 else 0.0
+    support = conf_mat.sum(axis=1)
+    present = support > 0  # classes without samples are ignored, as in sklearn
+    if not np.any(present):
+        return acc, 0.0
+    per_class_acc = np.diag(conf_mat)[present] / support[present]
+    return acc, per_class_acc.mean()
+
+
+class ClassificationEvaluator():
+    """
+    Streaming evaluation of a classifier.
+    The loss sum and the confusion matrix are accumulated on the device, so a full
+    evaluation pass needs a single host synchronization (in compute()).
+    """
+    def __init__(self, num_classes=10, device="cpu"):
+        self.num_classes = num_classes
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.count = torch.zeros((), dtype=torch.long, device=self.device)
+        self.conf_mat = torch.zeros(self.num_classes, self.num_classes, dtype=torch.long, device=self.device)
+
+    def update(self, logits, labels, loss=None):
+        """
+        Input:
+            logits - [B, num_classes]
+            labels - [B]
+            loss - mean loss over the batch (tensor), optional
+        """
+        labels = labels.view(-1)
+        preds = logits.detach().argmax(dim=1).view(-1)
+        batch_size = labels.numel()
+        if loss is not None:
+            self.loss_sum += loss.detach().double() * batch_size
+        self.count += batch_size
+        bins = labels * self.num_classes + preds
+        self.conf_mat += torch.bincount(bins, minlength=self.num_classes ** 2).view(self.num_classes,
+                                                                                     self.num_classes)
+
+    def all_reduce(self):
+        """
+        Sum the accumulated statistics over all processes of the default group (no-op if not distributed)
+        """
+        for t in (self.loss_sum, self.count, self.conf_mat):
+            all_reduce_sum(t)
+
+    def compute(self):
+        """
+        Return:
+            dict with the mean loss, accuracy, average per class accuracy and the confusion matrix (numpy)
+        """
+        # one transfer for everything
+        stats = torch.cat((self.loss_sum.view(1), self.count.double().view(1),
+                           self.conf_mat.double().view(-1))).cpu().numpy()
+        loss_sum, count = stats[0], stats[1]
+        conf_mat = stats[2:].reshape(self.num_classes, self.num_classes).astype(int)
+        acc, avg_per_class_acc = accuracy_from_conf_mat(conf_mat)
+        return {'loss': loss_sum / count if count > 0 else 0.0,
+                'acc': acc,
+                'avg_acc': avg_per_class_acc,
+                'conf_mat': conf_mat,
+                'count': int(count)}
+
+
+class LossTracker():
+    """
+    Deferred loss accounting.
+    Losses are detached and accumulated on the device; values are moved to the host only when
+    step_values() hits the logging interval or when an epoch's averages are read with flush().
+    """
+    def __init__(self, log_interval=0, device="cpu"):
+        self.log_interval = log_interval
+        self.device = device
+        self.sums = {}
+        self.counts = {}
+        self.last = {}
+
+    def reset(self, group, keys):
+        """
+        Input:
+            group - name of the statistics group (e.g. source/target)
+            keys - loss names of the group
+        """
+        self.sums[group] = {key: None for key in keys}
+        self.counts[group] = 0
+
+    def update(self, group, key, loss, batch_size, log_name=None):
+        """
+        Input:
+            loss - mean loss over the batch (tensor)
+            batch_size - number of samples the loss was averaged over
+            log_name - if given, the value is also reported by step_values()
+        """
+        val = loss.detach() * batch_size
+        prev = self.sums[group][key]
+        self.sums[group][key] = val if prev is None else prev + val
+        if log_name is not None:
+            self.last[log_name] = loss.detach()
+
+    def count(self, group, batch_size):
+        self.counts[group] += batch_size
+
+    def step_values(self, step):
+        """
+        Return:
+            host values of the losses registered for logging since the last call, every log_interval
+            steps (one synchronization); None otherwise
+        """
+        if self.log_interval <= 0 or step % self.log_interval != 0 or len(self.last) == 0:
+            return None
+        names = list(self.last.keys())
+        vals = torch.stack([self.last[n].float().view(()) for n in names]).cpu().tolist()
+        self.last = {}
+        return dict(zip(names, vals))
+
+    def state_dict(self):
+        """
+        Return: host copy of the accumulated sums and counts (for checkpointing)
+        """
+        return {'sums': {g: {k: None if v is None else float(v) for k, v in d.items()}
+                         for g, d in self.sums.items()},
+                'counts': dict(self.counts)}
+
+    def load_state_dict(self, state):
+        self.sums = {g: {k: None if v is None else torch.tensor(v, device=self.device) for k, v in d.items()}
+                     for g, d in state['sums'].items()}
+        self.counts = dict(state['counts'])
+
+    def flush(self, group):
+        """
+        Return:
+            dict of average losses of the group over all processes (host floats)
+        """
+        keys = list(self.sums[group].keys())
+        vals = [self.sums[group][k] for k in keys]
+        dev = next((v.device for v in vals if v is not None), self.device)
+        vals = [torch.zeros((), device=dev) if v is None else v.float().view(()) for v in vals]
+        vals.append(torch.tensor(float(self.counts[group]), device=dev))
+        vals = all_reduce_sum(torch.stack(vals)).cpu().tolist()
+        count = vals.pop()
+        if count == 0:
+            return {k: 0.0 for k in keys}
+        return {k: v * 1.0 / count for k, v in zip(keys, vals)}
@@ -1,5 +1,7 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
+from utils.profiler import profiled
 
 
 eps = 10e-4
@@ -30,6 +32,34 @@ def region_mean(num_regions):
     return lookup
 
 
+def masked_max(x, valid):
+    """
+    Input:
+        x: point features [B, C, N, ...]
+        valid: valid points of the padded shapes [B, N], None if all the points are valid
+    Return:
+        max over the valid points [B, C, ...]
+    """
+    if valid is None:
+        return torch.max(x, dim=2)[0]
+    valid = valid.view(valid.size(0), 1, valid.size(1), *([1] * (x.dim() - 3)))
+    return x.masked_fill(~valid, float('-inf')).max(dim=2)[0]
+
+
+def masked_mean(x, valid):
+    """
+    Input:
+        x: point features [B, C, N]
+        valid: valid points of the padded shapes [B, N], None if all the points are valid
+    Return:
+        mean over the valid points [B, C]
+    """
+    if valid is None:
+        return F.adaptive_avg_pool1d(x, 1).view(x.size(0), -1)
+    valid = valid.unsqueeze(1).to(x.dtype)
+    return (x * valid).sum(dim=2) / valid.sum(dim=2).clamp(min=1)
+
+
 def assign_region_to_point(X, device):
     """
     Input:
@@ -73,6 +103,23 @@ def assign_region_to_point(X, device):
     return Y
 
 
+def assign_region_to_point_np(X):
+    """
+    numpy assign_region_to_point (loader workers)
+    Input:
+        X: point cloud [B, C, N]
+    Return:
+        Y: Region assignment per point [B, N]
+    """
+    n = NREGIONS
+    d = 2 / n
+    X_clip = np.clip(X[:, :3, :], -0.99999999, 0.99999999)
+    # voxel of each coordinate, the regions are numbered over x, then y, then z
+    voxel = np.clip(np.floor((X_clip + 1) / d), 0, n - 1).astype(np.int64)
+    return voxel[:, 0, :] * n * n + voxel[:, 1, :] * n + voxel[:, 2, :]
+
+
+@profiled('collapse_to_point')
 def collapse_to_point(x, device):
     """
     Input:
@@ -111,6 +158,29 @@ def collapse_to_point(x, device):
     return x, indices
 
 
+def collapse_to_point_np(x):
+    """
+    numpy collapse_to_point (loader workers)
+    Input:
+        X: point cloud [C, N], deformed in place
+    Return:
+        x: the deformed point cloud
+        indices: the points that were clustered
+    """
+    xyz = x[:3, :]
+    pairwise_distance = np.sum((xyz[:, :, None] - xyz[:, None, :]) ** 2, axis=0)
+    mask = pairwise_distance <= RADIUS ** 2
+
+    # choose only from points that have more than MIN_POINTS within a RADIUS of them
+    candidates = np.nonzero(np.sum(mask, axis=1) >= MIN_POINTS)[0]
+    point_ind = np.random.choice(candidates)
+
+    # draw a gaussian centered at the point for points falling in the region
+    indices = np.nonzero(mask[point_ind])[0]
+    x[:3, indices] = draw_from_gaussian(xyz[:, point_ind].copy(), len(indices))
+    return x, indices
+
+
 def draw_from_gaussian(mean, num_points):
     """
     Input:
@@ -142,7 +212,7 @@ def farthest_point_sample(args, xyz, npoint):
     Return:
         centroids: sampled pointcloud index, [B, npoint]
     """
-    device = torch.device("cuda:" + str(xyz.get_device()) if args.cuda else "cpu")
+    device = xyz.device
 
     B, C, N = xyz.shape
     centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
@@ -161,11 +231,12 @@ def farthest_point_sample(args, xyz, npoint):
     return centroids, centroids_vals
 
 
-def farthest_point_sample_np(xyz, npoint):
+def farthest_point_sample_np(xyz, npoint, rng=None):
     """
     Input:
         xyz: pointcloud data, [B, C, N]
         npoint: number of samples
+        rng: np.random.RandomState of the random start points (default: the global numpy generator)
     Return:
         centroids: sampled pointcloud index, [B, npoint]
     """
@@ -173,7 +244,7 @@ def farthest_point_sample_np(xyz, npoint):
     B, C, N = xyz.shape
     centroids = np.zeros((B, npoint), dtype=np.int64)
     distance = np.ones((B, N)) * 1e10
-    farthest = np.random.randint(0, N, (B,), dtype=np.int64)
+    farthest = (np.random if rng is None else rng).randint(0, N, (B,), dtype=np.int64)
     batch_indices = np.arange(B, dtype=np.int64)
     centroids_vals = np.zeros((B, C, npoint))
     for i in range(npoint):
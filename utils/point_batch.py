@@ -0,0 +1,217 @@
+import multiprocessing
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from DefRec_and_PCM import DefRec, PCM
+from utils.pc_utils import farthest_point_sample_np
+
+IGNORE_INDEX = -100  # label of the padding of per point labels (ignored by nn.CrossEntropyLoss)
+
+
+class PointBatch():
+    """
+    Batch of point clouds as the models take them, channel first [B, C, N], with their labels ([B] per
+    shape or [B, N] per point), an optional mask and the dataset indices of the samples (kept on the host).
+    Shapes of different point counts are padded to the largest one, valid [B, N] tells their points
+    from the padding (None when the shapes have the same point count).
+    With the augmentations drawn by the loader (AugmentCollate) it also holds the DefRec deformed shapes
+    (mask - their deformed points) and the PCM mixed shapes, with the labels of the two mixed shapes and
+    the proportion (the mixed point labels in labels_a for segmentation).
+    The consumers index the tensors of the batch (views), they do not permute or copy them.
+    """
+    TENSORS = ('points', 'labels', 'valid', 'mask', 'deformed', 'mixed', 'labels_a', 'labels_b')
+
+    def __init__(self, points, labels, valid=None, mask=None, index=None, deformed=None, mixed=None, labels_a=None,
+                 labels_b=None, lam=None):
+        self.points = points
+        self.labels = labels
+        self.valid = valid
+        self.mask = mask
+        self.index = index
+        self.deformed = deformed
+        self.mixed = mixed
+        self.labels_a = labels_a
+        self.labels_b = labels_b
+        self.lam = lam
+
+    def __len__(self):
+        return self.points.size(0)
+
+    def valid_mask(self, rows=slice(None)):
+        """
+        Return: valid points of the rows of the batch (the models' valid argument), None without padding
+        """
+        return None if self.valid is None else self.valid[rows]
+
+    def apply(self, fn):
+        """
+        Return: batch of fn applied to the tensors of the batch (the indices stay on the host)
+        """
+        batch = PointBatch(**self.__dict__)
+        for name in self.TENSORS:
+            if getattr(self, name) is not None:
+                setattr(batch, name, fn(getattr(self, name)))
+        return batch
+
+    def to(self, device):
+        """
+        Return: the batch on device, all its tensors copied at once without blocking (from pinned memory
+        the copies overlap the host work until the tensors are used); the same batch if it is already there
+        """
+        if self.points.device == torch.device(device):
+            return self
+        return self.apply(lambda t: t.to(device, non_blocking=True))
+
+    def pin_memory(self):
+        # called by the DataLoader (pin_memory) and the worker pool, pinning a pinned tensor is free
+        return self.apply(lambda t: t.pin_memory())
+
+
+def in_worker():
+    """
+    Return: whether this is a loader worker process (DataLoader or worker pool), its batches are sent to
+    the main process through shared memory
+    """
+    return get_worker_info() is not None or multiprocessing.parent_process() is not None
+
+
+class PointCollate():
+    """
+    Collate of the (point cloud [N, C], label[, index]) samples of the datasets into a PointBatch: every
+    point cloud is transposed straight into its slot of the [B, C, N] batch, no [B, N, C] batch is
+    stacked and permuted. Shapes with fewer points than the largest one of the batch are padded by
+    repeating their points (the padding is a copy of the shape, not points at the origin, for the layers
+    that are not masked - batch norm statistics) and their per point labels with IGNORE_INDEX. The batch is allocated where it is sent: in shared memory in the loader workers
+    (not copied again to reach the main process), in pinned memory in the main process with pin_memory
+    (the cuda caching host allocator serves the buffers of the previous batches once their copies are
+    done, so after the first batches no memory is allocated).
+    """
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
+
+    def empty(self, shape, dtype):
+        """
+        Return: uninitialized batch tensor, in shared memory in the loader workers, pinned with pin_memory
+        """
+        if in_worker():
+            numel = int(np.prod(shape))
+            storage = torch.UntypedStorage._new_shared(numel * torch.empty(0, dtype=dtype).element_size())
+            return torch.empty(0, dtype=dtype).set_(storage).view(shape)
+        return torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory and torch.cuda.is_available())
+
+    def __call__(self, samples):
+        counts = [len(sample[0]) for sample in samples]
+        num_points, channels = max(counts), np.shape(samples[0][0])[1]
+        ragged = min(counts) < num_points
+        per_point = np.size(samples[0][1]) > 1
+        label_shape = (num_points,) if per_point else ()  # labels [1] of the h5 datasets are flattened
+        points = self.empty((len(samples), channels, num_points), torch.float32)
+        labels = self.empty((len(samples),) + label_shape, torch.int64)
+        points_np, labels_np = points.numpy(), labels.numpy()
+        for i, sample in enumerate(samples):
+            if counts[i] == num_points:
+                points_np[i] = np.asarray(sample[0]).T
+                labels_np[i] = np.reshape(sample[1], label_shape)
+            else:
+                points_np[i] = np.asarray(sample[0])[np.arange(num_points) % counts[i]].T
+                if per_point:
+                    labels_np[i, :counts[i]] = sample[1]
+                    labels_np[i, counts[i]:] = IGNORE_INDEX
+                else:
+                    labels_np[i] = np.reshape(sample[1], label_shape)
+        valid = None
+        if ragged:
+            valid = self.empty((len(samples), num_points), torch.bool)
+            valid.numpy()[...] = np.arange(num_points) < np.asarray(counts)[:, None]
+        index = torch.as_tensor([sample[2] for sample in samples]) if len(samples[0]) > 2 else None
+        return PointBatch(points, labels, valid=valid, index=index)
+
+
+class FPSOrderings():
+    """
+    Farthest point orderings of the shapes of a dataset, for the PCM mixing of the loader workers.
+    The shapes of the datasets subsampled with farthest point sampling (fps_ordered) are already in
+    farthest point order, from a random first point at every access. The shapes of the other datasets
+    keep their point order, they are ordered once, the first time a worker mixes them (the samples
+    carry their index, see IndexedDataset), and the worker keeps the orderings for the next epochs
+    (persistent workers, the worker pool). The rotation about the up axis and the jitter of the
+    augmentation do not change the ordering (up to the jitter).
+    """
+    def __init__(self, fps_ordered):
+        self.fps_ordered = fps_ordered
+        self.cache = {}
+
+    def __call__(self, points, index, valid=None):
+        """
+        Input:
+            points - the shapes of the batch [B, C, N]
+            index - dataset indices of the shapes
+            valid - valid points of the padded shapes [B, N] (their points first), None if all are valid
+        Return: farthest point ordering of the points of each shape [B, N] (repeated over the padding)
+        """
+        batch_size, _, num_points = points.shape
+        if self.fps_ordered and valid is None:
+            return np.broadcast_to(np.arange(num_points), (batch_size, num_points))
+        # shapes of the fps_ordered datasets padded in a batch (fewer points than the subsampling) are
+        # ordered here, the orderings are cached by index for the shapes that keep their point order
+        counts = [num_points] * batch_size if valid is None else valid.sum(axis=1)
+        cached = not self.fps_ordered and index is not None
+        orderings = []
+        for b in range(batch_size):
+            ordering = self.cache.get(int(index[b])) if cached else None
+            if ordering is None:
+                ordering = farthest_point_sample_np(points[b:b + 1, :, :counts[b]], counts[b])[0][0].astype(np.int32)
+                if cached:
+                    self.cache[int(index[b])] = ordering
+            orderings.append(np.resize(ordering, num_points))
+        return np.stack(orderings)
+
+
+class AugmentCollate(PointCollate):
+    """
+    PointCollate that also draws the DefRec deformation and the PCM mixing of the batch
+    (DefRec.deform_input_np, PCM.mix_shapes_np), which the trainers otherwise draw on the device between
+    the forward passes, so the loader workers prepare them while the device computes. The draws use the
+    numpy generator of the worker, seeded per worker by the DataLoader and per batch by the worker pool.
+    """
+    def __init__(self, pin_memory=False, defrec=None, pcm=None, orderings=None, segmentation=False):
+        """
+        Input:
+            defrec - (regions center points, DefRec_dist) of the DefRec deformation, None without it
+            pcm - mixup_params of the PCM mixing, None without it
+            orderings - FPSOrderings of the dataset (with pcm)
+            segmentation - mix the point labels (mix_shapes_segmentation) instead of the shape labels
+        """
+        super().__init__(pin_memory)
+        self.defrec = defrec
+        self.pcm = pcm
+        self.orderings = orderings
+        self.segmentation = segmentation
+
+    def tensor(self, array, dtype):
+        out = self.empty(array.shape, dtype)
+        out.numpy()[...] = array
+        return out
+
+    def __call__(self, samples):
+        batch = super().__call__(samples)
+        points, labels = batch.points.numpy(), batch.labels.numpy()
+        valid = None if batch.valid is None else batch.valid.numpy()
+        if self.defrec is not None:
+            lookup, DefRec_dist = self.defrec
+            batch.deformed = self.tensor(points, torch.float32)
+            batch.mask = self.empty(points.shape, torch.float32)
+            DefRec.deform_input_np(batch.deformed.numpy(), lookup, DefRec_dist, mask=batch.mask.numpy(),
+                                   valid=valid)
+        if self.pcm is not None:
+            # the mixes are made of points of the shapes, they have no padding
+            orderings = self.orderings(points, batch.index, valid)
+            if self.segmentation:
+                mixed, mixed_labels = PCM.mix_shapes_segmentation_np(self.pcm, points, labels, orderings)
+                batch.labels_a = self.tensor(mixed_labels, torch.int64)
+            else:
+                mixed, (_, labels_b, batch.lam) = PCM.mix_shapes_np(self.pcm, points, labels, orderings)
+                batch.labels_a = batch.labels
+                batch.labels_b = self.tensor(labels_b, torch.int64)
+            batch.mixed = self.tensor(mixed, torch.float32)
+        return batch
@@ -0,0 +1,198 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+import torch
+
+# histogram bucket edges of the stage durations (ms)
+HIST_EDGES_MS = (0.1, 1, 10, 100, 1000, 10000)
+
+
+class StageProfiler():
+    """
+    Wall clock timing of the stages of a training step.
+        profiler = StageProfiler(enabled=True, device=device, trace_path='trace.json')
+        with profiler.stage('forward'):
+            ...
+        for batch in profiler.iterate(loader, 'data'):
+            ...
+    When enabled, the device is synchronized at the start and end of every stage, so a stage is
+    charged with its own kernels. The durations are aggregated per epoch (summary/log) and kept as
+    Chrome trace events (chrome://tracing, ui.perfetto.dev). When disabled, stage() returns a shared
+    no-op context and iterate() the iterable itself.
+    With a MemoryTracker (utils.memory_tracker) as memory, the stages also record their memory.
+    """
+    def __init__(self, enabled=False, device=None, trace_path=None, max_events=1000000, pid=0, memory=None):
+        self.enabled = enabled
+        self.memory = memory
+        self.sync = enabled and device is not None and device.type == 'cuda'
+        self.device = device
+        self.trace_path = trace_path
+        self.max_events = max_events
+        self.pid = pid
+        self.durations = {}
+        self.events = []
+        self.origin = time.perf_counter()
+        self.local = threading.local()
+        self.null_stage = contextlib.nullcontext()
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+    def stage(self, name):
+        """
+        Context timing the enclosed code as stage name (nested stages are charged to both)
+        """
+        if not self.enabled:
+            return self.null_stage
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        self.synchronize()
+        if self.memory is not None:
+            self.memory.enter(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            end = time.perf_counter()
+            if self.memory is not None:
+                self.memory.exit(name)
+            self.local.depth = depth
+            self.record(name, start, end, depth)
+
+    def record(self, name, start, end, depth=0):
+        self.durations.setdefault(name, []).append(end - start)
+        if len(self.events) < self.max_events:
+            self.events.append({'name': name, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident() % 100000,
+                                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6,
+                                'args': {'depth': depth}})
+
+    def wrap(self, name=None):
+        """
+        Decorator timing every call of a function as stage name (default: the function name)
+        """
+        def decorator(fn):
+            stage_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, iterable, name='data'):
+        """
+        Iterate iterable, timing the wait for every item as stage name (data loading)
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name)
+
+    def _iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, start, time.perf_counter())
+            yield item
+
+    def end_step(self, step):
+        """
+        Close the memory row of a training step (see MemoryTracker.end_step)
+        """
+        if self.memory is not None:
+            self.memory.end_step(step)
+
+    def summary(self, reset=True):
+        """
+        Return:
+            dict of stage name to its call count, total/mean/p50/p90/max time (s) and the histogram
+            of its durations (counts per HIST_EDGES_MS bucket), sorted by total time
+        """
+        summary = {}
+        for name, durations in self.durations.items():
+            d = np.asarray(durations)
+            hist = np.histogram(d * 1000, bins=(0,) + HIST_EDGES_MS + (np.inf,))[0]
+            summary[name] = {'count': len(d), 'total': float(d.sum()), 'mean': float(d.mean()),
+                             'p50': float(np.percentile(d, 50)), 'p90': float(np.percentile(d, 90)),
+                             'max': float(d.max()), 'hist': hist.tolist()}
+        if reset:
+            self.durations = {}
+        return dict(sorted(summary.items(), key=lambda kv: -kv[1]['total']))
+
+    def log(self, io, epoch, elapsed=None):
+        """
+        Write the stage summary of the epoch to the run log (and the trace file so far)
+        Input:
+            elapsed - wall time of the epoch (s), for the share of every stage
+        """
+        if not self.enabled:
+            return
+        summary = self.summary()
+        edges = ('<%g' % HIST_EDGES_MS[0],) + tuple('%g-%g' % e for e in zip(HIST_EDGES_MS, HIST_EDGES_MS[1:])) + \
+            ('>%g' % HIST_EDGES_MS[-1],)
+        io.cprint("Stage times of epoch %d (ms; histogram buckets %s)" % (epoch, ' '.join(edges)))
+        for name, s in summary.items():
+            share = ", %5.1f%%" % (100 * s['total'] / elapsed) if elapsed else ""
+            io.cprint("  %-20s %7d calls, total %9.1f s%s, mean %8.2f, p50 %8.2f, p90 %8.2f, max %8.2f, hist %s"
+                      % (name, s['count'], s['total'], share, s['mean'] * 1000, s['p50'] * 1000, s['p90'] * 1000,
+                         s['max'] * 1000, s['hist']))
+        if self.memory is not None:
+            self.memory.log(io, epoch)
+        self.save_trace()
+
+    def save_trace(self):
+        """
+        Write the recorded events as a Chrome trace json (rewritten with all the events so far)
+        """
+        if not self.enabled or self.trace_path is None:
+            return
+        tmp_path = self.trace_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp_path, self.trace_path)
+
+
+# profiler of the running script, used by the profiled decorator of library functions
+_profiler = StageProfiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+    return profiler
+
+
+def profiled(name=None):
+    """
+    Decorator timing every call of a function as a stage of the current profiler (see set_profiler);
+    a disabled profiler costs one attribute check per call
+    """
+    def decorator(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _profiler.enabled:
+                return fn(*args, **kwargs)
+            with _profiler.stage(stage_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,96 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+
+
+def quantization_engine():
+    """
+    Return: the quantized kernels backend of the CPU (x86/fbgemm on x86, qnnpack on arm)
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError("no quantized engine available")
+
+
+def is_pointwise_conv(module):
+    return isinstance(module, (nn.Conv1d, nn.Conv2d)) and all(k == 1 for k in module.kernel_size)
+
+
+def wrap_pointwise_convs(module):
+    """
+    Wrap the 1x1 convs of module in QuantWrappers (quantize input, int8 conv, dequantize output), in place.
+    A conv that starts an nn.Sequential block (conv_2d: conv, folded BatchNorm, activation) is wrapped
+    with its block, so the activation also runs on int8. The rest of the model (knn, graph features,
+    pooling) stays in float.
+    Return: the wrappers
+    """
+    wrappers = []
+    for name, child in list(module.named_children()):
+        if is_pointwise_conv(child) or (isinstance(child, nn.Sequential) and len(child) > 0 and
+                                        is_pointwise_conv(child[0])):
+            for m in child.modules():
+                if isinstance(m, nn.LeakyReLU):
+                    m.inplace = False  # not supported by the quantized kernel
+            wrapper = tq.QuantWrapper(child)
+            if isinstance(module, nn.Sequential):
+                module[int(name)] = wrapper
+            else:
+                setattr(module, name, wrapper)
+            wrappers.append(wrapper)
+        else:
+            wrappers += wrap_pointwise_convs(child)
+    return wrappers
+
+
+def quantize_model(model, calibration_batches=None, static=True, dynamic=True):
+    """
+    Post training int8 quantization for CPU inference.
+    Input:
+        model - float model, preferably exported (BatchNorms folded into the convs, see utils.export)
+        calibration_batches - iterable of model inputs, to observe the activation ranges of the convs
+        static - static quantization of the 1x1 convs (weights and activations, calibrated)
+        dynamic - dynamic quantization of the linear layers (int8 weights, activations quantized per batch)
+    Return:
+        quantized copy of the model (eval mode, cpu)
+    """
+    torch.backends.quantized.engine = quantization_engine()
+    model = copy.deepcopy(model).cpu().eval()
+    if static:
+        qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+        for wrapper in wrap_pointwise_convs(model):
+            wrapper.qconfig = qconfig
+        tq.prepare(model, inplace=True)
+        with torch.no_grad():
+            for x in calibration_batches:
+                model(x)
+        tq.convert(model, inplace=True)
+    if dynamic:
+        model = tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def quantized_state(model, config, head, static=True, dynamic=True):
+    """
+    Return: checkpoint of a model quantized by quantize_model (quantized modules are saved through
+    their state dict, the model is rebuilt by load_quantized)
+    """
+    return {'quantization': {'static': static, 'dynamic': dynamic},
+            'config': vars(config),
+            'head': head,
+            'model': model.state_dict()}
+
+
+def load_quantized(model, state):
+    """
+    Input:
+        model - float model with the architecture of the quantized one (exported, see utils.export)
+        state - checkpoint returned by quantized_state
+    Return:
+        the quantized model
+    """
+    model = quantize_model(model, [], **state['quantization'])
+    model.load_state_dict(state['model'])
+    return model
@@ -0,0 +1,254 @@
+import collections
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PointDA.data.dataloader import idx_to_label
+from utils.inference import preprocess, collate_point_clouds, valid_mask
+
+DEFAULT_BUCKETS = (512, 1024, 2048, 4096)
+
+
+def bucket_size(num_points, buckets=DEFAULT_BUCKETS):
+    """
+    Return: the smallest bucket holding num_points; larger clouds get a bucket of their size rounded
+    up to a multiple of the largest bucket
+    """
+    for size in buckets:
+        if num_points <= size:
+            return size
+    return -(-num_points // buckets[-1]) * buckets[-1]
+
+
+class LatencyStats():
+    """
+    Latencies (queue wait, batch compute, total; ms) of the last window requests and the sizes of the
+    batches they were served in
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+        self.start = time.perf_counter()
+
+    def add(self, queue_ms, compute_ms, total_ms, batch_size):
+        with self.lock:
+            self.latencies.append((queue_ms, compute_ms, total_ms))
+            self.batch_sizes.append(batch_size)
+            self.requests += 1
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        Return: dict with the request count and rate, the mean batch size and the latency percentiles
+        """
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64).reshape(-1, 3)
+            batch_sizes = np.array(self.batch_sizes, dtype=np.float64)
+            requests = self.requests
+        summary = {'requests': requests,
+                   'requests_per_s': requests / (time.perf_counter() - self.start),
+                   'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.0}
+        for i, name in enumerate(('queue', 'compute', 'total')):
+            for p in percentiles:
+                value = np.percentile(latencies[:, i], p) if len(latencies) else 0.0
+                summary['%s_p%d_ms' % (name, p)] = float(value)
+        return summary
+
+
+class Request():
+    def __init__(self, points):
+        self.points = points
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.logits = None
+        self.error = None
+
+
+class DynamicBatcher():
+    """
+    Coalesce concurrent requests into batches.
+    Requests are queued per point count bucket. The bucket with the oldest request is served when it
+    holds max_batch_size requests or when its oldest request waited max_latency_ms, so a request waits
+    at most max_latency_ms for other requests to join its batch. A batch is padded to its bucket size,
+    which keeps the number of distinct input shapes small; the model skips the padding (valid mask),
+    so the prediction of a request does not depend on the requests batched with it.
+    """
+    def __init__(self, predictor, max_batch_size=32, max_latency_ms=5.0, buckets=DEFAULT_BUCKETS):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.buckets = tuple(sorted(buckets))
+        self.pending = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.stats = LatencyStats()
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, points, timeout=None):
+        """
+        Input:
+            points - [N, 3] float32 array, preprocessed
+        Return:
+            float32 logits, [C] for classification and [N, C] for segmentation
+        """
+        request = Request(points)
+        with self.cond:
+            self.pending.setdefault(bucket_size(points.shape[0], self.buckets), []).append(request)
+            self.cond.notify()
+        if not request.done.wait(timeout):
+            raise TimeoutError("no prediction after %s s" % timeout)
+        if request.error is not None:
+            raise request.error
+        return request.logits
+
+    def _next_batch(self):
+        with self.cond:
+            while self.running and not any(self.pending.values()):
+                self.cond.wait()
+            if not self.running:
+                return None, None
+            bucket = min((b for b, reqs in self.pending.items() if reqs), key=lambda b: self.pending[b][0].arrival)
+            deadline = self.pending[bucket][0].arrival + self.max_latency
+            while len(self.pending[bucket]) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not self.running:
+                    break
+                self.cond.wait(remaining)
+            batch = self.pending[bucket][:self.max_batch_size]
+            del self.pending[bucket][:self.max_batch_size]
+            return bucket, batch
+
+    def _loop(self):
+        while True:
+            bucket, batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            try:
+                logits = self.run(bucket, [r.points for r in batch])
+                for i, r in enumerate(batch):
+                    r.logits = logits[i] if logits.dim() == 2 else logits[i, :r.points.shape[0]]
+            except Exception as e:  # reported to the waiting clients, the server keeps running
+                for r in batch:
+                    r.error = e
+            end = time.perf_counter()
+            for r in batch:
+                r.done.set()
+                self.stats.add((start - r.arrival) * 1000, (end - start) * 1000, (end - r.arrival) * 1000, len(batch))
+
+    def run(self, bucket, clouds):
+        """
+        Return: host logits of the clouds padded to bucket points
+        """
+        points, lengths, _ = collate_point_clouds([(c, i) for i, c in enumerate(clouds)], num_points=bucket)
+        valid = valid_mask(lengths, bucket)
+        points = points.pin_memory() if self.predictor.device.type == 'cuda' else points
+        points = points.to(self.predictor.device, non_blocking=True)
+        if valid is not None:
+            valid = valid.to(self.predictor.device, non_blocking=True)
+        return self.predictor.forward(points, valid).cpu()
+
+    def warmup(self, rounds=2):
+        """
+        Run full batches of every bucket, so allocations and kernel selection happen before the first request
+        """
+        buckets = self.buckets
+        if self.predictor.task == 'cls':  # classification inputs are sampled down to num_points
+            buckets = [b for b in buckets if b <= bucket_size(self.predictor.num_points, self.buckets)]
+        for bucket in buckets:
+            clouds = [np.random.rand(bucket, 3).astype(np.float32)] * self.max_batch_size
+            for _ in range(rounds):
+                self.run(bucket, clouds)
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+
+def read_points(body, content_type):
+    """
+    Return: the point cloud of a request body, an .npy file (application/octet-stream) or
+    json {"points": [[x, y, z], ...]}
+    """
+    if content_type.startswith('application/json'):
+        points = np.asarray(json.loads(body)['points'], dtype=np.float32)
+    else:
+        points = np.load(io.BytesIO(body), allow_pickle=False)
+    if points.ndim != 2 or points.shape[1] < 3 or points.shape[0] == 0:
+        raise ValueError("expected a [N, 3] point cloud, got shape %s" % (points.shape,))
+    return points
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    POST /predict: point cloud (see read_points) -> json prediction
+    GET /stats: latency percentiles
+    GET /health
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive connections
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, {'status': 'ok', 'task': self.server.predictor.task})
+        elif self.path == '/stats':
+            self.reply(200, self.server.batcher.stats.summary())
+        else:
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/predict':
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        predictor = self.server.predictor
+        try:
+            points = read_points(body, self.headers.get('Content-Type', ''))
+            points = preprocess(points, predictor.task, predictor.num_points, predictor.rotate)
+        except (ValueError, KeyError, OSError) as e:
+            self.reply(400, {'error': str(e)})
+            return
+        try:
+            logits = self.server.batcher.submit(points, timeout=self.server.timeout_s)
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+            return
+        if predictor.task == 'cls':
+            label = int(logits.argmax())
+            result = {'label': label, 'class_name': idx_to_label[label]}
+        else:
+            result = {'labels': logits.argmax(dim=-1).tolist()}
+        if self.server.return_logits:
+            result['logits'] = logits.tolist()
+        self.reply(200, result)
+
+    def log_message(self, format, *args):
+        pass  # no line per request
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """
+    HTTP server with one thread per connection; requests are preprocessed in the connection threads
+    and batched for the model by a DynamicBatcher
+    """
+    daemon_threads = True
+
+    def __init__(self, address, predictor, batcher, return_logits=False, timeout_s=30.0):
+        super().__init__(address, PredictionHandler)
+        self.predictor = predictor
+        self.batcher = batcher
+        self.return_logits = return_logits
+        self.timeout_s = timeout_s
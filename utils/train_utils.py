@@ -0,0 +1,48 @@
+import contextlib
+import torch
+import torch.nn as nn
+
+
+def micro_batch_slices(batch_size, accum_steps=1):
+    """
+    Split a batch into accum_steps contiguous micro-batches of (almost) equal size. With the losses
+    weighted by the micro-batch share, the accumulated gradient is that of the batch mean only for
+    models without batch norm: the batch norm layers normalize each micro-batch with its own
+    statistics, so with them it approximates the full batch gradient (closer for larger micro-batches).
+    Input:
+        batch_size - number of samples in the batch
+        accum_steps - number of micro-batches (capped by batch_size)
+    Return:
+        list of slices, one per micro-batch
+    """
+    accum_steps = max(1, min(accum_steps, batch_size))
+    bounds = [(batch_size * i) // accum_steps for i in range(accum_steps + 1)]
+    return [slice(bounds[i], bounds[i + 1]) for i in range(accum_steps)]
+
+
+def no_sync(model, sync=False):
+    """
+    Context of the forward and backward passes of a micro-batch: under DistributedDataParallel the
+    gradient all-reduce is skipped unless sync (the last micro-batch, whose backward reduces the
+    gradients accumulated over all the micro-batches of the batch)
+    """
+    if sync or not hasattr(model, 'no_sync'):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+@contextlib.contextmanager
+def preserve_bn_stats(modules):
+    """
+    Context in which train mode forward passes do not change the running statistics of the batch norm
+    layers of modules (e.g. passes that are repeated, so each step updates them once)
+    """
+    bns = [m for module in modules for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    buffers = [[b.clone() for b in bn.buffers()] for bn in bns]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for bn, saved in zip(bns, buffers):
+                for b, s in zip(bn.buffers(), saved):
+                    b.copy_(s)
@@ -0,0 +1,291 @@
+import collections
+import itertools
+import queue
+import random
+import signal
+import threading
+import traceback
+import zlib
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+from utils.point_batch import PointCollate
+
+# task priorities, lower is served first
+TRAIN = 0
+EVAL = 1
+
+
+def task_seed(seed, name, epoch, batch):
+    """
+    Return: seed of the batch-th batch of an epoch of loader name, independent of the worker that loads it
+    """
+    return (seed * 1000003 + zlib.crc32(name.encode()) + epoch * 100003 + batch) % 2 ** 32
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def load_batch(datasets, collate_fns, name, indices, seed):
+    seed_everything(seed)
+    dataset = datasets[name]
+    return collate_fns[name]([dataset[i] for i in indices])
+
+
+def _worker_loop(datasets, collate_fns, task_queue, result_queue, threads):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # interrupts are handled by the main process
+    if threads > 0:
+        torch.set_num_threads(threads)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        task_id, name, indices, seed = task
+        try:
+            result_queue.put((task_id, load_batch(datasets, collate_fns, name, indices, seed), None))
+        except Exception:
+            result_queue.put((task_id, None, "loading batch of %s failed in a pool worker:\n%s"
+                              % (name, traceback.format_exc())))
+
+
+class WorkerPool():
+    """
+    One set of worker processes loading the batches of all the datasets of a run, for the whole run.
+    The datasets (and what they cache) stay loaded in the workers across epochs and phases, and no
+    worker is started per epoch or per loader.
+    Loaders (PooledLoader) submit batches of sample indices with a priority. At most max_inflight
+    batches are handed to the workers, the other submitted batches wait in per priority queues, so a
+    lower priority loader (evaluation) only gets the workers the higher priority ones (training) leave.
+    Every batch is loaded with its own seed (task_seed), so the random augmentations do not depend
+    on which worker loads it.
+    """
+    def __init__(self, datasets, num_workers, worker_threads=0, pin_memory=False, max_inflight=None, seed=0,
+                 collate_fns=None):
+        """
+        Input:
+            datasets - dict of name to dataset, the batches are collated into PointBatch
+            collate_fns - dict of name to collate function of the datasets collated otherwise (AugmentCollate)
+        """
+        self.datasets = datasets
+        self.prefetch = {}
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        # the batches of the workers are pinned by the router thread, the ones loaded in place directly
+        collate_fns = collate_fns or {}
+        self.collate_fns = {name: collate_fns.get(name) or PointCollate(pin_memory=self.pin_memory and num_workers == 0)
+                            for name in datasets}
+        self.max_inflight = max_inflight or 2 * max(num_workers, 1)
+        self.seed = seed
+        self.ids = itertools.count()
+        self.cond = threading.Condition()
+        self.pending = collections.defaultdict(collections.deque)  # priority -> tasks
+        self.cancelled = set()
+        self.results = {}
+        self.inflight = 0
+        self.error = None
+        self.running = True
+        self.workers = []
+        if num_workers > 0:
+            self.task_queue = multiprocessing.Queue()
+            self.result_queue = multiprocessing.Queue()
+            for _ in range(num_workers):
+                w = multiprocessing.Process(target=_worker_loop, daemon=True,
+                                            args=(datasets, self.collate_fns, self.task_queue, self.result_queue,
+                                                  worker_threads))
+                w.start()
+                self.workers.append(w)
+            self.router = threading.Thread(target=self._route, daemon=True)
+            self.router.start()
+
+    @classmethod
+    def from_configs(cls, datasets, seed=0, collate_fns=None):
+        """
+        Pool for the loaders of the datasets with their loader configurations (utils.loader_tuning):
+        as many workers as the largest configuration, each dataset with its prefetch depth
+        Input:
+            datasets - dict of name to (dataset, loader configuration)
+        """
+        configs = [config for _, config in datasets.values()]
+        pool = cls({name: dataset for name, (dataset, _) in datasets.items()},
+                   num_workers=max(c['num_workers'] for c in configs),
+                   worker_threads=max(c['worker_threads'] for c in configs),
+                   pin_memory=any(c['pin_memory'] for c in configs), seed=seed, collate_fns=collate_fns)
+        pool.prefetch = {name: config['prefetch_factor'] * max(config['num_workers'], 1)
+                         for name, (_, config) in datasets.items()}
+        return pool
+
+    def submit(self, name, indices, seed, priority=TRAIN):
+        """
+        Queue the loading of the batch of indices of dataset name
+        Return: task id, to get the batch
+        """
+        task_id = next(self.ids)
+        with self.cond:
+            self.pending[priority].append((task_id, name, list(indices), seed))
+            self._dispatch()
+        return task_id
+
+    def _dispatch(self):
+        # called with the lock held
+        if not self.workers:
+            return
+        while self.inflight < self.max_inflight:
+            tasks = next((self.pending[p] for p in sorted(self.pending) if self.pending[p]), None)
+            if tasks is None:
+                return
+            task = tasks.popleft()
+            if task[0] in self.cancelled:
+                self.cancelled.discard(task[0])
+                continue
+            self.task_queue.put(task)
+            self.inflight += 1
+
+    def _route(self):
+        while self.running:
+            try:
+                task_id, data, error = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                dead = [w.pid for w in self.workers if not w.is_alive()]
+                if dead and self.running:
+                    with self.cond:
+                        self.error = "pool workers %s exited unexpectedly" % dead
+                        self.cond.notify_all()
+                    return
+                continue
+            if data is not None and self.pin_memory:
+                data = pin(data)
+            with self.cond:
+                self.inflight -= 1
+                if task_id in self.cancelled:
+                    self.cancelled.discard(task_id)
+                else:
+                    self.results[task_id] = (data, error)
+                self._dispatch()
+                self.cond.notify_all()
+
+    def get(self, task_id):
+        """
+        Return: the batch of task task_id (loaded in place without workers)
+        """
+        if not self.workers:
+            with self.cond:
+                _, name, indices, seed = self._pop_pending(task_id)
+            data = load_batch(self.datasets, self.collate_fns, name, indices, seed)
+            return pin(data) if self.pin_memory else data
+        with self.cond:
+            while task_id not in self.results and self.error is None:
+                self.cond.wait()
+            if task_id not in self.results:
+                raise RuntimeError(self.error)
+            data, error = self.results.pop(task_id)
+        if error is not None:
+            raise RuntimeError(error)
+        return data
+
+    def _pop_pending(self, task_id):
+        for tasks in self.pending.values():
+            for task in tasks:
+                if task[0] == task_id:
+                    tasks.remove(task)
+                    return task
+        raise KeyError(task_id)
+
+    def cancel(self, task_ids):
+        """
+        Drop submitted batches that will not be read (an abandoned loader iteration)
+        """
+        with self.cond:
+            for task_id in task_ids:
+                if task_id in self.results:
+                    del self.results[task_id]
+                elif self.workers:
+                    self.cancelled.add(task_id)
+                else:
+                    self._pop_pending(task_id)
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for w in self.workers:
+            w.join(timeout=5)
+            if w.is_alive():
+                w.terminate()
+        self.workers = []
+
+
+def pin(data):
+    if hasattr(data, 'pin_memory'):  # tensors and PointBatch
+        return data.pin_memory()
+    if isinstance(data, (list, tuple)):
+        return type(data)(pin(d) for d in data)
+    return data
+
+
+class PooledLoader():
+    """
+    DataLoader-like iterable over the batches of one dataset of a WorkerPool, in the order of the
+    sampler (or batch_sampler); prefetch batches (default: the prefetch depth of the dataset in the
+    pool) are submitted ahead of the one being read
+    """
+    def __init__(self, pool, name, sampler=None, batch_size=1, drop_last=False, batch_sampler=None,
+                 priority=TRAIN, prefetch=None):
+        self.pool = pool
+        self.name = name
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.batch_sampler = batch_sampler
+        self.priority = priority
+        self.prefetch = max(prefetch or pool.prefetch.get(name, 2), 1)
+        self.iterations = 0
+
+    def batches(self):
+        if self.batch_sampler is not None:
+            yield from self.batch_sampler
+            return
+        batch = []
+        for index in self.sampler:
+            batch.append(index)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return -(-len(self.sampler) // self.batch_size)
+
+    def __iter__(self):
+        epoch = getattr(self.batch_sampler or self.sampler, 'epoch', self.iterations)
+        self.iterations += 1
+        batches = enumerate(self.batches())
+        submitted = collections.deque()
+
+        def submit_next():
+            i, indices = next(batches, (None, None))
+            if indices is None:
+                return False
+            seed = task_seed(self.pool.seed, self.name, epoch, i)
+            submitted.append(self.pool.submit(self.name, indices, seed, self.priority))
+            return True
+
+        try:
+            for _ in range(self.prefetch):
+                if not submit_next():
+                    break
+            while submitted:
+                data = self.pool.get(submitted.popleft())
+                submit_next()
+                yield data
+        finally:
+            self.pool.cancel(list(submitted))